@@ -1,3 +1,13 @@
+from .dependency_cache import clear_dependency_cache
+from .dependency_trace import trace_dependencies
+from .images import prefetch_images
 from .lug import docker_sidecar, hybrid, run
-from .shell import sidecar_shell
-__all__ = ["docker_sidecar", "hybrid", "run", "sidecar_shell"]
+from .reaper import reaper_backlog
+from .result_cache import clear_result_cache, configure_result_cache
+from .session import session
+from .shell import sidecar_shell, sidecar_shell_async, sidecar_shell_many
+__all__ = [
+    "clear_dependency_cache", "clear_result_cache", "configure_result_cache", "docker_sidecar", "hybrid",
+    "prefetch_images", "reaper_backlog", "run", "session", "sidecar_shell", "sidecar_shell_async",
+    "sidecar_shell_many", "trace_dependencies",
+]
@@ -0,0 +1,31 @@
+import os
+import tempfile
+
+
+def cache_directory(*parts):
+    """Lug's on-disk cache directory, which can be moved with the LUG_CACHE_DIR environment variable."""
+    base_directory = os.environ.get("LUG_CACHE_DIR") or os.path.join(
+        os.environ.get("XDG_CACHE_HOME") or os.path.join(os.path.expanduser("~"), ".cache"),
+        "lug",
+    )
+    return os.path.join(base_directory, *parts)
+
+
+def write_atomically(path, content):
+    """
+    Writes bytes to a file through a temporary file that's renamed into place, so concurrent readers (including other
+    processes) see either the old or the new file, never a partial one.
+    """
+    directory = os.path.dirname(path)
+    os.makedirs(directory, exist_ok=True)
+    file_descriptor, temporary_path = tempfile.mkstemp(prefix=".tmp-", dir=directory)
+    try:
+        with os.fdopen(file_descriptor, "wb") as temporary_file:
+            temporary_file.write(content)
+        os.replace(temporary_path, path)
+    except BaseException:
+        try:
+            os.remove(temporary_path)
+        except OSError:
+            pass
+        raise
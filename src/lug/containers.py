@@ -1,14 +1,20 @@
 import uuid
+from concurrent.futures import ThreadPoolExecutor
 
 from docker.errors import ImageNotFound, APIError, DockerException
 
+from .images import image_index
+from .reaper import reap_containers_now
+
 
 class DockerContainer:
     """
     This class cannot be pickled by cloudpickle.
+    resource_options are passed to the Docker client when the container is started, e.g. cpuset_cpus or mem_limit.
     """
-    def __init__(self, docker_client=None, image_name_and_tag=None):
+    def __init__(self, docker_client=None, image_name_and_tag=None, resource_options=None):
         self.container = None
+        self.resource_options = resource_options or dict()
         self.docker_client = docker_client
         self.image = None
         self.image_name_and_tag = image_name_and_tag
@@ -19,16 +25,112 @@ class DockerContainer:
 
     def load_image(self, remote=False):
         try:
-            self.image = self.docker_client.images.get(self.image_name_and_tag)
-        except ImageNotFound:
-            if not remote:
-                self.image = self.docker_client.images.pull(self.image_name_and_tag)
+            # Resolved images are cached per process, so this only reaches the Docker daemon on first use
+            self.image = image_index.resolve(self.docker_client, self.image_name_and_tag, remote=remote)
         except (APIError, DockerException):
             if not remote:
                 raise EnvironmentError(
                     'Unable to connect to Docker. Make sure you have Docker installed and that it is currently running.'
                 )
 
-    def signal_kill_handler(self, signum, frame):
-        if self.container is not None:
+    def start(self, mount, docker_shell_location):
+        # The shell is kept alive by an open stdin, so the container idles until it's torn down
+        container_options = dict(
+            image=self.image_name_and_tag,
+            volumes=[f'{mount}:/lug'],
+            detach=True,
+            stdin_open=True,
+            name=self.container_name,
+            command=docker_shell_location,
+            working_dir="/lug",
+            **self.resource_options,
+        )
+        try:
+            self.container = self.docker_client.containers.run(**container_options)
+        except ImageNotFound:
+            # The cached image was removed from the daemon since it was resolved
+            image_index.invalidate(self.image_name_and_tag)
+            self.load_image()
+            self.container = self.docker_client.containers.run(**container_options)
+
+    @property
+    def image_id(self):
+        """The content-addressed ID of the image that the container was started from."""
+        return self.container.attrs.get("Image") if self.container is not None else None
+
+    def is_running(self):
+        try:
+            self.container.reload()
+        except (APIError, DockerException):
+            return False
+        return self.container.status == "running"
+
+    def teardown(self):
+        self.container.reload()
+        if self.container.status == "running":
             self.container.stop()
+        self.container.remove()
+
+    def signal_kill_handler(self, signum, frame):
+        reap_containers_now([self])
+
+
+# Thread pool sizes of common numerical libraries, which otherwise default to every CPU the container can see
+THREAD_COUNT_ENVIRONMENT_VARIABLES = [
+    "OMP_NUM_THREADS", "OPENBLAS_NUM_THREADS", "MKL_NUM_THREADS", "VECLIB_MAXIMUM_THREADS", "NUMEXPR_NUM_THREADS",
+]
+
+
+def partition_cpus(num_cpus, num_partitions):
+    """
+    Splits CPUs 0 to num_cpus - 1 into num_partitions contiguous cpusets, like "0-3". If there are more partitions
+    than CPUs, partitions share CPUs.
+    """
+    cpusets = []
+    for partition in range(num_partitions):
+        if num_partitions >= num_cpus:
+            cpu = partition % num_cpus
+            cpusets.append(f"{cpu}")
+            continue
+        first_cpu = partition * num_cpus // num_partitions
+        last_cpu = (partition + 1) * num_cpus // num_partitions - 1
+        cpusets.append(f"{first_cpu}-{last_cpu}" if last_cpu > first_cpu else f"{first_cpu}")
+    return cpusets
+
+
+def partitioned_resource_options(docker_client, num_partitions, mem_limit=None, shm_size=None):
+    """
+    Returns container resource options that give each of num_partitions containers its own share of the Docker
+    daemon's CPUs, with numerical libraries' thread pools sized to match.
+    """
+    num_cpus = docker_client.info()["NCPU"]
+    resource_options = []
+    for cpuset in partition_cpus(num_cpus, num_partitions):
+        first_cpu, _, last_cpu = cpuset.partition("-")
+        num_threads = int(last_cpu or first_cpu) - int(first_cpu) + 1
+        options = dict(
+            cpuset_cpus=cpuset,
+            environment={variable: str(num_threads) for variable in THREAD_COUNT_ENVIRONMENT_VARIABLES},
+        )
+        if mem_limit is not None:
+            options["mem_limit"] = mem_limit
+        if shm_size is not None:
+            options["shm_size"] = shm_size
+        resource_options.append(options)
+    return resource_options
+
+
+def start_containers(user_dockers, mount, docker_shell_location):
+    """Loads images for and starts sidecar containers concurrently, all sharing the same mount."""
+    def load_and_start(user_docker):
+        if user_docker.image is None:
+            user_docker.load_image()
+        user_docker.start(mount=mount, docker_shell_location=docker_shell_location)
+
+    if len(user_dockers) <= 1:
+        for user_docker in user_dockers:
+            load_and_start(user_docker)
+        return
+    with ThreadPoolExecutor(max_workers=len(user_dockers), thread_name_prefix="lug-container-start") as executor:
+        for started in [executor.submit(load_and_start, user_docker) for user_docker in user_dockers]:
+            started.result()
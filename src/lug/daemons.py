@@ -0,0 +1,115 @@
+import os
+import threading
+import time
+
+import docker
+from docker.errors import APIError, DockerException
+
+from .images import image_index
+
+_daemon_pools = dict()
+_daemon_pools_lock = threading.Lock()
+
+
+class DockerDaemon:
+    """One Docker daemon in a DaemonPool, and the number of sidecar calls currently running on it."""
+    def __init__(self, docker_host):
+        self.docker_host = docker_host
+        self.client = None
+        self.active_calls = 0
+        self.consecutive_failures = 0
+        self.ejected_until = 0
+
+    def __repr__(self):
+        return f"<Lug DockerDaemon {self.docker_host} ({self.active_calls} active)>"
+
+    def connect(self):
+        if self.client is None:
+            # Connected like docker.from_env(), so TLS settings in the environment still apply
+            self.client = docker.from_env(environment={**os.environ, "DOCKER_HOST": self.docker_host})
+        return self.client
+
+    def is_healthy(self):
+        try:
+            return bool(self.connect().ping())
+        except (APIError, DockerException, OSError):
+            return False
+
+
+class DaemonPool:
+    """
+    Schedules local sidecar calls across several Docker daemons.
+
+    Each call runs on the healthy daemon with the fewest calls in progress, preferring daemons that already have the
+    sidecar image when there's a tie. A daemon that fails `max_failures` health checks in a row is ejected for
+    `ejection_period` seconds, after which it's health checked again before being used.
+
+    Mounts are bind mounted by each daemon's host, so the mounted directory must exist at the same path on every host
+    (e.g. on a shared filesystem).
+    """
+    def __init__(self, docker_hosts, max_failures=1, ejection_period=30):
+        if not docker_hosts:
+            raise ValueError("A Docker daemon pool needs at least one Docker host.")
+        self.daemons = [DockerDaemon(docker_host) for docker_host in docker_hosts]
+        self.max_failures = max_failures
+        self.ejection_period = ejection_period
+        self.lock = threading.Lock()
+
+    def __repr__(self):
+        return f"<Lug DaemonPool ({len(self.daemons)} daemons)>"
+
+    def record_health(self, daemon, healthy):
+        with self.lock:
+            if healthy:
+                daemon.consecutive_failures = 0
+                daemon.ejected_until = 0
+                return
+            daemon.consecutive_failures += 1
+            if daemon.consecutive_failures >= self.max_failures:
+                daemon.ejected_until = time.monotonic() + self.ejection_period
+
+    def candidates(self, image_name_and_tag):
+        """Daemons that aren't ejected, least loaded first."""
+        now = time.monotonic()
+        with self.lock:
+            daemons = [daemon for daemon in self.daemons if daemon.ejected_until <= now]
+
+        def load(daemon):
+            has_image = daemon.client is not None and image_index.is_cached(daemon.client, image_name_and_tag)
+            return daemon.active_calls, not has_image
+
+        return sorted(daemons, key=load)
+
+    def acquire(self, image_name_and_tag):
+        """Picks a daemon for a call and counts the call against it. Pass the daemon to release() afterwards."""
+        for daemon in self.candidates(image_name_and_tag):
+            # Daemons that haven't connected yet or were ejected are checked before they're used
+            if daemon.client is None or daemon.consecutive_failures:
+                healthy = daemon.is_healthy()
+                self.record_health(daemon, healthy)
+                if not healthy:
+                    continue
+            with self.lock:
+                daemon.active_calls += 1
+            return daemon
+        raise EnvironmentError(
+            'Unable to connect to any Docker daemon in the pool. Make sure the Docker hosts are running and reachable.'
+        )
+
+    def release(self, daemon, failed=False):
+        """Ends a call on the daemon. After a failed call, the daemon is health checked, and ejected if unhealthy."""
+        with self.lock:
+            daemon.active_calls -= 1
+        if failed:
+            self.record_health(daemon, daemon.is_healthy())
+
+
+def get_daemon_pool(docker_hosts, **pool_options):
+    """Returns the process-wide pool for these Docker hosts, creating it on first use."""
+    pool_key = tuple(docker_hosts)
+    with _daemon_pools_lock:
+        pool = _daemon_pools.get(pool_key)
+        if pool is None:
+            pool = DaemonPool(docker_hosts, **pool_options)
+            _daemon_pools[pool_key] = pool
+    return pool
@@ -0,0 +1,81 @@
+import os
+import sys
+import threading
+import types
+import weakref
+
+from .dependency_trace import clear_traces
+from .module_detection import module_graph
+
+
+def environment_fingerprint():
+    """
+    A cheap fingerprint of the interpreter's importable environment: the loaded modules, and the import path along
+    with the modification times of its directories, which change when packages are installed or removed.
+    """
+    path_modification_times = []
+    for path in sys.path:
+        try:
+            path_modification_times.append(os.stat(path or ".").st_mtime_ns)
+        except OSError:
+            path_modification_times.append(None)
+    return len(sys.modules), hash(tuple(sys.modules)), tuple(sys.path), tuple(path_modification_times)
+
+
+def function_fingerprint(func):
+    """The function's code, and the modules bound in its globals."""
+    bound_modules = tuple(
+        (name, id(value)) for name, value in func.__globals__.items() if isinstance(value, types.ModuleType)
+    )
+    return func.__code__, bound_modules
+
+
+class DependencyCache:
+    """
+    Memoizes the dependency analysis of lugged functions, so only the first call to a function pays for it.
+
+    Entries are kept per function object and are reused as long as the function's code, the modules bound in its
+    globals, and the interpreter's environment fingerprint are unchanged.
+    """
+    def __init__(self):
+        self.entries = weakref.WeakKeyDictionary()  # function: (fingerprint, analysis)
+        self.lock = threading.Lock()
+
+    def __repr__(self):
+        return f"<Lug DependencyCache ({len(self.entries)} functions)>"
+
+    def fingerprint(self, func):
+        return function_fingerprint(func), environment_fingerprint()
+
+    def get(self, func, fingerprint):
+        with self.lock:
+            entry = self.entries.get(func)
+        if entry is None or entry[0] != fingerprint:
+            return None
+        return entry[1]
+
+    def store(self, func, fingerprint, analysis):
+        with self.lock:
+            self.entries[func] = (fingerprint, analysis)
+
+    def clear(self, func=None):
+        with self.lock:
+            if func is None:
+                self.entries.clear()
+            else:
+                self.entries.pop(getattr(func, "__wrapped__", func), None)
+
+
+dependency_cache = DependencyCache()
+
+
+def clear_dependency_cache(func=None):
+    """
+    Forgets the cached dependency analysis of a lugged function, or of every function if none is given. The next call
+    analyzes the function's dependencies again. Saved traces (see dependency_mode="trace") are removed too, and clearing
+    every function also forgets the module dependency graph.
+    """
+    dependency_cache.clear(func)
+    clear_traces(func)
+    if func is None:
+        module_graph.clear()
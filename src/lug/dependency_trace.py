@@ -0,0 +1,146 @@
+import builtins
+import hashlib
+import importlib
+import importlib.abc
+import importlib.util
+import json
+import os
+import shutil
+import sys
+import threading
+import types
+
+from .caching import cache_directory, write_atomically
+from .module_detection import bytecode_dependencies, is_searchable_module
+from .package_index import get_package_index
+
+_tracing_lock = threading.Lock()  # The import hooks are process-wide, so only one function is traced at a time
+
+
+def code_digest(code, digest):
+    digest.update(code.co_code)
+    digest.update(repr(code.co_names).encode())
+    for constant in code.co_consts:
+        if isinstance(constant, types.CodeType):
+            code_digest(constant, digest)
+        elif isinstance(constant, frozenset):
+            # Set order depends on string hashing, which is randomized per process
+            digest.update(repr(sorted(map(repr, constant))).encode())
+        else:
+            digest.update(repr(constant).encode())
+
+
+def stable_function_fingerprint(func):
+    """
+    Fingerprints a function by its name and code, so the fingerprint is the same in every process that defines the
+    same function with the same version of Python.
+    """
+    digest = hashlib.sha256(f"{sys.version_info.major}.{sys.version_info.minor}".encode())
+    digest.update(f"\0{func.__module__}.{func.__qualname__}\0".encode())
+    code_digest(func.__code__, digest)
+    return digest.hexdigest()
+
+
+def trace_path(func):
+    return cache_directory("traces", f"{stable_function_fingerprint(func)}.json")
+
+
+class ImportTracer(importlib.abc.MetaPathFinder):
+    """
+    Records the names of the modules imported while it's installed: modules loaded for the first time, through
+    `sys.meta_path`, and the targets of every import statement, through `builtins.__import__`, including modules that
+    were already loaded.
+
+    The hooks are process-wide, so only imports made by the thread that installed the tracer are recorded.
+    """
+    def __init__(self):
+        self.imported_module_names = set()
+        self.original_import = None
+        self.thread_id = None
+
+    def find_spec(self, fullname, path=None, target=None):
+        if threading.get_ident() == self.thread_id:
+            self.imported_module_names.add(fullname)
+        return None  # Leaves loading to the other finders
+
+    def traced_import(self, name, globals=None, locals=None, fromlist=(), level=0):
+        module = self.original_import(name, globals, locals, fromlist, level)
+        if threading.get_ident() != self.thread_id:
+            return module
+        if level:
+            package = (globals or dict()).get("__package__")
+            try:
+                name = importlib.util.resolve_name("." * level + name, package)
+            except (ImportError, ValueError):
+                return module
+        self.imported_module_names.add(name)
+        for from_name in fromlist or ():
+            self.imported_module_names.add(f"{name}.{from_name}")
+        return module
+
+    def __enter__(self):
+        self.thread_id = threading.get_ident()
+        self.original_import = builtins.__import__
+        builtins.__import__ = self.traced_import
+        sys.meta_path.insert(0, self)
+        return self
+
+    def __exit__(self, *exc_info):
+        sys.meta_path.remove(self)
+        builtins.__import__ = self.original_import
+
+
+def trace_dependencies(func, *args, **kwargs):
+    """
+    Runs a function locally once, recording every module it imports along with the modules its code references, and
+    saves them in Lug's cache directory for dependency_mode="trace". Returns the function's result. Imports made by
+    other threads, including threads the function starts, aren't recorded.
+    """
+    func = getattr(func, "__wrapped__", func)  # Traces the function itself, not its lugged wrapper
+    with _tracing_lock:
+        with ImportTracer() as tracer:
+            result = func(*args, **kwargs)
+    module_names = {name for name in tracer.imported_module_names if name in sys.modules}
+    module_names |= {module.__name__ for module in bytecode_dependencies(func, modules_to_skip=frozenset())}
+    write_atomically(trace_path(func), json.dumps({
+        "function": f"{func.__module__}.{func.__qualname__}",
+        "modules": sorted(module_names),
+    }).encode())
+    return result
+
+
+def traced_dependencies(func, modules_to_skip=frozenset({"pytest", "cloudpickle"})):
+    """
+    Returns the modules recorded by the function's trace, or None if it hasn't been traced. Traced modules that aren't
+    loaded yet (e.g. imported inside the function) are imported. Submodules of installed distributions are replaced by
+    their top-level module, since installing the distribution installs them.
+    """
+    try:
+        with open(trace_path(func)) as trace_file:
+            module_names = json.load(trace_file)["modules"]
+    except (OSError, ValueError, KeyError):
+        return None
+    distribution_module_names = get_package_index().module_distributions
+    modules = set()
+    for module_name in module_names:
+        top_level_name = module_name.partition(".")[0]
+        if top_level_name in distribution_module_names:
+            module_name = top_level_name
+        if not is_searchable_module(module_name, modules_to_skip):
+            continue
+        try:
+            modules.add(sys.modules.get(module_name) or importlib.import_module(module_name))
+        except ImportError:
+            continue  # e.g. a module that was removed since the function was traced
+    return modules
+
+
+def clear_traces(func=None):
+    """Removes the saved trace of a function, or of every function if none is given."""
+    if func is None:
+        shutil.rmtree(cache_directory("traces"), ignore_errors=True)
+        return
+    try:
+        os.remove(trace_path(getattr(func, "__wrapped__", func)))
+    except OSError:
+        pass
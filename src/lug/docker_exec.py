@@ -0,0 +1,274 @@
+import io
+import os
+import signal
+import subprocess
+import sys
+import threading
+import uuid
+
+# Keyword arguments that the Docker Engine API exec backend can honor. Anything else falls back to the docker CLI.
+# cwd and env also fall back, so both backends treat them the same way: they apply to the local docker CLI process,
+# not to the command in the container.
+SUPPORTED_KWARGS = frozenset({
+    "bufsize", "capture_output", "check", "close_fds", "encoding", "errors", "shell", "stderr", "stdin", "stdout",
+    "text", "universal_newlines",
+})
+
+
+def can_use_exec_api(args, kwargs):
+    if len(args) != 1 or not set(kwargs).issubset(SUPPORTED_KWARGS):
+        return False
+    # Feeding stdin requires an attached socket, which is left to the CLI
+    return kwargs.get("stdin") in (None, subprocess.DEVNULL)
+
+
+def build_exec_command(command, using_shell, docker_shell_location):
+    if using_shell:
+        if isinstance(command, (list, tuple)):
+            return [docker_shell_location, "-c"] + list(command)
+        return [docker_shell_location, "-c", command]
+    if isinstance(command, (list, tuple)):
+        return list(command)
+    return [command]
+
+
+def signalable_command(exec_command, docker_shell_location, pid_file):
+    """
+    Wraps a command so it records its PID in the container before running. The shell execs the command, so the PID is
+    the command's own, and signals sent to it behave as they would for a local child process.
+    """
+    return [docker_shell_location, "-c", 'echo $$ 2>/dev/null >"$0"; exec "$@"', pid_file] + exec_command
+
+
+def write_all(fd, data):
+    view = memoryview(data)
+    while view:
+        written = os.write(fd, view)
+        view = view[written:]
+
+
+class InheritedOutput:
+    """Writes exec output to the host's stdout or stderr, like a child process inheriting the file descriptor would."""
+    def __init__(self, stream):
+        self.stream = stream
+
+    def write(self, data):
+        try:
+            fd = self.stream.fileno()
+        except (AttributeError, io.UnsupportedOperation):
+            # e.g. notebooks and captured output replace sys.stdout with an object without a file descriptor
+            self.stream.write(data.decode(errors="replace"))
+            self.stream.flush()
+            return
+        self.stream.flush()
+        write_all(fd, data)
+
+
+class FileDescriptorOutput:
+    def __init__(self, fd):
+        self.fd = fd
+
+    def write(self, data):
+        write_all(self.fd, data)
+
+
+class DockerExecProcess:
+    """
+    A subprocess.Popen-compatible handle for a command executed through the Docker Engine API.
+
+    Output is streamed from the exec over the Docker client's pooled connection by a background thread, and written to
+    the same destinations that subprocess.Popen would use (inherited, pipes, files, or /dev/null).
+
+    With a docker_shell_location, the command records its PID in a file under /tmp in the container, so it can be sent
+    signals. The file is left in place until the container is removed.
+    """
+    def __init__(self, docker_client, container_name, args, exec_command, stdout=None, stderr=None, text=False,
+                 universal_newlines=None, encoding=None, errors=None, cwd=None, docker_shell_location=None):
+        self.args = args
+        self.stdin = None
+        self.stdout = None
+        self.stderr = None
+        self.returncode = None
+        self.pid = None
+        self.text_mode = bool(text or universal_newlines or encoding or errors)
+        self.encoding = encoding
+        self.errors = errors
+        self.pipe_write_fds = []
+        self.pump_error = None
+        self.exit_code = None
+        self.signalled = False
+        self.api = docker_client.api
+        self.container_name = container_name
+        self.docker_shell_location = docker_shell_location
+        self.pid_file = None
+        if docker_shell_location is not None:
+            self.pid_file = f"/tmp/lug-exec-{uuid.uuid4().hex}.pid"
+            exec_command = signalable_command(exec_command, docker_shell_location, self.pid_file)
+
+        self.exec_id = self.api.exec_create(
+            container_name,
+            exec_command,
+            stdout=True,
+            stderr=True,
+            stdin=False,
+            tty=False,
+            workdir=cwd,
+        )["Id"]
+        stdout_output, self.stdout = self.open_output(stdout, sys.stdout)
+        if stderr == subprocess.STDOUT:
+            stderr_output = stdout_output
+        else:
+            stderr_output, self.stderr = self.open_output(stderr, sys.stderr)
+        output_stream = self.api.exec_start(self.exec_id, stream=True, demux=True)
+        self.pump_thread = threading.Thread(
+            target=self.pump_output,
+            args=(output_stream, stdout_output, stderr_output),
+            daemon=True,
+        )
+        self.pump_thread.start()
+
+    def __repr__(self):
+        return f"<Lug DockerExecProcess: returncode: {self.returncode} args: {self.args!r}>"
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, value, traceback):
+        for pipe in (self.stdout, self.stderr):
+            if pipe is not None:
+                pipe.close()
+        self.wait()
+
+    def open_output(self, destination, inherited_stream):
+        """Returns the writer used by the output pump and, for pipes, the readable end exposed to the caller."""
+        if destination is None:
+            return InheritedOutput(inherited_stream), None
+        if destination == subprocess.DEVNULL:
+            return None, None
+        if destination == subprocess.PIPE:
+            read_fd, write_fd = os.pipe()
+            self.pipe_write_fds.append(write_fd)
+            pipe = os.fdopen(read_fd, "rb")
+            if self.text_mode:
+                pipe = io.TextIOWrapper(pipe, encoding=self.encoding, errors=self.errors)
+            return FileDescriptorOutput(write_fd), pipe
+        if isinstance(destination, int):
+            return FileDescriptorOutput(destination), None
+        return FileDescriptorOutput(destination.fileno()), None
+
+    def pump_output(self, output_stream, stdout_output, stderr_output):
+        try:
+            for stdout_chunk, stderr_chunk in output_stream:
+                if stdout_chunk and stdout_output is not None:
+                    stdout_output.write(stdout_chunk)
+                if stderr_chunk and stderr_output is not None:
+                    stderr_output.write(stderr_chunk)
+            exec_info = self.api.exec_inspect(self.exec_id)
+            self.pid = exec_info.get("Pid")
+            self.exit_code = exec_info["ExitCode"]
+        except Exception as e:
+            self.pump_error = e
+        finally:
+            for write_fd in self.pipe_write_fds:
+                os.close(write_fd)
+
+    def poll(self):
+        if self.returncode is None and not self.pump_thread.is_alive():
+            self.wait()
+        return self.returncode
+
+    def wait(self, timeout=None):
+        if self.returncode is not None:
+            return self.returncode
+        self.pump_thread.join(timeout)
+        if self.pump_thread.is_alive():
+            raise subprocess.TimeoutExpired(self.args, timeout)
+        if self.pump_error is not None:
+            raise self.pump_error
+        self.returncode = self.exit_code
+        if self.signalled and self.returncode > 128:
+            # Docker reports 128 + the signal number, where subprocess reports the negated signal number
+            self.returncode = 128 - self.returncode
+        return self.returncode
+
+    def communicate(self, input=None, timeout=None):
+        if input:
+            raise ValueError("Lug's Docker API exec backend doesn't support stdin. Use exec_backend='cli'.")
+        pipes = [pipe for pipe in (self.stdout, self.stderr) if pipe is not None]
+        results = dict()
+
+        def read_pipe(pipe):
+            results[pipe] = pipe.read()
+            pipe.close()
+
+        # Read both pipes concurrently, so a full stderr pipe can't block the pump while we wait on stdout
+        reader_threads = [threading.Thread(target=read_pipe, args=(pipe,), daemon=True) for pipe in pipes]
+        for reader_thread in reader_threads:
+            reader_thread.start()
+        for reader_thread in reader_threads:
+            reader_thread.join(timeout)
+            if reader_thread.is_alive():
+                raise subprocess.TimeoutExpired(self.args, timeout)
+        self.wait()
+        return results.get(self.stdout), results.get(self.stderr)
+
+    def send_signal(self, sig):
+        """Sends a signal to the command by running kill in the container. Does nothing if the command has exited."""
+        if self.pid_file is None:
+            raise ValueError("This command was started without a shell, so Lug can't signal it.")
+        if self.poll() is not None:
+            return
+        self.signalled = True
+        # The PID is written just before the command starts, so wait briefly in case it was only just started
+        kill_command = (
+            'for attempt in 1 2 3 4 5 6 7 8 9 10; do [ -s "$0" ] && break; sleep 0.1; done; '
+            f'kill -{int(sig)} "$(cat "$0")"'
+        )
+        kill_exec_id = self.api.exec_create(
+            self.container_name, [self.docker_shell_location, "-c", kill_command, self.pid_file],
+            stdout=False, stderr=False,
+        )["Id"]
+        self.api.exec_start(kill_exec_id)
+
+    def terminate(self):
+        self.send_signal(signal.SIGTERM)
+
+    def kill(self):
+        self.send_signal(signal.SIGKILL)
+
+
+def exec_run(docker_client, container_name, args, exec_command, check=False, capture_output=False, **kwargs):
+    """subprocess.run through the Docker Engine API."""
+    if capture_output:
+        if kwargs.get("stdout") is not None or kwargs.get("stderr") is not None:
+            raise ValueError("stdout and stderr arguments may not be used with capture_output.")
+        kwargs["stdout"] = subprocess.PIPE
+        kwargs["stderr"] = subprocess.PIPE
+    process = DockerExecProcess(docker_client, container_name, args, exec_command, **kwargs)
+    stdout, stderr = process.communicate()
+    if check and process.returncode:
+        raise subprocess.CalledProcessError(process.returncode, args, output=stdout, stderr=stderr)
+    return subprocess.CompletedProcess(args, process.returncode, stdout, stderr)
+
+
+def exec_system(docker_client, container_name, args, exec_command):
+    """os.system through the Docker Engine API. Like os.system on Unix, this returns the encoded wait status."""
+    process = DockerExecProcess(docker_client, container_name, args, exec_command)
+    return process.wait() << 8
+
+
+def exec_with_api(docker_client, container_name, original_function, args, kwargs, using_shell,
+                  docker_shell_location):
+    command = args[0]
+    exec_command = build_exec_command(command, using_shell, docker_shell_location)
+    kwargs = {key: value for key, value in kwargs.items() if key not in ("shell", "bufsize", "close_fds", "stdin")}
+    function_name = original_function.__name__
+    if function_name == "system":
+        return exec_system(docker_client, container_name, command, exec_command)
+    if function_name == "Popen":
+        # Popen handles are returned to the caller, who may signal them
+        return DockerExecProcess(docker_client, container_name, command, exec_command,
+                                 docker_shell_location=docker_shell_location, **kwargs)
+    if function_name == "sidecar_shell":
+        kwargs = {"text": True, "stdout": subprocess.PIPE, "stderr": subprocess.STDOUT, **kwargs}
+    return exec_run(docker_client, container_name, command, exec_command, **kwargs)
@@ -0,0 +1,123 @@
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import docker
+from docker.errors import ImageNotFound, APIError, DockerException
+
+
+def daemon_address(docker_client):
+    """Identifies the Docker daemon that a client talks to."""
+    # Clients for different Unix sockets share the same base URL, so they're told apart by socket path
+    socket_path = getattr(getattr(docker_client.api, "_custom_adapter", None), "socket_path", None)
+    if socket_path:
+        return f"unix://{socket_path}"
+    return docker_client.api.base_url
+
+
+class ImageIndex:
+    """
+    A per-process cache of resolved sidecar images, keyed by Docker daemon and image reference.
+
+    Once an image is resolved, later calls use the cached image without a round trip to the Docker daemon. Images can
+    be prefetched in the background, in which case resolving waits on the in-flight pull instead of starting another.
+    References pinned by digest (image@sha256:...) are only cached once the resolved image carries that digest, and
+    every pull replaces the cached image, so a tag that was re-pulled to a new digest never resolves to a stale image.
+    """
+    def __init__(self, max_concurrent_pulls=4):
+        self.max_concurrent_pulls = max_concurrent_pulls
+        self.images = dict()  # (daemon URL, image reference): docker Image
+        self.in_flight = dict()  # (daemon URL, image reference): Future
+        # Reentrant, since a prefetch's done callback runs immediately under the lock if the pull already finished
+        self.lock = threading.RLock()
+        self.executor = None
+
+    def __repr__(self):
+        return f"<Lug ImageIndex ({len(self.images)} cached, {len(self.in_flight)} pulling)>"
+
+    @staticmethod
+    def index_key(docker_client, image_name_and_tag):
+        return daemon_address(docker_client), image_name_and_tag
+
+    def is_cached(self, docker_client, image_name_and_tag):
+        """Whether the image is known to be present on the client's daemon, without a round trip to the daemon."""
+        with self.lock:
+            return self.index_key(docker_client, image_name_and_tag) in self.images
+
+    def store(self, docker_client, image_name_and_tag, image):
+        digest = image_name_and_tag.partition("@")[2]
+        if digest and not any(repo_digest.endswith(digest) for repo_digest in image.attrs.get("RepoDigests", [])):
+            return
+        with self.lock:
+            self.images[self.index_key(docker_client, image_name_and_tag)] = image
+
+    def fetch(self, docker_client, image_name_and_tag, remote=False):
+        """Gets or pulls the image from the daemon, bypassing the cache."""
+        try:
+            image = docker_client.images.get(image_name_and_tag)
+        except ImageNotFound:
+            if remote:
+                return None
+            image = docker_client.images.pull(image_name_and_tag)
+        self.store(docker_client, image_name_and_tag, image)
+        return image
+
+    def resolve(self, docker_client, image_name_and_tag, remote=False):
+        key = self.index_key(docker_client, image_name_and_tag)
+        with self.lock:
+            image = self.images.get(key)
+            in_flight_pull = self.in_flight.get(key)
+        if image is not None:
+            return image
+        if in_flight_pull is not None:
+            try:
+                return in_flight_pull.result()
+            except (APIError, DockerException):
+                pass  # Retried below, so the error is raised in the caller's thread
+        return self.fetch(docker_client, image_name_and_tag, remote=remote)
+
+    def prefetch(self, docker_client, image_names_and_tags):
+        """Starts pulling images concurrently in the background, and returns the futures of the pulls."""
+        pulls = []
+        with self.lock:
+            if self.executor is None:
+                self.executor = ThreadPoolExecutor(
+                    max_workers=self.max_concurrent_pulls,
+                    thread_name_prefix="lug-image-prefetch",
+                )
+            for image_name_and_tag in image_names_and_tags:
+                key = self.index_key(docker_client, image_name_and_tag)
+                if key in self.images:
+                    continue
+                if key not in self.in_flight:
+                    in_flight_pull = self.executor.submit(self.fetch, docker_client, image_name_and_tag)
+                    in_flight_pull.add_done_callback(lambda _, key=key: self.finish_prefetch(key))
+                    self.in_flight[key] = in_flight_pull
+                pulls.append(self.in_flight[key])
+        return pulls
+
+    def finish_prefetch(self, key):
+        with self.lock:
+            self.in_flight.pop(key, None)
+
+    def invalidate(self, image_name_and_tag=None):
+        """Drops an image reference from the cache on every daemon, or the entire cache if no reference is given."""
+        with self.lock:
+            for key in list(self.images):
+                if image_name_and_tag is None or key[1] == image_name_and_tag:
+                    del self.images[key]
+
+
+image_index = ImageIndex()
+
+
+def prefetch_images(image_names_and_tags, docker_client=None):
+    """Pulls sidecar images concurrently in the background, so the first call using them doesn't block on a pull."""
+    if isinstance(image_names_and_tags, str):
+        image_names_and_tags = [image_names_and_tags]
+    try:
+        docker_client = docker_client or docker.from_env()
+    except (APIError, DockerException):
+        raise EnvironmentError(
+            'Unable to connect to Docker. Make sure you have Docker installed and that it is currently running.'
+        )
+    return image_index.prefetch(docker_client, image_names_and_tags)
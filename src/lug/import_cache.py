@@ -0,0 +1,110 @@
+import ast
+import hashlib
+import json
+import os
+import threading
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+
+from .caching import cache_directory, write_atomically
+
+# Below this many uncached files, parsing in a process pool costs more than it saves
+MIN_FILES_FOR_PROCESS_POOL = 32
+# Bumped whenever the extracted import names change, so stale entries on disk aren't read
+IMPORTS_CACHE_FORMAT = 2
+
+_imports_by_file = dict()  # (path, mtime, size): imported module names
+_imports_by_file_lock = threading.Lock()
+
+
+def extract_imports(python_file_path):
+    """
+    Returns the names of the modules a Python file may import: the modules of each `import` statement, and the module
+    of each `from ... import` statement along with each name it imports, which may be a submodule. Relative imports
+    keep their leading dots. Only these names are kept, not the parsed AST.
+    """
+    try:
+        with open(python_file_path, "rb") as python_file:
+            parsed_ast = ast.parse(python_file.read())
+    except (SyntaxError, ValueError):
+        return []  # e.g. files written for another version of Python
+    imported_module_names = []
+    for node in ast.walk(parsed_ast):
+        if isinstance(node, ast.ImportFrom):
+            module_name = "." * node.level + (node.module or "")
+            imported_module_names.append(module_name)
+            separator = "" if module_name.endswith(".") else "."
+            imported_module_names.extend(
+                f"{module_name}{separator}{alias.name}" for alias in node.names if alias.name != "*"
+            )
+        elif isinstance(node, ast.Import):
+            imported_module_names.extend(alias.name for alias in node.names)
+    return list(dict.fromkeys(imported_module_names))
+
+
+def file_cache_key(python_file_path):
+    stat = os.stat(python_file_path)
+    return python_file_path, stat.st_mtime_ns, stat.st_size
+
+
+def disk_cache_path(cache_key):
+    digest = hashlib.sha256(json.dumps([IMPORTS_CACHE_FORMAT, *cache_key]).encode()).hexdigest()
+    return cache_directory("imports", digest[:2], f"{digest}.json")
+
+
+def load_cached_imports(cache_key):
+    try:
+        with open(disk_cache_path(cache_key)) as cache_file:
+            return json.load(cache_file)
+    except (OSError, ValueError):
+        return None
+
+
+def store_cached_imports(cache_key, imported_module_names):
+    try:
+        write_atomically(disk_cache_path(cache_key), json.dumps(imported_module_names).encode())
+    except OSError:
+        pass  # e.g. a read-only cache directory, in which case imports are only cached in memory
+
+
+def extract_imports_concurrently(python_file_paths):
+    if len(python_file_paths) < MIN_FILES_FOR_PROCESS_POOL:
+        return [extract_imports(python_file_path) for python_file_path in python_file_paths]
+    try:
+        with ProcessPoolExecutor() as executor:
+            return list(executor.map(extract_imports, python_file_paths, chunksize=16))
+    except (BrokenProcessPool, OSError):
+        # e.g. environments where processes can't be started
+        return [extract_imports(python_file_path) for python_file_path in python_file_paths]
+
+
+def get_imports_by_file(python_file_paths):
+    """
+    Returns a dict of Python file path: names of the modules it imports. Results are cached in memory and on disk per
+    file path, modification time, and size, and files that aren't cached yet are parsed in a process pool.
+    """
+    imports_by_file = dict()
+    uncached_files = dict()  # path: cache key
+    for python_file_path in python_file_paths:
+        cache_key = file_cache_key(python_file_path)
+        with _imports_by_file_lock:
+            imported_module_names = _imports_by_file.get(cache_key)
+        if imported_module_names is None:
+            imported_module_names = load_cached_imports(cache_key)
+            if imported_module_names is not None:
+                with _imports_by_file_lock:
+                    _imports_by_file[cache_key] = imported_module_names
+        if imported_module_names is None:
+            uncached_files[python_file_path] = cache_key
+        else:
+            imports_by_file[python_file_path] = imported_module_names
+
+    uncached_file_paths = list(uncached_files)
+    for python_file_path, imported_module_names in zip(
+            uncached_file_paths, extract_imports_concurrently(uncached_file_paths)):
+        cache_key = uncached_files[python_file_path]
+        store_cached_imports(cache_key, imported_module_names)
+        with _imports_by_file_lock:
+            _imports_by_file[cache_key] = imported_module_names
+        imports_by_file[python_file_path] = imported_module_names
+    return imports_by_file
@@ -1,301 +1,99 @@
-import base64
+import asyncio
+import contextvars
 import functools
-import glob
 
 from docker.errors import DockerException, APIError
-from importlib_metadata import packages_distributions, version
 import inspect
 import os
+import queue
 import shutil
 import signal
 import sys
 import threading
-import types
 import uuid
 
 import cloudpickle
 import docker
 import tempfile
-
-from .containers import DockerContainer
-from .module_detection import get_modules_to_register
-from .shell import sidecar_shell
-
-
-def patch_system_call(user_docker_container_name=None, original_function=None, pass_kwargs=True,
-                      docker_shell_location=None):
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+from .containers import DockerContainer, partitioned_resource_options, start_containers
+from .daemons import get_daemon_pool
+from .dependency_cache import dependency_cache
+from .dependency_trace import traced_dependencies
+from .docker_exec import DockerExecProcess
+from .images import prefetch_images
+from .module_detection import DEPENDENCY_MODES, get_modules_to_register
+from .payload import PAYLOAD_FILE_NAME, bootstrap_script, write_payload
+from .persistent_shell import PersistentShell
+from .pool import get_container_pool
+from .reaper import reap_container, reap_containers_now
+from .transferability import find_module_transferability
+from . import redirection
+from .redirection import Sidecar
+
+# The lug.session() that local Docker Sidecar calls are currently routed to, if any
+active_session = contextvars.ContextVar("lug_active_session", default=None)
+
+# The pip requirements already installed in each container used for in-container execution, as container ID:
+# {distribution name: requirement}, so calls that reuse a container (e.g. in a warm pool or a .map()) only install
+# what's changed
+installed_requirements = dict()
+installed_requirements_lock = threading.Lock()
+
+
+def patch_system_calls(func, user_docker_container_name, docker_shell_location, redirect_shell, docker_client=None,
+                       persistent_shell=None, image_id=None, mount=None, routes=None, docker_host=None):
     """
-    Patch os.system, subprocess.run, subprocess.Popen, and Lug sidecar_shell
-    Note: docker_shell_location refers to the shell in the *user* docker container
+    Redirect os.system, subprocess.run, subprocess.Popen, and Lug sidecar_shell to the sidecar container for calls made
+    in the current context. Commands whose executable is in `routes` are redirected to the sidecar it maps to instead.
+    Returns a token to pass to unpatch_system_calls.
     """
-
-    def run(*args, **kwargs):
-        """Lug-replaced function."""
-        docker_exec_args = [
-            "docker",
-            "exec",
-            f"{user_docker_container_name}",
-        ]
-        using_shell = kwargs.get("shell") or original_function.__name__ in ["system", "sidecar_shell"]
-        if using_shell:
-            docker_exec_args.append(docker_shell_location)
-
-        if type(args[0]) is list:
-            original_list_args = args[0]
-            docker_exec_args += original_list_args
-            return original_function(docker_exec_args, *args[1:], **kwargs)
-        else:
-            # NOTE: args[0] (the user command argument) can only be a string if using_shell is True.
-            stringified_docker_command = ' '.join(docker_exec_args)
-            user_command = args[0].replace("'", r"'\''")  # sanitizes single quotes within sh command
-            new_args = stringified_docker_command + " -c '" + user_command + "'"
-            if pass_kwargs:
-                return original_function(new_args, **kwargs)
-            return original_function(new_args)
-
-    run.is_lug_function = True
-    run.lug_original_function = original_function
-    return run
-
-
-def find_and_replace_function(member, unique_docstring, replace_with, patched_functions, depth=0, max_depth=3):
-    if depth > max_depth:
-        return
-    if type(member) in [str, type(None)]:
-        return
-    elif type(member) == dict:
-        for name, sub_attribute in member.copy().items():  # The dict can change size, so make a copy for iteration
-            if name == "__builtins__":
-                continue
-            this_one = find_and_replace_function(
-                member=sub_attribute,
-                unique_docstring=unique_docstring,
-                replace_with=replace_with,
-                patched_functions=patched_functions,
-                depth=depth + 1,
-                max_depth=max_depth,
-            )
-            if this_one:
-                patched_functions.append({
-                    "member": member,
-                    "attribute_name": name,
-                    "original_value": replace_with.lug_original_function,
-                    "is_dictionary": True,
-                })
-                member[name] = replace_with
-                return False
-    elif isinstance(member, types.ModuleType):
-        # import subprocess -> subprocess is a module
-        # import os -> os is a module
-        try:
-            members = inspect.getmembers(member)
-        # For some members, inspect.getmembers returns "TypeError: '_ClassNamespace' object is not iterable"
-        except (ModuleNotFoundError, TypeError):
-            return
-        for name, sub_member in members:
-            if name == "__builtins__":
-                continue
-            this_one = find_and_replace_function(
-                member=sub_member,
-                unique_docstring=unique_docstring,
-                replace_with=replace_with,
-                patched_functions=patched_functions,
-                depth=depth + 1,
-                max_depth=max_depth,
-            )
-            if this_one:
-                patched_functions.append({
-                    "member": member,
-                    "attribute_name": name,
-                    "original_value": getattr(member, name),
-                    "is_dictionary": False,
-                })
-                setattr(member, name, replace_with)
-                return False
-        return False
-    else:
-        try:
-            if hasattr(member, "__doc__") and member.__doc__ and unique_docstring in member.__doc__:
-                return True
-            elif isinstance(member, types.FunctionType):
-                # Explore the globals of any imported function
-                find_and_replace_function(
-                    member=member.__globals__,
-                    unique_docstring=unique_docstring,
-                    replace_with=replace_with,
-                    patched_functions=patched_functions,
-                    depth=depth + 1,
-                    max_depth=5,  # If we're exploring a function globals, increase max depth to five
-                )
-                return False
-        except (TypeError, ModuleNotFoundError):
-            return False
-        return False
-
-
-def patch_system_calls(func, user_docker_container_name, docker_shell_location, redirect_shell):
-    patched_functions = []
-
-    # Create a patched lug.sidecar_shell
-    new_sidecar_shell = patch_system_call(
-        user_docker_container_name=user_docker_container_name,
-        original_function=sidecar_shell,
+    # Referenced through the module, since context variables can't be pickled when this is sent to run remotely
+    redirection.install_dispatchers(namespace=func.__globals__)
+    return redirection.current_sidecar.set(redirection.Sidecar(
+        container_name=user_docker_container_name,
         docker_shell_location=docker_shell_location,
-    )
-    find_and_replace_function(
-        member=func.__globals__,
-        unique_docstring="This function is redirected to the Lug sidecar container.",
-        replace_with=new_sidecar_shell,
-        patched_functions=patched_functions,
-    )
-
-    if redirect_shell:
-        # Create a new subprocess.Popen
-        import subprocess
-        new_subprocess_popen = patch_system_call(
-            user_docker_container_name=user_docker_container_name,
-            original_function=subprocess.Popen,
-            docker_shell_location=docker_shell_location,
-        )
-        find_and_replace_function(
-            member=func.__globals__,
-            unique_docstring="Execute a child program in a new process.",
-            replace_with=new_subprocess_popen,
-            patched_functions=patched_functions,
-        )
-        # Create a new subprocess.run
-        new_subprocess_run = patch_system_call(
-            user_docker_container_name=user_docker_container_name,
-            original_function=subprocess.run,
-            docker_shell_location=docker_shell_location,
-        )
-        if not hasattr(subprocess.Popen, "is_lug_function"):
-            find_and_replace_function(
-                member=func.__globals__,
-                unique_docstring="Run command with arguments and return a CompletedProcess instance",
-                replace_with=new_subprocess_run,
-                patched_functions=patched_functions,
-            )
-        # Create a new os.system
-        import os
-        new_os_system = patch_system_call(
-            user_docker_container_name=user_docker_container_name,
-            original_function=os.system,
-            pass_kwargs=False,
-            docker_shell_location=docker_shell_location,
-        )
-        find_and_replace_function(
-            member=func.__globals__,
-            unique_docstring="Execute the command in a subshell",
-            replace_with=new_os_system,
-            patched_functions=patched_functions,
-        )
-
-    return patched_functions
+        redirect_shell=redirect_shell,
+        docker_client=docker_client,
+        persistent_shell=persistent_shell,
+        image_id=image_id,
+        mount=mount,
+        routes=routes,
+        docker_host=docker_host,
+    ))
 
 
-def unpatch_system_calls(patched_functions):
-    for patched_function_info in patched_functions:
-        if patched_function_info["is_dictionary"]:
-            attribute = patched_function_info["attribute_name"]
-            patched_function_info["member"][attribute] = patched_function_info["original_value"]
-        else:
-            setattr(
-                patched_function_info["member"],
-                patched_function_info["attribute_name"],
-                patched_function_info["original_value"],
-            )
+def unpatch_system_calls(redirection_token):
+    redirection.current_sidecar.reset(redirection_token)
 
 
-def can_be_pickled(module):
-    # The module must be referenced inside the function to actually test if it can be pickled
-    dummy_function_using_module = lambda x: module.__name__
-    try:
-        cloudpickle.register_pickle_by_value(module)
-        cloudpickle.dumps(dummy_function_using_module)
-        return True
-    except Exception:
-        return False
-    finally:
-        cloudpickle.unregister_pickle_by_value(module)
-
-
-def find_module_transferability(modules):
-    children_to_ignore = set()
-    copyable_packages = set()
-    uncopyable_packages = set()
-    uncopyable_pip_names = dict()  # package_name: version # todo: filter out packages that can't be installed with pip
-    packages_distribution = packages_distributions()
-    # Split pickleable and unpickleable packages
-    for module in modules:
-        if not module.__spec__:
-            continue
-
-        picklable = can_be_pickled(module)
-
-        # Find physical location of module source
-        parent = module.__spec__.name.rpartition(".")[0]
-        child = None
-        if parent:
-            child = module
-            module = sys.modules[parent]
-        submodule_search_locations = module.__spec__.submodule_search_locations
-        loader_members = inspect.getmembers(module.__spec__.loader)
-        loader_keys = [loader[0] for loader in loader_members]
-        loader_path = None
-        if "path" in loader_keys:
-            loader_path = module.__spec__.loader.path
-        # todo: handle multiple submodule search locations
-        primary_location = (submodule_search_locations and submodule_search_locations[0]) or loader_path
-
-        has_so_files = False
-        if primary_location:
-            adjusted_primary_location = os.path.dirname(primary_location) if primary_location.endswith(".py") \
-                else primary_location
-
-            # Check if the package contains any CPython compiled files (e.g. numpy, scipy, etc)
-            has_so_files = glob.glob(f"{adjusted_primary_location}/*.so") \
-                + glob.glob(f"{adjusted_primary_location}/**/*.so", recursive=True)
-            picklable = False
-
-        if not picklable:
-            try:
-                pip_names = packages_distribution[module.__name__]
-                for pip_name in pip_names:
-                    # Drop local version identifiers (e.g. "+cu117" in "torch==1.13.1+cu117")
-                    if hasattr(module, "__version__"):
-                        # Some packages, like sklearn, don't support version()
-                        public_version = module.__version__.split("+")[0]
-                    else:
-                        public_version = version(module.__name__)
-                    uncopyable_pip_names[pip_name] = public_version
-                uncopyable_packages.add(module.__name__)
-                # Make sure we know not to copy the child if present (e.g. lug and lug.run)
-                if child:
-                    uncopyable_packages.add(child.__name__)
-                    children_to_ignore.add(child)
-            except KeyError:
-                if not has_so_files:
-                    # Add to packages that need to be manually copied
-                    copyable_packages.add(primary_location)
-                    children_to_ignore.add(child)
-                else:
-                    raise ModuleNotFoundError(f"'{module.__name__}' distribution info not found on this machine.")
-            continue
-
-    # Prune copyable packages that are a subdirectory of another package
-    # I'm assuming the copyable_packages set will be tiny; optimizing for clarity rather than performance
-    for package_a in copyable_packages.copy():
-        for package_b in copyable_packages:
-            if package_a == package_b:
-                continue
-            # Assuming all absolute paths, no symlinks. If not, we should use proper parent finding.
-            is_child = package_a.startswith(package_b) and len(package_a.split(package_b)) > 1
-            if is_child:
-                copyable_packages.remove(package_a)
-                break
+def analyze_dependencies(func, dependency_mode="globals"):
+    """
+    Finds the modules that a function depends on, and how each of them can be transferred. The analysis is memoized
+    per function, and is only redone once the function, the dependency mode, or the interpreter's loaded modules and
+    packages change.
 
-    return uncopyable_packages, uncopyable_pip_names, copyable_packages, children_to_ignore
+    With dependency_mode="trace", the function must have been traced with lug.trace_dependencies() first. It isn't
+    traced automatically, since that would run it on the host, without its shell commands redirected to the sidecar.
+    """
+    fingerprint = (dependency_mode, dependency_cache.fingerprint(func))
+    analysis = dependency_cache.get(func, fingerprint)
+    if analysis is None:
+        if dependency_mode == "trace":
+            modules_to_register = traced_dependencies(func)
+            if modules_to_register is None:
+                raise ValueError(
+                    f"'{func.__qualname__}' hasn't been traced. Call lug.trace_dependencies() with the function and "
+                    f"sample arguments first, or use another dependency_mode."
+                )
+            # Loading the trace imports modules, so the fingerprint is taken again for the analysis to be reused
+            fingerprint = (dependency_mode, dependency_cache.fingerprint(func))
+        else:
+            modules_to_register = get_modules_to_register(func, dependency_mode=dependency_mode)
+        analysis = (modules_to_register, *find_module_transferability(modules_to_register))
+        dependency_cache.store(func, fingerprint, analysis)
+    return analysis
 
 
 def env_requirements_to_string(pip_packages):
@@ -306,90 +104,86 @@ def env_requirements_to_string(pip_packages):
 
 
 def create_python_script(func, args, kwargs, temp_input, user_docker, docker_shell_location, serialize_dependencies,
-                         internal_dir, redirect_shell):
+                         internal_dir, redirect_shell, function_working_dir=None, dependency_mode="globals"):
+    """
+    Writes the function, its arguments, and its dependencies to a binary payload file in `internal_dir`, and a small
+    bootstrap script that runs the payload to `temp_input`.
+    """
     output_uuid = uuid.uuid4()
+    copyable_packages = []
+    pip_packages_string = ''
+    links = []
+    internal_dir_basename = os.path.basename(internal_dir)
+    if serialize_dependencies:
+        modules_to_register, uncopyable_packages, uncopyable_pip_names, copyable_packages, children_to_ignore = \
+            analyze_dependencies(func, dependency_mode)
+        pip_packages_string = env_requirements_to_string(uncopyable_pip_names)
+        pickle_packages = set(filter(
+            lambda mod: mod.__name__ not in copyable_packages and mod.__name__ not in uncopyable_packages,
+            modules_to_register,
+        ))
+        pickle_packages -= children_to_ignore
+        for module_location_to_include in copyable_packages:
+            #  todo: handle conflicts for package directory names
+            local_path_with_internal_dir = os.path.join(
+                internal_dir_basename,
+                os.path.basename(module_location_to_include)
+            )
+            abs_path_with_internal_dir = os.path.join(internal_dir, os.path.basename(module_location_to_include))
+            if not os.path.exists(abs_path_with_internal_dir):
+                shutil.copytree(module_location_to_include, abs_path_with_internal_dir)
+            links.append((module_location_to_include, f"./input/{local_path_with_internal_dir}"))
+    elif user_docker:
+        pickle_packages = {sys.modules[__name__]}  # Ships the system call patcher
+    else:
+        pickle_packages = set()
+    config = {
+        "copyable_packages": list(copyable_packages),
+        "links": links,
+        "container_name": user_docker.container_name if user_docker else None,
+        "docker_shell_location": docker_shell_location,
+        "redirect_shell": redirect_shell,
+        "function_working_dir": function_working_dir,
+        "output_uuid": str(output_uuid),
+    }
+    for module in pickle_packages:
+        cloudpickle.register_pickle_by_value(module)
+    try:
+        write_payload(
+            os.path.join(internal_dir, PAYLOAD_FILE_NAME),
+            config=config,
+            func=func,
+            # Without a sidecar container, nothing is patched, so the payload doesn't need Lug where it runs
+            patch_system_calls=patch_system_calls if user_docker else None,
+            args=args,
+            kwargs=kwargs,
+        )
+    finally:
+        for module in pickle_packages:
+            cloudpickle.unregister_pickle_by_value(module)
     with open(temp_input.name, 'w') as fp:
-        copyable_packages = []
-        pip_packages_string = ''
-        links = []
-        if serialize_dependencies:
-            modules_to_register = get_modules_to_register(func)
-            uncopyable_packages, uncopyable_pip_names, copyable_packages, children_to_ignore = \
-                find_module_transferability(modules_to_register)
-            pip_packages_string = env_requirements_to_string(uncopyable_pip_names)
-            pickle_packages = set(filter(
-                lambda mod: mod.__name__ not in copyable_packages and mod.__name__ not in uncopyable_packages,
-                modules_to_register,
-            ))
-            pickle_packages -= children_to_ignore
-            internal_dir_basename = os.path.basename(internal_dir)
-            for module_location_to_include in copyable_packages:
-                #  todo: handle conflicts for package directory names
-                local_path_with_internal_dir = os.path.join(
-                    internal_dir_basename,
-                    os.path.basename(module_location_to_include)
-                )
-                abs_path_with_internal_dir = os.path.join(internal_dir, os.path.basename(module_location_to_include))
-                if not os.path.exists(abs_path_with_internal_dir):
-                    shutil.copytree(module_location_to_include, abs_path_with_internal_dir)
-                links.append((module_location_to_include, f"./input/{local_path_with_internal_dir}"))
-            for module in pickle_packages:
-                cloudpickle.register_pickle_by_value(module)
-        else:
-            cloudpickle.register_pickle_by_value(sys.modules[__name__])
-        pickled_func = cloudpickle.dumps(func)
-        encoded_func = base64.encodebytes(pickled_func)
-        pickled_patch = cloudpickle.dumps(patch_system_calls)
-        encoded_pickled_patch = base64.encodebytes(pickled_patch)
-        pickled_args = cloudpickle.dumps(args)
-        encoded_args = base64.encodebytes(pickled_args)
-        pickled_kwargs = cloudpickle.dumps(kwargs)
-        encoded_kwargs = base64.encodebytes(pickled_kwargs)
-        if serialize_dependencies:
-            for module in pickle_packages:
-                cloudpickle.unregister_pickle_by_value(module)
-        else:
-            cloudpickle.unregister_pickle_by_value(sys.modules[__name__])
-        container_name = user_docker.container_name if user_docker else None
-
-        fp.write("import base64\n")
-        fp.write("import cloudpickle\n")
-        fp.write("import os\n")
-        fp.write("import sys\n")
-        fp.write(f"for dir in {list(copyable_packages)}:\n")  # Make directories
-        fp.write("\tos.makedirs(os.path.dirname(dir), exist_ok=True)\n")
-        fp.write("\tsys.path.insert(0, os.path.dirname(dir))\n")
-        fp.write(f"for link in {links}:\n")  # ln all paths
-        fp.write("\tif not os.path.exists(link[0]):\n")
-        fp.write("\t\tos.symlink(os.path.join(os.getcwd(), link[1]), link[0])\n")
-        fp.write(f"func = cloudpickle.loads(base64.decodebytes({encoded_func}))\n")
-        fp.write(f"patch_system_calls = cloudpickle.loads(base64.decodebytes({encoded_pickled_patch}))\n")
-        fp.write(f"args = cloudpickle.loads(base64.decodebytes({encoded_args}))\n")
-        fp.write(f"kwargs = cloudpickle.loads(base64.decodebytes({encoded_kwargs}))\n")
-        fp.write(f"patch_system_calls(func, '{container_name}', '{docker_shell_location}', {redirect_shell})\n")
-        fp.write("result = func(*args, **kwargs)\n")
-        fp.write(f"with open(f'./output/encoded_output_{output_uuid}', 'wb') as file:\n")
-        fp.write("\tfile.write(base64.encodebytes(cloudpickle.dumps(result)))\n")
+        # The payload is shipped with the internal directory, which is an input of the run
+        fp.write(bootstrap_script(f"./input/{internal_dir_basename}/{PAYLOAD_FILE_NAME}"))
     return output_uuid, pip_packages_string
 
 
 def parse_toolchest_run(output_path, output_uuid):
-    encoded_output_path = f'{output_path}/encoded_output_{output_uuid}'
-    if os.path.exists(encoded_output_path):
-        with open(encoded_output_path, 'rb') as file:
-            encoded_result = file.read().replace(b'\n', b'')
-            if encoded_result:
-                result = cloudpickle.loads(base64.decodebytes(encoded_result))
+    output_file_path = f'{output_path}/output_{output_uuid}'
+    if os.path.exists(output_file_path):
+        with open(output_file_path, 'rb') as file:
+            pickled_result = file.read()
+            if pickled_result:
+                result = cloudpickle.loads(pickled_result)
             else:
                 result = None
-        os.remove(encoded_output_path)
+        os.remove(output_file_path)
     return result
 
 
 def execute_remote(func, args, kwargs, toolchest_key, remote_output_directory, tmp_dir, image, remote_inputs,
                    user_docker, remote_instance_type, volume_size, python_version, docker_shell_location,
                    serialize_dependencies, command_line_args, streaming_enabled, redirect_shell, provider, log_level,
-                   universal_name, universal_volume_name):
+                   universal_name, universal_volume_name, dependency_mode="globals"):
     # We're deploying Lug via Toolchest, but the user code deployed by Lug could include a different version of the
     # client. It's a late import inside this function to avoid being picked up by the Lug dependency transfer.
     import toolchest_client
@@ -412,6 +206,7 @@ def execute_remote(func, args, kwargs, toolchest_key, remote_output_directory, t
         serialize_dependencies=serialize_dependencies,
         internal_dir=lug_internal_dir,
         redirect_shell=redirect_shell,
+        dependency_mode=dependency_mode,
     )
     try:
         if toolchest_key:
@@ -460,41 +255,296 @@ def execute_remote(func, args, kwargs, toolchest_key, remote_output_directory, t
             temp_input.close()
 
 
-def execute_local(mount, client, user_docker, func, args, kwargs, docker_shell_location, redirect_shell):
+def run_to_completion(result):
+    """Runs a lugged coroutine's event loop while its sidecar is still up, in the redirected context."""
+    if inspect.iscoroutine(result):
+        return asyncio.run(result)
+    return result
+
+
+def execute_local(mount, client, user_docker, func, args, kwargs, docker_shell_location, redirect_shell,
+                  exec_backend="cli", persistent_shell=False, routed_dockers=None, docker_host=None):
     # todo: make sure the docker containers don't exit shortly after spawn, propagate errors
     mount = os.path.realpath(mount)
-    patched_functions = None
-    if user_docker:
-        # Run user container
-        user_docker.container = client.containers.run(
-            image=user_docker.image_name_and_tag,
-            volumes=[f'{mount}:/lug'],
-            detach=True,
-            stdin_open=True,
-            name=user_docker.container_name,
-            command=docker_shell_location,
-            working_dir="/lug",
+    routed_dockers = routed_dockers or dict()
+    redirection_token = None
+    shell_session = None
+    if user_docker or routed_dockers:
+        # Run user containers concurrently, except for one leased already running from a container pool
+        all_dockers = [user_docker] if user_docker else []
+        all_dockers += [routed_docker for routed_docker in routed_dockers.values() if routed_docker not in all_dockers]
+        start_containers(
+            [sidecar_docker for sidecar_docker in all_dockers if sidecar_docker.container is None],
+            mount=mount,
+            docker_shell_location=docker_shell_location,
         )
+
+        def signal_kill_handler(signum, frame):
+            reap_containers_now(all_dockers)
+
         if threading.current_thread() is threading.main_thread() and not sys.platform.startswith('win'):
             # Only supports Unix signals
-            signal.signal(signal.SIGABRT, user_docker.signal_kill_handler)
-            signal.signal(signal.SIGHUP, user_docker.signal_kill_handler)
-            signal.signal(signal.SIGSEGV, user_docker.signal_kill_handler)
-            signal.signal(signal.SIGTERM, user_docker.signal_kill_handler)
-        patched_functions = patch_system_calls(func, user_docker.container_name, docker_shell_location, redirect_shell)
+            signal.signal(signal.SIGABRT, signal_kill_handler)
+            signal.signal(signal.SIGHUP, signal_kill_handler)
+            signal.signal(signal.SIGSEGV, signal_kill_handler)
+            signal.signal(signal.SIGTERM, signal_kill_handler)
+        if exec_backend not in ("cli", "api"):
+            raise ValueError(f"Unknown exec_backend '{exec_backend}'. Use 'cli' or 'api'.")
+        if persistent_shell and user_docker:
+            # One long-lived shell for all os.system and sidecar_shell commands in this call
+            shell_session = PersistentShell(client, user_docker.container_name, docker_shell_location)
+        # The Docker Engine API backend reuses the client's keep-alive connection instead of forking the CLI
+        exec_client = client if exec_backend == "api" else None
+        routes = {
+            executable: Sidecar(
+                container_name=routed_docker.container_name,
+                docker_shell_location=docker_shell_location,
+                redirect_shell=redirect_shell,
+                docker_client=exec_client,
+                image_id=routed_docker.image_id,
+                mount=mount,
+                docker_host=docker_host,
+            )
+            for executable, routed_docker in routed_dockers.items()
+        }
+        redirection_token = patch_system_calls(
+            func=func,
+            user_docker_container_name=user_docker.container_name if user_docker else None,
+            docker_shell_location=docker_shell_location,
+            redirect_shell=redirect_shell,
+            docker_client=exec_client,
+            persistent_shell=shell_session,
+            image_id=user_docker.image_id if user_docker else None,
+            mount=mount,
+            routes=routes,
+            docker_host=docker_host,
+        )
     try:
-        result = func(*args, **kwargs)
+        result = run_to_completion(func(*args, **kwargs))
     finally:
-        if patched_functions:
-            unpatch_system_calls(patched_functions)
+        if redirection_token is not None:
+            unpatch_system_calls(redirection_token)
+        if shell_session is not None:
+            shell_session.close()
     return result
 
 
+def execute_local_in_container(mount, user_docker, func, args, kwargs, docker_shell_location,
+                               serialize_dependencies, container_python, dependency_mode="globals"):
+    """
+    Runs the whole function inside the sidecar container's Python, instead of on the host. Shell calls made by the
+    function then run natively inside the container. The script, dependencies, and result are passed through the mount.
+    """
+    mount = os.path.realpath(mount)
+    if user_docker.container is None:
+        user_docker.start(mount=mount, docker_shell_location=docker_shell_location)
+    api = user_docker.docker_client.api
+
+    def exec_in_container(command, workdir="/lug"):
+        exec_id = api.exec_create(user_docker.container_name, command, workdir=workdir)["Id"]
+        output = api.exec_start(exec_id)
+        return api.exec_inspect(exec_id)["ExitCode"], output.decode(errors="replace")
+
+    # cloudpickle only supports loading functions in the same Python version that they were pickled in
+    exit_code, container_python_version = exec_in_container([
+        container_python, "-c", "import sys; print(f'{sys.version_info.major}.{sys.version_info.minor}')",
+    ])
+    host_python_version = f"{sys.version_info.major}.{sys.version_info.minor}"
+    if exit_code != 0 or container_python_version.strip() != host_python_version:
+        raise EnvironmentError(
+            f"In-container execution requires Python {host_python_version} at '{container_python}' in the sidecar "
+            f"image, but found: {container_python_version.strip()}"
+        )
+
+    # The container sees the run directory at /lug/<run directory>, with the same input/output layout as remote runs
+    run_directory = os.path.join(mount, f".lug-{uuid.uuid4()}")
+    lug_internal_dir = os.path.join(run_directory, "input", f".lug-{uuid.uuid4()}")
+    os.makedirs(lug_internal_dir)
+    os.makedirs(os.path.join(run_directory, "output"))
+    container_run_directory = f"/lug/{os.path.basename(run_directory)}"
+    try:
+        with tempfile.NamedTemporaryFile(dir=run_directory, suffix=".py") as temp_input:
+            output_uuid, pip_packages_string = create_python_script(
+                func=func,
+                args=args,
+                kwargs=kwargs,
+                temp_input=temp_input,
+                user_docker=None,
+                docker_shell_location=docker_shell_location,
+                serialize_dependencies=serialize_dependencies,
+                internal_dir=lug_internal_dir,
+                redirect_shell=False,
+                function_working_dir="/lug",
+                dependency_mode=dependency_mode,
+            )
+            requirements = [f"cloudpickle=={cloudpickle.__version__}"] + pip_packages_string.split()
+            with installed_requirements_lock:
+                new_requirements = [
+                    requirement for requirement in requirements
+                    if requirement not in installed_requirements.get(user_docker.container.id, dict()).values()
+                ]
+            if new_requirements:
+                exit_code, pip_output = exec_in_container(
+                    [container_python, "-m", "pip", "install", "--quiet"] + new_requirements
+                )
+                if exit_code != 0:
+                    raise EnvironmentError(f"Unable to install dependencies in the sidecar container: {pip_output}")
+                with installed_requirements_lock:
+                    installed_requirements.setdefault(user_docker.container.id, dict()).update(
+                        (requirement.partition("==")[0], requirement) for requirement in new_requirements
+                    )
+            # Stream the function's output to the host, as if it was running locally
+            script_process = DockerExecProcess(
+                docker_client=user_docker.docker_client,
+                container_name=user_docker.container_name,
+                args=[container_python, os.path.basename(temp_input.name)],
+                exec_command=[container_python, os.path.basename(temp_input.name)],
+                cwd=container_run_directory,
+            )
+            if script_process.wait() != 0:
+                raise ValueError(f"In-container execution failed with exit code {script_process.returncode}.")
+        return parse_toolchest_run(os.path.join(run_directory, "output"), output_uuid)
+    finally:
+        shutil.rmtree(run_directory, ignore_errors=True)
+
+
+def iterate_futures(start_calls, yield_as_completed, cleanup):
+    """
+    Yields the results of futures in index order, or (index, result) pairs as they complete. Nothing runs until
+    iteration begins: start_calls() then starts the calls and returns their futures (a dict of future: index). Calls
+    cleanup once iteration finishes or is abandoned, so an iterator that's never used never starts anything.
+    """
+    try:
+        futures = start_calls()
+        if yield_as_completed:
+            for future in as_completed(futures):
+                yield futures[future], future.result()
+        else:
+            for future in futures:
+                yield future.result()
+    finally:
+        cleanup()
+
+
+def execute_local_map(func, items, workers, yield_as_completed, image, mount, docker_shell_location, redirect_shell,
+                      exec_backend, persistent_shell, execute_in_container, serialize_dependencies, container_python,
+                      mem_limit, shm_size, async_teardown, dependency_mode="globals"):
+    """
+    Calls a lugged function on every item concurrently, across `workers` sidecar containers from the same image. Each
+    container gets its own share of the Docker daemon's CPUs, and items are dispatched to whichever container is free.
+    Returns an iterator of the results in order, or of (index, result) pairs as calls complete. The containers are
+    only started once iteration begins.
+    """
+    try:
+        client = docker.from_env()
+    except (APIError, DockerException):
+        raise EnvironmentError(
+            'Unable to connect to Docker. Make sure you have Docker installed and that it is currently running.'
+        )
+    items = list(items)
+    workers = max(min(workers or os.cpu_count() or 1, len(items)), 1)
+    user_dockers = [
+        DockerContainer(docker_client=client, image_name_and_tag=image, resource_options=resource_options)
+        for resource_options in partitioned_resource_options(client, workers, mem_limit=mem_limit, shm_size=shm_size)
+    ]
+    executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="lug-map")
+    idle_dockers = queue.Queue()
+
+    def call_in_free_container(item):
+        user_docker = idle_dockers.get()
+        try:
+            if execute_in_container:
+                return execute_local_in_container(
+                    mount=mount,
+                    user_docker=user_docker,
+                    func=func,
+                    args=(item,),
+                    kwargs={},
+                    docker_shell_location=docker_shell_location,
+                    serialize_dependencies=serialize_dependencies,
+                    container_python=container_python,
+                    dependency_mode=dependency_mode,
+                )
+            return execute_local(
+                func=func,
+                args=(item,),
+                kwargs={},
+                mount=mount,
+                client=client,
+                user_docker=user_docker,
+                docker_shell_location=docker_shell_location,
+                redirect_shell=redirect_shell,
+                exec_backend=exec_backend,
+                persistent_shell=persistent_shell,
+            )
+        finally:
+            idle_dockers.put(user_docker)
+
+    def teardown():
+        for future in futures:
+            future.cancel()
+        executor.shutdown()
+        for user_docker in user_dockers:
+            if user_docker.container is None:
+                continue
+            if async_teardown:
+                reap_container(user_docker)
+            else:
+                user_docker.teardown()
+
+    futures = dict()
+    # Each call runs in a copy of the caller's context, with its own redirection to its container
+    context = contextvars.copy_context()
+
+    def start_calls():
+        start_containers(user_dockers, mount=os.path.realpath(mount), docker_shell_location=docker_shell_location)
+        for user_docker in user_dockers:
+            idle_dockers.put(user_docker)
+        for index, item in enumerate(items):
+            futures[executor.submit(context.copy().run, call_in_free_container, item)] = index
+        return futures
+
+    return iterate_futures(start_calls, yield_as_completed, cleanup=teardown)
+
+
+def usable_session(image, mount, execute_in_container, warm_pool, docker_hosts, exec_backend, persistent_shell):
+    """
+    Returns the open lug.session() if it can run a call to a Docker Sidecar function, otherwise None. A session only
+    runs calls for its own image and mount, and calls with options that it can't honor start their own container.
+    """
+    session = active_session.get()
+    if session is None or session.image != image or session.mount != os.path.realpath(mount):
+        return None
+    if execute_in_container or warm_pool or docker_hosts:
+        return None
+    if exec_backend != "cli" and exec_backend != session.exec_backend:
+        return None
+    if persistent_shell and not session.use_persistent_shell:
+        return None
+    return session
+
+
 def run(image=None, mount=os.getcwd(), tmp_dir=tempfile.gettempdir(), docker_shell_location="/bin/sh", remote=False,
         remote_inputs=None, remote_output_directory=None, toolchest_key=None, remote_instance_type=None,
         volume_size=None, serialize_dependencies=True, command_line_args="", streaming_enabled=True,
-        redirect_shell=True, provider="aws", log_level="INFO", universal_name=None, universal_volume_name=None):
+        redirect_shell=True, provider="aws", log_level="INFO", universal_name=None, universal_volume_name=None,
+        warm_pool=False, pool_min_size=0, pool_max_size=4, pool_idle_ttl=300, exec_backend="cli",
+        persistent_shell=False, async_teardown=True, prefetch_image=False, execute_in_container=False,
+        container_python="python3", sidecars=None, docker_hosts=None, dependency_mode="globals"):
+    sidecars = sidecars or dict()
+    if dependency_mode not in DEPENDENCY_MODES:
+        raise ValueError(f"Unknown dependency mode '{dependency_mode}', expected one of: {', '.join(DEPENDENCY_MODES)}")
+    if sidecars and (remote or execute_in_container):
+        raise ValueError("Routing commands to multiple sidecars is only supported when running locally.")
+
     def decorator_lug(func):
+        if prefetch_image and (image or sidecars) and not remote:
+            # Start pulling the sidecar images as soon as the function is decorated, instead of on the first call
+            try:
+                prefetch_images(([image] if image else []) + list(sidecars.values()))
+            except EnvironmentError:
+                pass  # Docker isn't available yet; the first call raises if that's still the case
+
         @functools.wraps(func)
         def inner(*args, **kwargs):
             # Find current Python version
@@ -503,6 +553,15 @@ def run(image=None, mount=os.getcwd(), tmp_dir=tempfile.gettempdir(), docker_she
             if python_version not in supported_versions:
                 raise ValueError(f"Python version {python_version} is not supported. PRs welcome!")
             user_docker = None
+            routed_dockers = dict()
+            container_pool = None
+            daemon_pool, daemon = None, None
+            call_failed = False
+            session = None
+            if image and not remote and not sidecars:
+                session = usable_session(
+                    image, mount, execute_in_container, warm_pool, docker_hosts, exec_backend, persistent_shell,
+                )
             try:
                 if remote:
                     user_docker = DockerContainer(
@@ -531,10 +590,24 @@ def run(image=None, mount=os.getcwd(), tmp_dir=tempfile.gettempdir(), docker_she
                         log_level=log_level,
                         universal_name=universal_name,
                         universal_volume_name=universal_volume_name,
+                        dependency_mode=dependency_mode,
+                    )
+                elif session is not None:
+                    # Reuse the open session's container, client, and patches
+                    result = session.call(
+                        func=func,
+                        args=args,
+                        kwargs=kwargs,
+                        redirect_shell=redirect_shell,
                     )
                 else:
                     client, user_docker = None, None
-                    if image:
+                    if (image or sidecars) and docker_hosts:
+                        # Run on the least loaded daemon in the pool
+                        daemon_pool = get_daemon_pool(docker_hosts)
+                        daemon = daemon_pool.acquire(image or next(iter(sidecars.values())))
+                        client = daemon.client
+                    elif image or sidecars:
                         try:
                             client = docker.from_env()
                         except (APIError, DockerException):
@@ -542,30 +615,146 @@ def run(image=None, mount=os.getcwd(), tmp_dir=tempfile.gettempdir(), docker_she
                                 'Unable to connect to Docker. Make sure you have Docker installed and that it is '
                                 'currently running.'
                             )
+                    if sidecars:
+                        # One container per image, which every executable routed to that image shares
+                        image_dockers = {
+                            sidecar_image: DockerContainer(docker_client=client, image_name_and_tag=sidecar_image)
+                            for sidecar_image in set(sidecars.values())
+                        }
+                        routed_dockers = {
+                            executable: image_dockers[sidecar_image] for executable, sidecar_image in sidecars.items()
+                        }
+                    if image and warm_pool:
+                        # Lease an already started container instead of starting a new one. The pool only resolves
+                        # the image when it has to start a container.
+                        container_pool = get_container_pool(
+                            docker_client=client,
+                            image_name_and_tag=image,
+                            mount=os.path.realpath(mount),
+                            docker_shell_location=docker_shell_location,
+                            min_size=pool_min_size,
+                            max_size=pool_max_size,
+                            idle_ttl=pool_idle_ttl,
+                        )
+                        user_docker = container_pool.lease()
+                    elif image:
                         # Get or pull the user Docker image from local/remote
                         user_docker = DockerContainer(
                             docker_client=client,
                             image_name_and_tag=image,
                         )
                         user_docker.load_image(remote=remote)
-                    result = execute_local(
-                        func=func,
-                        args=args,
-                        kwargs=kwargs,
-                        mount=mount,
-                        client=client,
-                        user_docker=user_docker,
-                        docker_shell_location=docker_shell_location,
-                        redirect_shell=image is not None and redirect_shell,
-                    )
+                    if execute_in_container:
+                        if not image:
+                            raise ValueError("execute_in_container requires a sidecar image.")
+                        result = execute_local_in_container(
+                            mount=mount,
+                            user_docker=user_docker,
+                            func=func,
+                            args=args,
+                            kwargs=kwargs,
+                            docker_shell_location=docker_shell_location,
+                            serialize_dependencies=serialize_dependencies,
+                            container_python=container_python,
+                            dependency_mode=dependency_mode,
+                        )
+                    else:
+                        result = execute_local(
+                            func=func,
+                            args=args,
+                            kwargs=kwargs,
+                            mount=mount,
+                            client=client,
+                            user_docker=user_docker,
+                            docker_shell_location=docker_shell_location,
+                            redirect_shell=(image is not None or bool(sidecars)) and redirect_shell,
+                            exec_backend=exec_backend,
+                            persistent_shell=persistent_shell,
+                            routed_dockers=routed_dockers,
+                            docker_host=daemon.docker_host if daemon is not None else None,
+                        )
+            except Exception:
+                call_failed = True
+                raise
             finally:
-                if user_docker is not None and user_docker.container is not None:
-                    user_docker.container.reload()
-                    if user_docker.container.status == "running":
-                        user_docker.container.stop()
-                    user_docker.container.remove()
+                dockers_to_teardown = list({id(routed): routed for routed in routed_dockers.values()}.values())
+                if container_pool is not None and user_docker is not None:
+                    container_pool.release(user_docker)
+                elif user_docker is not None:
+                    dockers_to_teardown.append(user_docker)
+                for docker_to_teardown in dockers_to_teardown:
+                    if docker_to_teardown.container is None:
+                        continue
+                    if async_teardown:
+                        # Hand the container to the background reaper, so cleanup isn't on the return path
+                        reap_container(docker_to_teardown)
+                    else:
+                        docker_to_teardown.teardown()
+                if daemon is not None:
+                    # A failed call may have been the daemon's fault, so it's health checked
+                    daemon_pool.release(daemon, failed=call_failed)
             return result
 
+        def map_calls(items, workers=None, yield_as_completed=False, mem_limit=None, shm_size=None):
+            """
+            Calls the function on every item concurrently. Locally, each of the `workers` calls at a time runs in its
+            own sidecar container, pinned to its own share of the CPUs and optionally limited to mem_limit memory with
+            a shm_size /dev/shm. Returns an iterator of the results in order, or of (index, result) pairs as calls
+            complete. Calls only start once iteration begins.
+            """
+            if image and not remote and not sidecars and not docker_hosts and usable_session(
+                image, mount, execute_in_container, warm_pool, docker_hosts, exec_backend, persistent_shell,
+            ) is None:
+                return execute_local_map(
+                    func=func,
+                    items=items,
+                    workers=workers,
+                    yield_as_completed=yield_as_completed,
+                    image=image,
+                    mount=mount,
+                    docker_shell_location=docker_shell_location,
+                    redirect_shell=redirect_shell,
+                    exec_backend=exec_backend,
+                    persistent_shell=persistent_shell,
+                    execute_in_container=execute_in_container,
+                    serialize_dependencies=serialize_dependencies,
+                    container_python=container_python,
+                    mem_limit=mem_limit,
+                    shm_size=shm_size,
+                    async_teardown=async_teardown,
+                    dependency_mode=dependency_mode,
+                )
+            # Other calls are fanned out over threads, e.g. to be scheduled across a Docker daemon pool
+            items = list(items)
+            executor = ThreadPoolExecutor(max_workers=max(min(workers or os.cpu_count() or 1, len(items)), 1))
+            futures = dict()
+            context = contextvars.copy_context()
+
+            def start_calls():
+                for index, item in enumerate(items):
+                    futures[executor.submit(context.copy().run, inner, item)] = index
+                return futures
+
+            def cleanup():
+                for future in futures:
+                    future.cancel()
+                executor.shutdown()
+
+            return iterate_futures(start_calls, yield_as_completed, cleanup=cleanup)
+
+        inner.map = map_calls
+
+        if inspect.iscoroutinefunction(func):
+            @functools.wraps(func)
+            async def async_inner(*args, **kwargs):
+                # Container setup and teardown block, so the call runs in a worker thread with its own event loop
+                context = contextvars.copy_context()
+                return await asyncio.get_running_loop().run_in_executor(
+                    None, context.run, functools.partial(inner, *args, **kwargs)
+                )
+            async_inner.map = map_calls
+            return async_inner
+
         return inner
 
     return decorator_lug
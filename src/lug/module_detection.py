@@ -1,154 +1,289 @@
-import ast
 import glob
+import importlib.util
 import inspect
+import os
 import sys
+import threading
 import types
-import os
 
 from .constants import STDLIB_MODULE_NAMES
+from .import_cache import get_imports_by_file
+from .package_index import get_package_index
+
+# "globals" searches everything a function's module references, "bytecode" only what the function's code uses, and
+# "trace" uses the modules recorded while running the function (see dependency_trace.py)
+DEPENDENCY_MODES = ("globals", "bytecode", "trace")
 
 
-def parse_ast_for_file(python_file_path):
-    opened_file = open(python_file_path).read()
-    parsed_ast = ast.parse(opened_file)
-    return [node for node in ast.walk(parsed_ast)]
+def is_searchable_module(module_name, modules_to_skip):
+    """Stdlib, builtin, and skipped modules are never registered, along with their submodules."""
+    top_level_name = module_name.partition(".")[0]
+    return not (
+        top_level_name in sys.builtin_module_names
+        or top_level_name in STDLIB_MODULE_NAMES
+        or top_level_name in modules_to_skip
+        or module_name in modules_to_skip
+    )
 
 
-def get_registered_module_imports(modules_to_register, modules_to_skip):
+def namespace_edges(namespace):
+    """
+    Returns the names of the modules in a namespace, and the names of the modules that define the functions and
+    classes in it.
     """
-    Perform a deep search for module dependencies, by parsing the AST and looking for all imports.
+    referenced_module_names = set()
+    defining_module_names = set()
+    for value in list(namespace.values()):
+        if isinstance(value, types.ModuleType):
+            referenced_module_names.add(value.__name__)
+        elif isinstance(value, (types.FunctionType, type)):
+            defining_module_name = getattr(value, "__module__", None)
+            if isinstance(defining_module_name, str):
+                defining_module_names.add(defining_module_name)
+    return referenced_module_names, defining_module_names
 
-    All imports in the module are parsed, even if they aren't used. Practically, this means we're catching
-    more dependencies than needed within a module.
 
-    Modules that this function finds are not searched for _their_ dependencies. For a truly deep search, this would need
-    to be modified to search through found modules and their dependencies.
+def module_python_files(module):
+    """
+    Returns the Python files searched for a module's imports, as {file: package its relative imports resolve against}.
+    For a package, these are the files in its directory and one level of subdirectories, as subpackages aren't always
+    imported by the package itself. For any other module, this is just the module's file.
+    """
+    module_path = getattr(module, "__path__", None)
+    if module_path:
+        python_files = dict()
+        for path in module_path:
+            for python_file in glob.glob(os.path.join(path, "*.py")):
+                python_files[python_file] = module.__name__
+            for python_file in glob.glob(os.path.join(path, "*", "*.py")):
+                subdirectory = os.path.basename(os.path.dirname(python_file))
+                python_files[python_file] = f"{module.__name__}.{subdirectory}"
+        return python_files
+    module_file = getattr(module, "__file__", None)
+    if module_file and module_file.endswith(".py"):
+        return {module_file: module.__name__.rpartition(".")[0]}
+    return dict()
+
+
+def resolve_import(imported_module_name, package):
+    """Resolves a relative import against the package it's imported from. Returns None if it can't be resolved."""
+    if not imported_module_name.startswith("."):
+        return imported_module_name
+    if not package:
+        return None
+    try:
+        return importlib.util.resolve_name(imported_module_name, package)
+    except (ImportError, ValueError):
+        return None
 
-    Only modules that are already loaded within `sys.modules` of the Lugged function are registered for pickling.
+
+class ModuleGraph:
     """
-    # Find all sys level registered modules that aren't builtins
-    filtered_sys_modules = []
-    for module_name, module_value in sys.modules.items():
-        is_builtin_module = module_name in sys.builtin_module_names
-        is_stdlib_module = module_name in STDLIB_MODULE_NAMES
-        if not (is_builtin_module or is_stdlib_module):
-            filtered_sys_modules.append(module_name)
-
-    # Find all imported modules within dependencies
-    deep_modules = set()
-    for module in modules_to_register:
-        all_ast_nodes = []
-
-        # Some modules are single-file modules, or otherwise don't have a root directory
-        if not hasattr(module, "__path__"):
-            # We're not supporting modules that have neither a directory or file at their root
-            if not hasattr(module, "__file__"):
-                continue
-            # If the module only has one file, we only need to parse that file
-            all_ast_nodes = parse_ast_for_file(
-                python_file_path=getattr(module, "__file__")
+    A graph of the dependencies between loaded modules, built incrementally and shared by every lugged function.
+
+    A module's edges point to the modules in its namespace, to the modules that define the functions and classes in
+    its namespace, and, for deep searches, to the modules imported anywhere in its source files. Each module's edges
+    are found the first time a search reaches it, and are reused by later searches until the module is reloaded or
+    (for namespace edges) its namespace changes size.
+    """
+    def __init__(self):
+        self.namespace_edges = dict()  # module name: (spec, namespace size, referenced names, defining names)
+        self.import_edges = dict()  # module name: (spec, imported module names)
+        self.lock = threading.Lock()
+
+    def __repr__(self):
+        return f"<Lug ModuleGraph ({len(self.namespace_edges)} modules)>"
+
+    def get_namespace_edges(self, module):
+        namespace = module.__dict__
+        with self.lock:
+            entry = self.namespace_edges.get(module.__name__)
+        if entry is not None and entry[0] is module.__spec__ and entry[1] == len(namespace):
+            return entry[2], entry[3]
+        referenced_module_names, defining_module_names = namespace_edges(namespace)
+        with self.lock:
+            self.namespace_edges[module.__name__] = (
+                module.__spec__, len(namespace), referenced_module_names, defining_module_names
             )
-        else:
-            # If the module has a directory root, we'll need to parse all .py files in the directory
-            module_path = getattr(module, "__path__")
-            if len(module_path) == 1:  # Most packaged modules have a source directory
-                python_files = glob.glob(os.path.join(module_path[0], "**.py"))
-                python_files += glob.glob(os.path.join(module_path[0], "**/*.py"))
-            elif len(module_path) == 0:
-                module_file = getattr(module, "__file__")
-                python_files = [module_file]
+        return referenced_module_names, defining_module_names
+
+    def get_import_edges(self, modules):
+        """Returns a dict of module name: imported module names, parsing the source files of all modules at once."""
+        import_edges = dict()
+        python_files_by_module = dict()
+        for module in modules:
+            with self.lock:
+                entry = self.import_edges.get(module.__name__)
+            if entry is not None and entry[0] is module.__spec__:
+                import_edges[module.__name__] = entry[1]
             else:
-                raise ValueError("Lug requires source code to get dependencies from module: ", module)
-
-            for python_file_path in python_files:
-                all_ast_nodes += parse_ast_for_file(python_file_path)
-
-        # Now that we have the AST for all Python files in the module, we need to find the imports
-        # There are two types of imports: direct imports and renamed imports. E.g.:
-        # Direct import: import subprocess
-        # Renamed import from subprocess import run
-        ast_direct_imports = []
-        ast_renamed_imports = []
-        for node in all_ast_nodes:
-            if isinstance(node, ast.Import):
-                ast_direct_imports.append(node)
-            if isinstance(node, ast.ImportFrom):
-                ast_renamed_imports.append(node)
-
-        # Both types of imports have different structures.
-        # They're parsed differently, but added to the same list of imports once we find the module name.
-        for renamed_import in ast_renamed_imports:
-            module_name = renamed_import.module
-            if module_name in filtered_sys_modules and module_name not in modules_to_skip:
-                if "_pytest" in module.__name__:
+                python_files_by_module[module] = module_python_files(module)
+
+        # Imports are extracted for all files at once, so uncached files can be parsed in parallel
+        imports_by_file = get_imports_by_file(list(dict.fromkeys(
+            python_file for python_files in python_files_by_module.values() for python_file in python_files
+        )))
+
+        for module, python_files in python_files_by_module.items():
+            imported_module_names = set()
+            for python_file, package in python_files.items():
+                for imported_module_name in imports_by_file[python_file]:
+                    imported_module_name = resolve_import(imported_module_name, package)
+                    if imported_module_name is not None:
+                        imported_module_names.add(imported_module_name)
+            with self.lock:
+                self.import_edges[module.__name__] = (module.__spec__, imported_module_names)
+            import_edges[module.__name__] = imported_module_names
+        return import_edges
+
+    def dependencies(self, func, deep=False, modules_to_skip=frozenset()):
+        """
+        Returns the transitive closure of the modules a function depends on, excluding stdlib, builtin, and skipped
+        modules. Only modules that are already loaded in `sys.modules` are returned.
+
+        Modules in the function's globals are registered, and the modules that define the functions and classes it
+        references are searched for their own dependencies, as are theirs, and so on. Modules provided by an installed
+        distribution are registered but not searched, since installing the distribution installs its dependencies.
+
+        A deep search also searches every registered module, following the imports in its source files as well. All
+        imports in the source files are followed, even if they aren't used, so deep searches over-approximate.
+        """
+        referenced_module_names, defining_module_names = namespace_edges(func.__globals__)
+        function_module = inspect.getmodule(func)
+        if function_module is not None:
+            defining_module_names.add(function_module.__name__)
+        distribution_module_names = get_package_index().module_distributions
+
+        registered_modules = dict()  # module name: module
+        searched_module_names = set()
+        frontier = [(module_name, False) for module_name in referenced_module_names]
+        frontier += [(module_name, True) for module_name in defining_module_names]
+        while frontier:
+            modules_to_search = []
+            for module_name, search in frontier:
+                module = sys.modules.get(module_name)
+                if module is None or not is_searchable_module(module_name, modules_to_skip):
                     continue
-                deep_modules.add(sys.modules[module_name])
-        for direct_import in ast_direct_imports:
-            module_name = direct_import.names[0].name
-            if module_name in filtered_sys_modules and module_name not in modules_to_skip:
-                if "_pytest" in module.__name__:
+                registered_modules[module_name] = module
+                if module_name in searched_module_names or not (search or deep):
                     continue
-                deep_modules.add(sys.modules[module_name])
-    return deep_modules
-
-
-def search_for_modules_to_register(member, modules_to_register, discovered_module_names, depth=0):
-    """Recursively search for modules to register."""
-    if depth > 3:
-        return
-    is_module = isinstance(member, types.ModuleType)
-    is_function = isinstance(member, types.FunctionType)
-    if is_function:
-        for global_var in member.__globals__.values():
-            search_for_modules_to_register(
-                member=global_var,
-                modules_to_register=modules_to_register,
-                discovered_module_names=discovered_module_names,
-                depth=depth + 1
-            )
-        function_parent_module = inspect.getmodule(member)
-        search_for_modules_to_register(
-            member=function_parent_module,
-            modules_to_register=modules_to_register,
-            discovered_module_names=discovered_module_names,
-            depth=depth + 1
-        )
-    elif is_module:
-        module_name = getattr(member, "__name__")
-        if module_name in discovered_module_names:
-            return
-        else:
-            discovered_module_names.add(module_name)
-        is_builtin_module = module_name in sys.builtin_module_names
-        is_stdlib_module = module_name in STDLIB_MODULE_NAMES
-        if not is_builtin_module and not is_stdlib_module:
-            modules_to_register.append(member)
-        if hasattr(member, "__globals__"):
-            for global_var in member.__globals__.values():
-                search_for_modules_to_register(
-                    member=global_var,
-                    modules_to_register=modules_to_register,
-                    discovered_module_names=discovered_module_names,
-                    depth=depth + 1,
-                )
+                # Pytest rewrites test modules to reference its internals, which are registered but not searched
+                if module_name.startswith("_pytest"):
+                    continue
+                if not deep and module_name.partition(".")[0] in distribution_module_names:
+                    continue
+                searched_module_names.add(module_name)
+                modules_to_search.append(module)
+
+            frontier = []
+            import_edges = self.get_import_edges(modules_to_search) if deep else dict()
+            for module in modules_to_search:
+                referenced_module_names, defining_module_names = self.get_namespace_edges(module)
+                frontier += [(module_name, False) for module_name in referenced_module_names]
+                frontier += [(module_name, True) for module_name in defining_module_names]
+                frontier += [(module_name, True) for module_name in import_edges.get(module.__name__, ())]
+        return set(registered_modules.values())
+
+    def clear(self):
+        with self.lock:
+            self.namespace_edges.clear()
+            self.import_edges.clear()
+
+
+module_graph = ModuleGraph()
+
+
+def code_names(code):
+    """The global and attribute names used by a code object and the code objects nested in it (e.g. lambdas)."""
+    names = set(code.co_names)
+    for constant in code.co_consts:
+        if isinstance(constant, types.CodeType):
+            names |= code_names(constant)
+    return names
+
+
+def class_members(cls):
+    """The base classes of a class, and the functions of its methods, static methods, class methods, and properties."""
+    members = list(cls.__bases__)
+    for attribute in vars(cls).values():
+        if isinstance(attribute, (staticmethod, classmethod)):
+            members.append(attribute.__func__)
+        elif isinstance(attribute, property):
+            members += [accessor for accessor in (attribute.fget, attribute.fset, attribute.fdel) if accessor]
+        elif isinstance(attribute, types.FunctionType):
+            members.append(attribute)
+    return members
+
+
+def bytecode_dependencies(func, modules_to_skip=frozenset()):
+    """
+    Returns the modules a function depends on, found from the names its bytecode actually uses instead of everything
+    in its globals. Only modules that are already loaded in `sys.modules` are returned.
+
+    The `co_names` of the function's code and nested code objects are looked up in its globals, along with its closure
+    and defaults. Modules found are registered, along with their submodules, functions, and classes that the code uses
+    as attributes. Functions and classes are registered by their defining module and analyzed the same way, as are
+    the methods and base classes of classes, and the classes of other objects. Like regular searches, functions and
+    classes of installed distributions are registered but not analyzed.
+    """
+    distribution_module_names = get_package_index().module_distributions
+    registered_modules = dict()  # module name: module
+    analyzed_ids = set()
+    # (module name, attribute names) for each module whose attributes were expanded with those names, so modules that
+    # reference each other (e.g. a package and a submodule that imports it) are only expanded once
+    expanded_modules = set()
+    pending = [(func, None)]  # (value, names used as attributes of the value if it's a module)
+    while pending:
+        value, attribute_names = pending.pop()
+        if isinstance(value, types.ModuleType):
+            if not is_searchable_module(value.__name__, modules_to_skip):
+                continue
+            registered_modules[value.__name__] = value
+            if (value.__name__, attribute_names) in expanded_modules:
+                continue
+            expanded_modules.add((value.__name__, attribute_names))
+            for name in attribute_names or ():
+                attribute = getattr(value, name, None)
+                if isinstance(attribute, (types.ModuleType, types.FunctionType, type)):
+                    pending.append((attribute, attribute_names))
+            continue
+        if id(value) in analyzed_ids:
+            continue
+        analyzed_ids.add(id(value))
+        if isinstance(value, types.MethodType):
+            pending.append((value.__func__, None))
+            continue
+        if not isinstance(value, (types.FunctionType, type)):
+            pending.append((type(value), None))
+            continue
+
+        module = sys.modules.get(getattr(value, "__module__", None) or "")
+        if module is None or not is_searchable_module(module.__name__, modules_to_skip):
+            continue
+        registered_modules[module.__name__] = module
+        if module.__name__.startswith("_pytest") or module.__name__.partition(".")[0] in distribution_module_names:
+            continue
+        if isinstance(value, type):
+            pending += [(member, None) for member in class_members(value)]
+            continue
+        names = frozenset(code_names(value.__code__))
+        pending += [(value.__globals__[name], names) for name in names if name in value.__globals__]
+        for cell in value.__closure__ or ():
+            try:
+                pending.append((cell.cell_contents, names))
+            except ValueError:
+                pass  # An empty cell, e.g. a closure variable that's assigned later
+        pending += [(default, None) for default in value.__defaults__ or ()]
+        pending += [(default, None) for default in (value.__kwdefaults__ or dict()).values()]
+    return set(registered_modules.values())
 
 
 def get_modules_to_register(
         func,
         deep=False,
-        modules_to_skip=frozenset({"pytest", "cloudpickle"})
+        modules_to_skip=frozenset({"pytest", "cloudpickle"}),
+        dependency_mode="globals",
 ):
-    modules_to_register = []
-    search_for_modules_to_register(
-        member=func,
-        modules_to_register=modules_to_register,
-        discovered_module_names=set(modules_to_skip),  # Skips unpicklable internal modules
-    )
-    deduplicated_modules_to_register = set(modules_to_register)
-    if not deep:
-        return deduplicated_modules_to_register
-    additional_modules = get_registered_module_imports(
-        deduplicated_modules_to_register,
-        modules_to_skip=modules_to_skip,
-    )
-    return deduplicated_modules_to_register.union(additional_modules)
+    if dependency_mode == "bytecode":
+        return bytecode_dependencies(func, modules_to_skip=modules_to_skip)
+    return module_graph.dependencies(func, deep=deep, modules_to_skip=modules_to_skip)
@@ -0,0 +1,185 @@
+import hashlib
+import json
+import os
+import sys
+import threading
+import time
+
+from importlib_metadata import distributions, packages_distributions
+
+from .caching import cache_directory, write_atomically
+
+NATIVE_EXTENSION_SUFFIXES = (".so", ".pyd", ".dylib")
+STALE_INDEX_AGE = 7 * 24 * 60 * 60  # Seconds
+# Directory walks for native extensions give up (and report none) after this many entries
+MAX_SCANNED_ENTRIES = 50000
+SKIPPED_DIRECTORY_NAMES = frozenset({"__pycache__", ".git", ".hg", ".svn", ".tox", ".venv", "node_modules"})
+
+_package_index = None  # (fingerprint, PackageIndex) of the most recently loaded index
+_package_index_lock = threading.Lock()
+_scanned_paths = dict()  # (path, mtime): whether the path contains native extensions
+
+
+def is_native_extension(file_name):
+    # Also matches versioned shared libraries vendored by wheels, like libopenblas.so.0
+    return file_name.endswith(NATIVE_EXTENSION_SUFFIXES) or ".so." in file_name
+
+
+def scan_for_native_extensions(path, max_entries=MAX_SCANNED_ENTRIES):
+    """Walks a directory until the first native extension is found. The result is cached per path."""
+    try:
+        cache_key = (path, os.stat(path).st_mtime_ns)
+    except OSError:
+        return False
+    has_native_extensions = _scanned_paths.get(cache_key)
+    if has_native_extensions is not None:
+        return has_native_extensions
+    has_native_extensions = False
+    num_entries = 0
+    directories = [path]
+    while directories and not has_native_extensions and num_entries < max_entries:
+        try:
+            entries = os.scandir(directories.pop())
+        except OSError:
+            continue
+        with entries:
+            for entry in entries:
+                num_entries += 1
+                try:
+                    if entry.is_dir(follow_symlinks=False):
+                        if entry.name not in SKIPPED_DIRECTORY_NAMES:
+                            directories.append(entry.path)
+                    elif is_native_extension(entry.name):
+                        has_native_extensions = True
+                        break
+                except OSError:
+                    continue
+    _scanned_paths[cache_key] = has_native_extensions
+    return has_native_extensions
+
+
+def site_packages_fingerprint():
+    """
+    Fingerprints the installed distributions on the import path, by the names and modification times of their
+    metadata directories. Installing, upgrading, or removing a distribution changes the fingerprint.
+    """
+    digest = hashlib.sha256(sys.executable.encode())
+    for path in sys.path:
+        try:
+            entries = sorted(os.scandir(path or "."), key=lambda entry: entry.name)
+        except OSError:
+            continue
+        digest.update(f"\0{path}".encode())
+        for entry in entries:
+            if entry.name.endswith((".dist-info", ".egg-info")):
+                try:
+                    digest.update(f"\0{entry.name}:{entry.stat().st_mtime_ns}".encode())
+                except OSError:
+                    pass
+    return digest.hexdigest()
+
+
+class PackageIndex:
+    """
+    Maps top-level modules to the distributions that provide them, and distributions to their versions and whether
+    they include native extensions (None if the distribution doesn't list its files).
+    """
+    def __init__(self, module_distributions, distribution_versions, native_distributions):
+        self.module_distributions = module_distributions
+        self.distribution_versions = distribution_versions
+        self.native_distributions = native_distributions
+
+    def __repr__(self):
+        return f"<Lug PackageIndex ({len(self.distribution_versions)} distributions)>"
+
+    @classmethod
+    def build(cls):
+        distribution_versions = dict()
+        native_distributions = dict()
+        for distribution in distributions():
+            name = distribution.metadata["Name"]
+            # Like imports, the first distribution with a name on the import path wins
+            if name is None or name in distribution_versions:
+                continue
+            distribution_versions[name] = distribution.version
+            files = distribution.files
+            native_distributions[name] = None if files is None else any(
+                is_native_extension(file.name) for file in files
+            )
+        return cls(packages_distributions(), distribution_versions, native_distributions)
+
+    def to_json(self):
+        return json.dumps({
+            "modules": self.module_distributions,
+            "versions": self.distribution_versions,
+            "native": self.native_distributions,
+        })
+
+    @classmethod
+    def from_json(cls, serialized_index):
+        index = json.loads(serialized_index)
+        return cls(index["modules"], index["versions"], index["native"])
+
+    def distributions(self, module_name):
+        """Returns the names of the distributions that provide a top-level module. Raises KeyError if there are none."""
+        return self.module_distributions[module_name]
+
+    def version(self, distribution_name):
+        return self.distribution_versions[distribution_name]
+
+    def has_native_extensions(self, distribution_name):
+        return self.native_distributions.get(distribution_name)
+
+    def module_has_native_extensions(self, module_name, location):
+        """
+        Whether a top-level module includes native extensions (.so, .pyd, or .dylib files). Installed distributions are
+        checked by the files listed in their RECORD, and anything else by walking the module's directory.
+        """
+        native_flags = [
+            self.has_native_extensions(distribution_name)
+            for distribution_name in self.module_distributions.get(module_name, [])
+        ]
+        if native_flags and None not in native_flags:
+            return any(native_flags)
+        return scan_for_native_extensions(location)
+
+
+def prune_stale_indexes(index_directory, current_index_path):
+    now = time.time()
+    try:
+        index_entries = list(os.scandir(index_directory))
+    except OSError:
+        return
+    for entry in index_entries:
+        try:
+            if entry.path != current_index_path and now - entry.stat().st_mtime > STALE_INDEX_AGE:
+                os.remove(entry.path)
+        except OSError:
+            pass
+
+
+def get_package_index():
+    """
+    Returns the package index for the current environment. The index is persisted in Lug's cache directory, so it's
+    shared by every process using the same environment, and is rebuilt once the installed distributions change.
+    """
+    global _package_index
+    fingerprint = site_packages_fingerprint()
+    with _package_index_lock:
+        if _package_index is not None and _package_index[0] == fingerprint:
+            return _package_index[1]
+    index_directory = cache_directory("package-index")
+    index_path = os.path.join(index_directory, f"{fingerprint}.json")
+    try:
+        with open(index_path) as index_file:
+            index = PackageIndex.from_json(index_file.read())
+    except (OSError, ValueError, KeyError):
+        index = PackageIndex.build()
+        try:
+            write_atomically(index_path, index.to_json().encode())
+            prune_stale_indexes(index_directory, index_path)
+        except OSError:
+            pass  # e.g. a read-only home directory, in which case the index is only kept in memory
+    with _package_index_lock:
+        _package_index = (fingerprint, index)
+    return index
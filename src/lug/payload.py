@@ -0,0 +1,167 @@
+import contextvars
+import functools
+import json
+import os
+import pickle
+import struct
+import threading
+
+import cloudpickle
+
+from .dependency_cache import DependencyCache
+from .images import ImageIndex
+from .module_detection import ModuleGraph
+from .reaper import ContainerReaper
+from .result_cache import ResultCache
+
+# A payload is a header (magic, format version, and section count) followed by length-prefixed sections: a JSON config,
+# the pickled function, system call patcher, args, and kwargs, then a JSON list of each pickle's out-of-band buffers
+PAYLOAD_MAGIC = b"LUGPAYLD"
+PAYLOAD_FORMAT_VERSION = 2
+PAYLOAD_HEADER = struct.Struct("<8sHH")
+SECTION_LENGTH = struct.Struct("<Q")
+PAYLOAD_FILE_NAME = "payload.lug"
+# Contiguous buffers at least this large (e.g. NumPy arrays) are pickled out-of-band, into their own files
+MIN_OUT_OF_BAND_BUFFER_SIZE = 1024 ** 2
+
+# Runs a payload on the remote side. Only the payload path is filled in, so the script stays tiny no matter how large
+# the arguments are. The payload is memory-mapped, and sections are unpickled straight from the mapping. Out-of-band
+# buffers are memory-mapped copy-on-write, so arrays are rebuilt on top of their files without reading them in.
+BOOTSTRAP_SCRIPT = """import asyncio
+import cloudpickle
+import inspect
+import json
+import mmap
+import os
+import struct
+import sys
+output_dir = os.path.join(os.getcwd(), 'output')
+with open({payload_path!r}, 'rb') as payload_file:
+    payload = mmap.mmap(payload_file.fileno(), 0, access=mmap.ACCESS_READ)
+magic, version, section_count = struct.unpack_from('<8sHH', payload, 0)
+if magic != {magic!r} or version != {version!r}:
+    raise ValueError('Unsupported Lug payload. The same version of Lug must write and run it.')
+sections = []
+offset = struct.calcsize('<8sHH')
+for _ in range(section_count):
+    (length,) = struct.unpack_from('<Q', payload, offset)
+    offset += struct.calcsize('<Q')
+    sections.append(memoryview(payload)[offset:offset + length])
+    offset += length
+config = json.loads(bytes(sections[0]))
+payload_directory = os.path.dirname({payload_path!r})
+
+
+def load_buffer(buffer_name):
+    with open(os.path.join(payload_directory, buffer_name), 'rb') as buffer_file:
+        if os.fstat(buffer_file.fileno()).st_size == 0:
+            return bytearray()
+        return mmap.mmap(buffer_file.fileno(), 0, access=mmap.ACCESS_COPY)
+
+
+buffer_names = json.loads(bytes(sections[5]))
+for dir in config['copyable_packages']:
+    os.makedirs(os.path.dirname(dir), exist_ok=True)
+    sys.path.insert(0, os.path.dirname(dir))
+for link in config['links']:
+    if not os.path.exists(link[0]):
+        os.symlink(os.path.join(os.getcwd(), link[1]), link[0])
+func, patch_system_calls, args, kwargs = (
+    cloudpickle.loads(section, buffers=[load_buffer(buffer_name) for buffer_name in section_buffer_names])
+    for section, section_buffer_names in zip(sections[1:5], buffer_names)
+)
+if config['container_name']:
+    # Without a sidecar container, shell calls run natively where the script runs
+    patch_system_calls(func, config['container_name'], config['docker_shell_location'], config['redirect_shell'])
+if config['function_working_dir']:
+    os.chdir(config['function_working_dir'])
+result = func(*args, **kwargs)
+if inspect.iscoroutine(result):
+    result = asyncio.run(result)
+with open(os.path.join(output_dir, 'output_' + config['output_uuid']), 'wb') as file:
+    cloudpickle.dump(result, file)
+"""
+
+
+class PayloadPickler(cloudpickle.CloudPickler):
+    """
+    When Lug is shipped with a function, its modules are pickled by value, along with their process-wide state. That
+    state is pickled as new objects instead: context variables with their default and no value, unlocked locks, empty
+    caches and reapers, and structs from their format.
+    """
+    lock_factories = {type(threading.Lock()): threading.Lock, type(threading.RLock()): threading.RLock}
+    process_local_types = (ContainerReaper, DependencyCache, ImageIndex, ModuleGraph, ResultCache)
+
+    def reducer_override(self, obj):
+        if isinstance(obj, contextvars.ContextVar):
+            try:
+                default = contextvars.Context().run(obj.get)
+            except LookupError:
+                return contextvars.ContextVar, (obj.name,)
+            return functools.partial(contextvars.ContextVar, obj.name, default=default), ()
+        lock_factory = self.lock_factories.get(type(obj))
+        if lock_factory is not None:
+            return lock_factory, ()
+        if type(obj) in self.process_local_types:
+            return type(obj), ()
+        if isinstance(obj, struct.Struct):
+            return struct.Struct, (obj.format,)
+        return super().reducer_override(obj)
+
+
+def write_section(payload_file, write_content):
+    """Writes a length-prefixed section. The content is streamed to the file, and its length is filled in after."""
+    length_offset = payload_file.tell()
+    payload_file.write(SECTION_LENGTH.pack(0))
+    write_content(payload_file)
+    end_offset = payload_file.tell()
+    payload_file.seek(length_offset)
+    payload_file.write(SECTION_LENGTH.pack(end_offset - length_offset - SECTION_LENGTH.size))
+    payload_file.seek(end_offset)
+
+
+class OutOfBandBufferWriter:
+    """
+    A pickle protocol 5 buffer_callback that writes large contiguous buffers straight to their own files as they're
+    pickled, so they're never copied into the pickle. Smaller and non-contiguous buffers stay in-band.
+    """
+    def __init__(self, directory):
+        self.directory = directory
+        self.buffer_names = []
+
+    def __call__(self, pickle_buffer):
+        try:
+            raw_buffer = pickle_buffer.raw()
+        except BufferError:
+            return True  # Not contiguous
+        if raw_buffer.nbytes < MIN_OUT_OF_BAND_BUFFER_SIZE:
+            return True
+        buffer_name = f"buffer_{len(self.buffer_names)}"
+        with open(os.path.join(self.directory, buffer_name), "wb") as buffer_file:
+            buffer_file.write(raw_buffer)
+        self.buffer_names.append(buffer_name)
+        return False
+
+
+def write_payload(payload_path, config, func, patch_system_calls, args, kwargs):
+    """
+    Writes a payload file. Objects are pickled straight into the file, and their large buffers into files next to it,
+    so they're never held in memory as bytes, base64, or source code.
+    """
+    objects = (func, patch_system_calls, args, kwargs)
+    buffer_writer = OutOfBandBufferWriter(os.path.dirname(payload_path))
+    buffer_names = []
+    with open(payload_path, "wb") as payload_file:
+        payload_file.write(PAYLOAD_HEADER.pack(PAYLOAD_MAGIC, PAYLOAD_FORMAT_VERSION, 2 + len(objects)))
+        write_section(payload_file, lambda section_file: section_file.write(json.dumps(config).encode()))
+        for pickled_object in objects:
+            buffer_count = len(buffer_writer.buffer_names)
+            write_section(payload_file, lambda section_file: PayloadPickler(
+                section_file, protocol=pickle.HIGHEST_PROTOCOL, buffer_callback=buffer_writer,
+            ).dump(pickled_object))
+            buffer_names.append(buffer_writer.buffer_names[buffer_count:])
+        write_section(payload_file, lambda section_file: section_file.write(json.dumps(buffer_names).encode()))
+
+
+def bootstrap_script(payload_path):
+    return BOOTSTRAP_SCRIPT.format(payload_path=payload_path, magic=PAYLOAD_MAGIC, version=PAYLOAD_FORMAT_VERSION)
@@ -0,0 +1,122 @@
+import re
+import subprocess
+import sys
+import threading
+import uuid
+
+from docker.utils.socket import STDERR, STDOUT, SocketError, next_frame_header, read_exactly
+
+from .docker_exec import InheritedOutput
+
+# Keyword arguments that the persistent shell can honor. Anything else falls back to a separate exec per command.
+SUPPORTED_KWARGS = frozenset({"check", "encoding", "errors", "shell", "text", "universal_newlines"})
+
+
+def can_use_persistent_shell(args, kwargs):
+    return len(args) == 1 and isinstance(args[0], str) and set(kwargs).issubset(SUPPORTED_KWARGS)
+
+
+class PersistentShell:
+    """
+    A single long-lived shell inside the sidecar container that redirected shell commands are pipelined through.
+
+    Each command is written to the shell's stdin as a framed block, and runs in its own subshell so that exit statuses,
+    working directory changes, and exits don't leak between commands. The output of each command is followed by a
+    unique end marker carrying its exit code, which is used to split the shell's output stream back into per-command
+    results.
+    """
+    def __init__(self, docker_client, container_name, docker_shell_location):
+        self.lock = threading.Lock()
+        self.closed = False
+        api = docker_client.api
+        exec_id = api.exec_create(
+            container_name,
+            [docker_shell_location],
+            stdin=True,
+            stdout=True,
+            stderr=True,
+            tty=False,
+            workdir="/lug",
+        )["Id"]
+        self.socket = api.exec_start(exec_id, socket=True)
+        self.buffer = b""
+
+    def __repr__(self):
+        return f"<Lug PersistentShell {'closed' if self.closed else 'open'}>"
+
+    def send(self, data):
+        # The raw socket is wrapped in a read-only SocketIO by docker-py
+        raw_socket = getattr(self.socket, "_sock", self.socket)
+        raw_socket.sendall(data)
+
+    def read_until(self, end_pattern):
+        while True:
+            match = end_pattern.search(self.buffer)
+            if match:
+                output = self.buffer[:match.start()]
+                self.buffer = self.buffer[match.end():]
+                return output, int(match.group(1))
+            stream, size = next_frame_header(self.socket)
+            if stream < 0:
+                self.closed = True
+                raise EnvironmentError("Lug's persistent sidecar shell exited unexpectedly.")
+            try:
+                frame = read_exactly(self.socket, size)
+            except SocketError:
+                self.closed = True
+                raise EnvironmentError("Lug's persistent sidecar shell exited unexpectedly.")
+            if stream in (STDOUT, STDERR):
+                self.buffer += frame
+
+    def execute(self, command, blocking=True):
+        """
+        Runs a shell command with stderr redirected to stdout, and returns the exit code and output bytes.
+        If blocking is False and the shell is busy with another command, returns None without running the command.
+        """
+        marker = f"__lug_end_{uuid.uuid4().hex}__"
+        quoted_command = command.replace("'", r"'\''")  # sanitizes single quotes within sh command
+        # printf always emits a newline before the marker, so output without a trailing newline stays exact
+        framed_command = f"(eval '{quoted_command}') </dev/null 2>&1; printf '\\n{marker} %d\\n' $?\n"
+        end_pattern = re.compile(rb"\n" + marker.encode() + rb" (\d+)\n")
+        if not self.lock.acquire(blocking=blocking):
+            return None
+        try:
+            if self.closed:
+                raise EnvironmentError("Lug's persistent sidecar shell is closed.")
+            self.send(framed_command.encode())
+            output, exit_code = self.read_until(end_pattern)
+        finally:
+            self.lock.release()
+        return exit_code, output
+
+    def close(self):
+        if self.closed:
+            return
+        self.closed = True
+        try:
+            self.send(b"exit\n")
+            self.socket.close()
+        except OSError:
+            pass
+
+
+def persistent_shell_run(persistent_shell, original_function, args, kwargs, blocking=True):
+    """
+    Runs a sidecar_shell or os.system call through the persistent shell.
+    If blocking is False and the shell is busy, returns None without running the command.
+    """
+    command = args[0]
+    execution = persistent_shell.execute(command, blocking=blocking)
+    if execution is None:
+        return None
+    exit_code, output = execution
+    if original_function.__name__ == "system":
+        InheritedOutput(sys.stdout).write(output)
+        return exit_code << 8
+    # sidecar_shell captures text output with stderr merged into stdout by default
+    text_mode = kwargs.get("text", True) or kwargs.get("universal_newlines") or kwargs.get("encoding")
+    if text_mode:
+        output = output.decode(kwargs.get("encoding") or "utf-8", kwargs.get("errors") or "strict")
+    if kwargs.get("check") and exit_code:
+        raise subprocess.CalledProcessError(exit_code, command, output=output)
+    return subprocess.CompletedProcess(command, exit_code, output, None)
@@ -0,0 +1,213 @@
+import atexit
+import threading
+import time
+
+from docker.errors import APIError, DockerException
+
+from .containers import DockerContainer
+from .images import daemon_address
+from .reaper import reap_container
+
+# Resets a container between leases: kills processes left behind by the previous lease (everything but the container's
+# init shell) and removes its temporary files. The final cd checks that the mounted working directory is still
+# reachable, and its non-zero exit code marks the container as unhealthy.
+DEFAULT_RESET_COMMAND = "kill -9 -1 2>/dev/null; rm -rf /tmp/* /tmp/.[!.]* /var/tmp/* 2>/dev/null; cd /lug"
+
+# How often idle containers are checked for eviction, at most. Pools with a shorter idle_ttl are checked every idle_ttl.
+MAX_SWEEP_INTERVAL = 30
+
+_container_pools = dict()
+_container_pools_lock = threading.Lock()
+
+
+class ContainerPool:
+    """
+    A per-image pool of started, idle sidecar containers.
+
+    Containers are leased for the duration of one call and released afterwards, so back-to-back calls to the same
+    sidecar function skip container creation and startup. Idle containers are health checked and reset before they're
+    handed out again, and evicted once they've been idle for longer than `idle_ttl` seconds. Eviction is done by a
+    background sweeper thread, so idle containers are removed even if the pool is never used again.
+
+    Released containers are reset on background threads, so resets aren't on a call's return path. A lease that finds
+    no idle containers waits for a reset in progress rather than starting a new container.
+    """
+    def __init__(self, docker_client, image_name_and_tag, mount, docker_shell_location, min_size=0, max_size=4,
+                 idle_ttl=300, reset_command=DEFAULT_RESET_COMMAND):
+        if min_size > max_size:
+            raise ValueError(f"Pool min_size ({min_size}) can't be larger than max_size ({max_size}).")
+        self.docker_client = docker_client
+        self.image_name_and_tag = image_name_and_tag
+        self.mount = mount
+        self.docker_shell_location = docker_shell_location
+        self.min_size = min_size
+        self.max_size = max_size
+        self.idle_ttl = idle_ttl
+        self.reset_command = reset_command
+        self.idle_containers = []  # (DockerContainer, released_at) pairs, most recently released last
+        self.num_starting = 0
+        self.num_resetting = 0
+        self.lock = threading.Lock()
+        self.container_available = threading.Condition(self.lock)
+        self.sweeper = None
+        self.closed = threading.Event()
+
+    def __repr__(self):
+        return str(f"<Lug ContainerPool {self.image_name_and_tag} ({len(self.idle_containers)} idle)>")
+
+    def start_container(self):
+        user_docker = DockerContainer(
+            docker_client=self.docker_client,
+            image_name_and_tag=self.image_name_and_tag,
+        )
+        user_docker.load_image()
+        user_docker.start(mount=self.mount, docker_shell_location=self.docker_shell_location)
+        return user_docker
+
+    def reset_container(self, user_docker):
+        """Returns True if the container is running and was successfully reset for the next lease."""
+        if not user_docker.is_running():
+            return False
+        try:
+            exit_code, _ = user_docker.container.exec_run(
+                [self.docker_shell_location, "-c", self.reset_command],
+                workdir="/lug",
+            )
+        except (APIError, DockerException):
+            return False
+        return exit_code == 0
+
+    def teardown_container(self, user_docker):
+        reap_container(user_docker)
+
+    def evict_expired(self):
+        """Tears down containers that have been idle for longer than idle_ttl, keeping at least min_size."""
+        now = time.monotonic()
+        expired = []
+        with self.lock:
+            while len(self.idle_containers) > self.min_size and now - self.idle_containers[0][1] > self.idle_ttl:
+                expired.append(self.idle_containers.pop(0)[0])
+        for user_docker in expired:
+            self.teardown_container(user_docker)
+
+    def sweep_forever(self):
+        """Evicts expired containers until none are idle, when the thread exits until the next release."""
+        sweep_interval = min(self.idle_ttl, MAX_SWEEP_INTERVAL)
+        while not self.closed.wait(sweep_interval):
+            self.evict_expired()
+            with self.lock:
+                if not self.idle_containers:
+                    self.sweeper = None
+                    return
+
+    def start_sweeper(self):
+        """Starts the sweeper thread, unless it's already running. Must be called with the lock held."""
+        if self.sweeper is None or not self.sweeper.is_alive():
+            self.sweeper = threading.Thread(target=self.sweep_forever, name="lug-pool-sweeper", daemon=True)
+            self.sweeper.start()
+
+    def replenish(self):
+        """Starts containers in the background until at least min_size are idle, starting, or being reset."""
+        with self.lock:
+            num_to_start = self.min_size - len(self.idle_containers) - self.num_starting - self.num_resetting
+            if num_to_start <= 0:
+                return
+            self.num_starting += num_to_start
+
+        def start_idle_container():
+            try:
+                user_docker = self.start_container()
+            except (APIError, DockerException):
+                return
+            finally:
+                with self.lock:
+                    self.num_starting -= 1
+            self.release(user_docker, reset=False)
+
+        for _ in range(num_to_start):
+            threading.Thread(target=start_idle_container, daemon=True).start()
+
+    def lease(self):
+        self.evict_expired()
+        while True:
+            with self.lock:
+                while not self.idle_containers and self.num_resetting:
+                    self.container_available.wait()
+                if not self.idle_containers:
+                    break
+                user_docker, _ = self.idle_containers.pop()
+            if user_docker.is_running():
+                self.replenish()
+                return user_docker
+            self.teardown_container(user_docker)
+        self.replenish()
+        return self.start_container()
+
+    def release(self, user_docker, reset=True):
+        if user_docker.container is None:
+            return
+        if not reset:
+            self.return_container(user_docker, healthy=True)
+            return
+        with self.lock:
+            self.num_resetting += 1
+        threading.Thread(target=self.reset_and_return_container, args=(user_docker,), daemon=True).start()
+
+    def reset_and_return_container(self, user_docker):
+        healthy = False
+        try:
+            healthy = self.reset_container(user_docker)
+        finally:
+            self.return_container(user_docker, healthy, was_reset=True)
+
+    def return_container(self, user_docker, healthy, was_reset=False):
+        """Makes a healthy container idle if there's room for it, and tears it down otherwise."""
+        with self.lock:
+            if was_reset:
+                self.num_resetting -= 1
+            self.container_available.notify_all()
+            if healthy and len(self.idle_containers) < self.max_size and not self.closed.is_set():
+                self.idle_containers.append((user_docker, time.monotonic()))
+                self.start_sweeper()
+                return
+        self.teardown_container(user_docker)
+
+    def shutdown(self):
+        self.closed.set()
+        with self.lock:
+            idle_containers = self.idle_containers
+            self.idle_containers = []
+        for user_docker, _ in idle_containers:
+            self.teardown_container(user_docker)
+
+
+def get_container_pool(docker_client, image_name_and_tag, mount, docker_shell_location, **pool_options):
+    """
+    Returns the process-wide pool for this Docker daemon, image, mount, shell, and pool options (e.g. sizes), creating
+    it on first use.
+    """
+    pool_key = (
+        daemon_address(docker_client), image_name_and_tag, mount, docker_shell_location,
+        tuple(sorted(pool_options.items())),
+    )
+    with _container_pools_lock:
+        pool = _container_pools.get(pool_key)
+        if pool is None:
+            pool = ContainerPool(
+                docker_client=docker_client,
+                image_name_and_tag=image_name_and_tag,
+                mount=mount,
+                docker_shell_location=docker_shell_location,
+                **pool_options,
+            )
+            _container_pools[pool_key] = pool
+    return pool
+
+
+@atexit.register
+def shutdown_container_pools():
+    with _container_pools_lock:
+        pools = list(_container_pools.values())
+        _container_pools.clear()
+    for pool in pools:
+        pool.shutdown()
@@ -0,0 +1,119 @@
+import atexit
+import collections
+import threading
+import time
+
+from docker.errors import APIError, DockerException
+
+
+class ContainerReaper:
+    """
+    Tears down sidecar containers on a background thread, so a lugged function's return latency excludes cleanup.
+
+    Containers are killed rather than stopped (the sidecar shell ignores SIGTERM, so a stop always waits out the grace
+    period), and then force removed. Containers queued while a teardown is in progress are handled together as a batch.
+
+    The queue is a deque and in-progress batches are kept in a dict, whose single operations are atomic without locks.
+    Signal handlers can then queue containers and drain the queue, even if they interrupt code that's using it.
+    """
+    def __init__(self, max_batch_size=16):
+        self.max_batch_size = max_batch_size
+        self.pending = collections.deque()
+        self.in_progress = dict()  # id(batch): batch
+        self.wakeup = threading.Event()
+        self.lock = threading.Lock()  # Guards starting the reaper thread
+        self.thread = None
+
+    def __repr__(self):
+        return f"<Lug ContainerReaper ({self.backlog()} pending)>"
+
+    def submit(self, user_docker):
+        self.pending.append(user_docker)
+        self.wakeup.set()
+        with self.lock:
+            if self.thread is None or not self.thread.is_alive():
+                self.thread = threading.Thread(target=self.reap_forever, name="lug-container-reaper", daemon=True)
+                try:
+                    self.thread.start()
+                except RuntimeError:
+                    pass  # New threads can't be started during interpreter shutdown, so drain() picks this up
+
+    def backlog(self):
+        """Number of containers waiting for or in the middle of teardown."""
+        return len(self.pending) + sum(len(batch) for batch in list(self.in_progress.values()))
+
+    def take_batch(self):
+        """Takes up to max_batch_size queued containers. The batch is empty if nothing is queued."""
+        batch = []
+        self.in_progress[id(batch)] = batch
+        while len(batch) < self.max_batch_size:
+            try:
+                batch.append(self.pending.popleft())
+            except IndexError:
+                break
+        if not batch:
+            del self.in_progress[id(batch)]
+        return batch
+
+    def reap_batch(self, batch):
+        try:
+            # Kill everything first, so the containers in the batch shut down concurrently
+            for user_docker in batch:
+                try:
+                    user_docker.container.kill()
+                except (APIError, DockerException):
+                    pass  # Already exited
+            for user_docker in batch:
+                try:
+                    user_docker.container.remove(force=True)
+                except (APIError, DockerException):
+                    pass  # Already removed
+        finally:
+            self.in_progress.pop(id(batch), None)
+
+    def reap_queued(self):
+        batch = self.take_batch()
+        while batch:
+            self.reap_batch(batch)
+            batch = self.take_batch()
+
+    def reap_forever(self):
+        while True:
+            self.wakeup.wait()
+            self.wakeup.clear()
+            self.reap_queued()
+
+    def drain(self, timeout=30):
+        """
+        Synchronously tears down everything still queued, then waits up to `timeout` seconds for the reaper thread to
+        finish its current batch. No locks are taken, so this can be called from exit and signal handlers.
+        """
+        self.reap_queued()
+        deadline = time.monotonic() + timeout
+        while self.in_progress and time.monotonic() < deadline:
+            time.sleep(0.05)
+
+
+container_reaper = ContainerReaper()
+atexit.register(container_reaper.drain)
+
+
+def reap_container(user_docker):
+    """Queues a sidecar container for background teardown."""
+    container_reaper.submit(user_docker)
+
+
+def reaper_backlog():
+    """Returns the number of sidecar containers that are queued for or in the middle of background teardown."""
+    return container_reaper.backlog()
+
+
+def reap_containers_now(user_dockers):
+    """
+    Tears down sidecar containers right away, along with every container queued for background teardown. Used by
+    signal handlers, so no locks are taken.
+    """
+    for user_docker in user_dockers:
+        if user_docker.container is not None:
+            container_reaper.pending.append(user_docker)
+    container_reaper.drain()
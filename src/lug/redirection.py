@@ -0,0 +1,293 @@
+import asyncio
+import contextvars
+import os
+import re
+import shlex
+import subprocess
+import sys
+import threading
+
+from .docker_exec import can_use_exec_api, exec_with_api
+from .persistent_shell import can_use_persistent_shell, persistent_shell_run
+
+# The sidecar that system calls made in the current context are redirected to, or None to run them on the host.
+# Being a context variable, each thread and asyncio task sees its own value, so enabling redirection for one lugged call
+# doesn't affect calls made concurrently elsewhere.
+current_sidecar = contextvars.ContextVar("lug_current_sidecar", default=None)
+
+ORIGINAL_POPEN = subprocess.Popen
+ORIGINAL_RUN = subprocess.run
+ORIGINAL_SYSTEM = os.system
+ORIGINAL_CREATE_SUBPROCESS_EXEC = asyncio.create_subprocess_exec
+ORIGINAL_CREATE_SUBPROCESS_SHELL = asyncio.create_subprocess_shell
+
+_dispatchers_installed = False
+_install_lock = threading.Lock()
+_rebound_namespaces = set()
+
+ENVIRONMENT_ASSIGNMENT = re.compile(r"^[A-Za-z_][A-Za-z0-9_]*=")
+
+
+class Sidecar:
+    """
+    A container that system calls are redirected to, and how commands are executed in it.
+    Note: docker_shell_location refers to the shell in the *user* docker container
+    If a docker_client is passed, commands are executed through the Docker Engine API instead of the docker CLI when
+    possible. If a persistent_shell is passed, os.system and sidecar_shell commands are pipelined through it.
+    If redirect_shell is False, only lug.sidecar_shell is redirected.
+    The image ID and host mount directory are used to cache sidecar_shell results, if known.
+    Commands whose executable is in `routes` are redirected to the sidecar it maps to instead. If container_name is
+    None, only routed commands are redirected.
+    If docker_host is set, the docker CLI targets that daemon instead of the default one.
+    """
+    def __init__(self, container_name, docker_shell_location, redirect_shell=True, docker_client=None,
+                 persistent_shell=None, image_id=None, mount=None, routes=None, docker_host=None):
+        self.container_name = container_name
+        self.docker_shell_location = docker_shell_location
+        self.redirect_shell = redirect_shell
+        self.docker_client = docker_client
+        self.persistent_shell = persistent_shell
+        self.image_id = image_id
+        self.mount = mount
+        self.routes = routes or dict()
+        self.docker_host = docker_host
+
+    def __repr__(self):
+        return f"<Lug Sidecar {self.container_name}>"
+
+    def with_redirect_shell(self, redirect_shell):
+        if redirect_shell == self.redirect_shell:
+            return self
+        return Sidecar(
+            container_name=self.container_name,
+            docker_shell_location=self.docker_shell_location,
+            redirect_shell=redirect_shell,
+            docker_client=self.docker_client,
+            persistent_shell=self.persistent_shell,
+            image_id=self.image_id,
+            mount=self.mount,
+            routes={
+                executable: routed_sidecar.with_redirect_shell(redirect_shell)
+                for executable, routed_sidecar in self.routes.items()
+            },
+            docker_host=self.docker_host,
+        )
+
+    def docker_cli(self):
+        if self.docker_host is None:
+            return ["docker"]
+        return ["docker", "--host", self.docker_host]
+
+    def route(self, command):
+        """Returns the sidecar that a command should run in, or None if it should run on the host."""
+        if self.routes and command is not None:
+            routed_sidecar = self.routes.get(command_executable(command))
+            if routed_sidecar is not None:
+                return routed_sidecar
+        return self if self.container_name is not None else None
+
+    def runs_without_cli(self, original_function, args, kwargs):
+        """Whether the call is executed without the docker CLI, i.e. doesn't spawn a host process."""
+        if self.persistent_shell is not None and original_function.__name__ in ["system", "sidecar_shell"] \
+                and can_use_persistent_shell(args, kwargs):
+            return True
+        return self.docker_client is not None and can_use_exec_api(args, kwargs)
+
+    def docker_exec_arguments(self, original_function, args, kwargs):
+        """Rewrites the arguments of a system call to run the command through the docker CLI instead."""
+        docker_exec_args = self.docker_cli() + [
+            "exec",
+            f"{self.container_name}",
+        ]
+        using_shell = kwargs.get("shell") or original_function.__name__ in ["system", "sidecar_shell"]
+        if using_shell:
+            docker_exec_args.append(self.docker_shell_location)
+
+        if type(args[0]) is list:
+            original_list_args = args[0]
+            docker_exec_args += original_list_args
+            return (docker_exec_args, *args[1:]), kwargs
+        # NOTE: args[0] (the user command argument) can only be a string if using_shell is True.
+        stringified_docker_command = ' '.join(docker_exec_args)
+        user_command = args[0].replace("'", r"'\''")  # sanitizes single quotes within sh command
+        new_args = stringified_docker_command + " -c '" + user_command + "'"
+        if original_function.__name__ == "system":
+            return (new_args,), {}
+        return (new_args,), kwargs
+
+    async def redirect_async(self, args, kwargs, using_shell):
+        """
+        Runs asyncio.create_subprocess_exec or asyncio.create_subprocess_shell in the sidecar container, through the
+        docker CLI. The CLI processes are asyncio subprocesses themselves, so many commands can run concurrently.
+        """
+        token = current_sidecar.set(None)
+        try:
+            docker_exec_args = self.docker_cli() + ["exec"]
+            if kwargs.get("stdin") is not None:
+                docker_exec_args.append("--interactive")  # Forward stdin into the container
+            docker_exec_args.append(self.container_name)
+            if using_shell:
+                docker_exec_args += [self.docker_shell_location, "-c", args[0]]
+            else:
+                docker_exec_args += list(args)
+            return await ORIGINAL_CREATE_SUBPROCESS_EXEC(*docker_exec_args, **kwargs)
+        finally:
+            current_sidecar.reset(token)
+
+    def redirect(self, original_function, args, kwargs):
+        """Runs os.system, subprocess.run, subprocess.Popen, or lug.sidecar_shell in the sidecar container."""
+        # Anything spawned while redirecting (e.g. the docker CLI itself) runs on the host
+        token = current_sidecar.set(None)
+        try:
+            using_shell = kwargs.get("shell") or original_function.__name__ in ["system", "sidecar_shell"]
+            if self.persistent_shell is not None and original_function.__name__ in ["system", "sidecar_shell"] \
+                    and can_use_persistent_shell(args, kwargs):
+                # The shell runs one command at a time, so concurrent commands (e.g. from sidecar_shell_many) get their
+                # own exec instead of waiting for it
+                result = persistent_shell_run(self.persistent_shell, original_function, args, kwargs, blocking=False)
+                if result is not None:
+                    return result
+            if self.docker_client is not None and can_use_exec_api(args, kwargs):
+                return exec_with_api(
+                    docker_client=self.docker_client,
+                    container_name=self.container_name,
+                    original_function=original_function,
+                    args=args,
+                    kwargs=kwargs,
+                    using_shell=using_shell,
+                    docker_shell_location=self.docker_shell_location,
+                )
+            args, kwargs = self.docker_exec_arguments(original_function, args, kwargs)
+            return original_function(*args, **kwargs)
+        finally:
+            current_sidecar.reset(token)
+
+
+def command_executable(command):
+    """
+    The name of the program that a command runs: its first word, skipping environment variable assignments and opening
+    subshells or command groups.
+    """
+    if isinstance(command, (list, tuple)):
+        words = [os.fsdecode(word) for word in command]
+    else:
+        try:
+            words = shlex.split(os.fsdecode(command))
+        except (TypeError, ValueError):
+            return None
+    for word in words:
+        if word not in ("(", "{") and not ENVIRONMENT_ASSIGNMENT.match(word):
+            return os.path.basename(word)
+    return None
+
+
+def redirected_sidecar(shell_call=False, command=None):
+    """Returns the sidecar that a call should be redirected to, if any."""
+    sidecar = current_sidecar.get()
+    if sidecar is None or not (shell_call or sidecar.redirect_shell):
+        return None
+    return sidecar.route(command)
+
+
+def popen_command(args, kwargs):
+    return args[0] if args else kwargs.get("args")
+
+
+class Popen(ORIGINAL_POPEN):
+    """Execute a child program in a new process, or in the current Lug sidecar container."""
+    is_lug_dispatcher = True
+
+    def __new__(cls, *args, **kwargs):
+        sidecar = redirected_sidecar(command=popen_command(args, kwargs))
+        if sidecar is not None and sidecar.runs_without_cli(ORIGINAL_POPEN, args, kwargs):
+            # Returns a Popen-compatible handle for the exec instead of a Popen instance
+            return sidecar.redirect(ORIGINAL_POPEN, args, kwargs)
+        return super().__new__(cls)
+
+    def __init__(self, *args, **kwargs):
+        sidecar = redirected_sidecar(command=popen_command(args, kwargs))
+        if sidecar is not None:
+            args, kwargs = sidecar.docker_exec_arguments(ORIGINAL_POPEN, args, kwargs)
+        super().__init__(*args, **kwargs)
+
+
+def run(*args, **kwargs):
+    """Run command with arguments and return a CompletedProcess instance, in the current Lug sidecar if any."""
+    sidecar = redirected_sidecar(command=popen_command(args, kwargs))
+    if sidecar is None:
+        return ORIGINAL_RUN(*args, **kwargs)
+    return sidecar.redirect(ORIGINAL_RUN, args, kwargs)
+
+
+def system(command):
+    """Execute the command in a subshell, in the current Lug sidecar if any."""
+    sidecar = redirected_sidecar(command=command)
+    if sidecar is None:
+        return ORIGINAL_SYSTEM(command)
+    return sidecar.redirect(ORIGINAL_SYSTEM, (command,), {})
+
+
+async def create_subprocess_exec(program, *args, **kwargs):
+    """Create a subprocess, in the current Lug sidecar if any."""
+    sidecar = redirected_sidecar(command=[program])
+    if sidecar is None:
+        return await ORIGINAL_CREATE_SUBPROCESS_EXEC(program, *args, **kwargs)
+    return await sidecar.redirect_async((program, *args), kwargs, using_shell=False)
+
+
+async def create_subprocess_shell(cmd, **kwargs):
+    """Run the shell command cmd, in the current Lug sidecar if any."""
+    sidecar = redirected_sidecar(command=cmd)
+    if sidecar is None:
+        return await ORIGINAL_CREATE_SUBPROCESS_SHELL(cmd, **kwargs)
+    return await sidecar.redirect_async((cmd,), kwargs, using_shell=True)
+
+
+run.is_lug_dispatcher = True
+system.is_lug_dispatcher = True
+create_subprocess_exec.is_lug_dispatcher = True
+create_subprocess_shell.is_lug_dispatcher = True
+DISPATCHERS = [
+    (ORIGINAL_POPEN, Popen),
+    (ORIGINAL_RUN, run),
+    (ORIGINAL_SYSTEM, system),
+    # Bound in both asyncio and asyncio.subprocess, which are rebound like any other loaded module
+    (ORIGINAL_CREATE_SUBPROCESS_EXEC, create_subprocess_exec),
+    (ORIGINAL_CREATE_SUBPROCESS_SHELL, create_subprocess_shell),
+]
+
+
+def rebind_namespace(namespace):
+    """Points names bound to the original system call functions (e.g. `from subprocess import run`) to dispatchers."""
+    for name, value in list(namespace.items()):
+        # Compared by identity, since arbitrary module globals can have unusual __eq__ and __hash__ implementations
+        for original_function, dispatcher in DISPATCHERS:
+            if value is original_function:
+                namespace[name] = dispatcher
+
+
+def install_dispatchers(namespace=None):
+    """
+    Installs the system call dispatchers, once per process. Afterwards, redirecting calls is a context variable change.
+
+    Modules imported after installation pick up the dispatchers on their own, so only modules that are already loaded
+    are rebound. A function's globals are rebound as well, in case they aren't a loaded module's namespace.
+    """
+    global _dispatchers_installed
+    with _install_lock:
+        if not _dispatchers_installed:
+            subprocess.Popen = Popen
+            subprocess.run = run
+            os.system = system
+            asyncio.create_subprocess_exec = create_subprocess_exec
+            asyncio.create_subprocess_shell = create_subprocess_shell
+            for module in list(sys.modules.values()):
+                module_namespace = getattr(module, "__dict__", None)
+                # This module keeps the originals, which the dispatchers fall back to
+                if isinstance(module_namespace, dict) and module_namespace is not globals():
+                    rebind_namespace(module_namespace)
+                    _rebound_namespaces.add(id(module_namespace))
+            _dispatchers_installed = True
+        if namespace is not None and id(namespace) not in _rebound_namespaces:
+            rebind_namespace(namespace)
+            _rebound_namespaces.add(id(namespace))
@@ -0,0 +1,213 @@
+import base64
+import hashlib
+import json
+import os
+import shutil
+import subprocess
+import tempfile
+import threading
+import uuid
+
+from .caching import cache_directory
+
+DEFAULT_MAX_SIZE = 2 * 1024 ** 3  # 2 GiB
+HASH_CHUNK_SIZE = 1024 * 1024
+
+
+def directory_size(path):
+    size = 0
+    for directory, _, file_names in os.walk(path):
+        for file_name in file_names:
+            try:
+                size += os.lstat(os.path.join(directory, file_name)).st_size
+            except OSError:
+                pass
+    return size
+
+
+class ResultCache:
+    """
+    An on-disk, content-addressed cache of sidecar shell results.
+
+    Results are keyed on the sidecar image ID, the command and its arguments, and the contents of the command's declared
+    input paths. Each entry stores the captured output and copies of the declared output paths, which are restored
+    into the mount on a hit instead of running the command again. Once the cache grows past `max_size` bytes, the
+    least recently used entries are evicted.
+    """
+    def __init__(self, directory=None, max_size=DEFAULT_MAX_SIZE):
+        self.directory = directory or cache_directory("results")
+        self.max_size = max_size
+        self.lock = threading.Lock()
+        self.file_hashes = dict()  # (path, device, inode, size, mtime): SHA-256 digest
+
+    def __repr__(self):
+        return f"<Lug ResultCache {self.directory}>"
+
+    def hash_file(self, path):
+        stat = os.stat(path)
+        stat_key = (path, stat.st_dev, stat.st_ino, stat.st_size, stat.st_mtime_ns)
+        file_hash = self.file_hashes.get(stat_key)
+        if file_hash is None:
+            digest = hashlib.sha256()
+            with open(path, "rb") as input_file:
+                for chunk in iter(lambda: input_file.read(HASH_CHUNK_SIZE), b""):
+                    digest.update(chunk)
+            file_hash = digest.hexdigest()
+            self.file_hashes[stat_key] = file_hash
+        return file_hash
+
+    def hash_path(self, path):
+        """Hashes a file, or the names and contents of every file in a directory."""
+        if not os.path.isdir(path):
+            return self.hash_file(path)
+        digest = hashlib.sha256()
+        for directory, directory_names, file_names in os.walk(path):
+            directory_names.sort()
+            for file_name in sorted(file_names):
+                file_path = os.path.join(directory, file_name)
+                digest.update(os.path.relpath(file_path, path).encode() + b"\0")
+                digest.update(self.hash_file(file_path).encode())
+        return digest.hexdigest()
+
+    def key(self, image_id, command, kwargs, mount, inputs, outputs):
+        key_material = {
+            "image": image_id,
+            "command": command,
+            "kwargs": sorted((name, repr(value)) for name, value in kwargs.items()),
+            "inputs": [(path, self.hash_path(os.path.join(mount, path))) for path in sorted(inputs)],
+            "outputs": sorted(outputs),
+        }
+        return hashlib.sha256(json.dumps(key_material).encode()).hexdigest()
+
+    def entry_directory(self, key):
+        return os.path.join(self.directory, key[:2], key)
+
+    def replay(self, key, command, mount, outputs):
+        """Restores a cached result's outputs into the mount and returns its CompletedProcess, or None on a miss."""
+        entry_directory = self.entry_directory(key)
+        try:
+            with open(os.path.join(entry_directory, "result.json")) as result_file:
+                result = json.load(result_file)
+            os.utime(entry_directory)  # Marks the entry as recently used
+        except (OSError, ValueError):
+            return None
+        for index, path in enumerate(outputs):
+            cached_path = os.path.join(entry_directory, "outputs", str(index))
+            destination = os.path.join(mount, path)
+            if os.path.isdir(destination) and not os.path.islink(destination):
+                shutil.rmtree(destination)
+            os.makedirs(os.path.dirname(destination) or ".", exist_ok=True)
+            if os.path.isdir(cached_path):
+                shutil.copytree(cached_path, destination)
+            else:
+                shutil.copy2(cached_path, destination)
+        stdout = result["stdout"]
+        if result["stdout_is_bytes"]:
+            stdout = base64.b64decode(stdout)
+        return subprocess.CompletedProcess(command, result["returncode"], stdout, None)
+
+    def store(self, key, mount, outputs, result):
+        os.makedirs(self.directory, exist_ok=True)
+        # Entries are built in a temporary directory and renamed into place, so readers never see a partial entry
+        staging_directory = tempfile.mkdtemp(prefix=".staging-", dir=self.directory)
+        try:
+            os.mkdir(os.path.join(staging_directory, "outputs"))
+            for index, path in enumerate(outputs):
+                source = os.path.join(mount, path)
+                cached_path = os.path.join(staging_directory, "outputs", str(index))
+                if os.path.isdir(source):
+                    shutil.copytree(source, cached_path)
+                else:
+                    shutil.copy2(source, cached_path)
+            stdout_is_bytes = isinstance(result.stdout, bytes)
+            with open(os.path.join(staging_directory, "result.json"), "w") as result_file:
+                json.dump({
+                    "returncode": result.returncode,
+                    "stdout": base64.b64encode(result.stdout).decode() if stdout_is_bytes else result.stdout,
+                    "stdout_is_bytes": stdout_is_bytes,
+                }, result_file)
+            entry_directory = self.entry_directory(key)
+            os.makedirs(os.path.dirname(entry_directory), exist_ok=True)
+            try:
+                os.rename(staging_directory, entry_directory)
+            except OSError:
+                pass  # Stored concurrently by another call with the same key
+        finally:
+            shutil.rmtree(staging_directory, ignore_errors=True)
+        self.evict()
+
+    def entries(self):
+        """Returns (last used, size, entry directory) for every entry in the cache."""
+        entries = []
+        if not os.path.isdir(self.directory):
+            return entries
+        for shard in os.listdir(self.directory):
+            shard_directory = os.path.join(self.directory, shard)
+            if shard.startswith(".") or not os.path.isdir(shard_directory):
+                continue
+            for key in os.listdir(shard_directory):
+                entry_directory = os.path.join(shard_directory, key)
+                try:
+                    last_used = os.stat(entry_directory).st_mtime
+                except OSError:
+                    continue
+                entries.append((last_used, directory_size(entry_directory), entry_directory))
+        return entries
+
+    def evict(self):
+        """Removes the least recently used entries until the cache fits in max_size."""
+        with self.lock:
+            entries = sorted(self.entries())
+            total_size = sum(size for _, size, _ in entries)
+            for _, size, entry_directory in entries:
+                if total_size <= self.max_size:
+                    break
+                # Renamed first, so a concurrent replay can't read a half-removed entry
+                evicted_directory = os.path.join(self.directory, f".evicted-{uuid.uuid4().hex}")
+                try:
+                    os.rename(entry_directory, evicted_directory)
+                except OSError:
+                    continue
+                shutil.rmtree(evicted_directory, ignore_errors=True)
+                total_size -= size
+
+    def clear(self):
+        shutil.rmtree(self.directory, ignore_errors=True)
+        self.file_hashes.clear()
+
+
+result_cache = ResultCache()
+
+
+def cached_sidecar_shell(sidecar, run_command, command, kwargs, inputs, outputs):
+    """
+    Runs a sidecar shell command through the result cache. Only successful results are cached, and commands run
+    uncached if the sidecar's image ID isn't known.
+    """
+    if sidecar is None or sidecar.image_id is None or sidecar.mount is None:
+        return run_command(command, **kwargs)
+    key = result_cache.key(sidecar.image_id, command, kwargs, sidecar.mount, inputs, outputs)
+    result = result_cache.replay(key, command, sidecar.mount, outputs)
+    if result is not None:
+        result.cached = True
+        return result
+    result = run_command(command, **kwargs)
+    if result.returncode == 0:
+        result_cache.store(key, sidecar.mount, outputs, result)
+    result.cached = False
+    return result
+
+
+def configure_result_cache(directory=None, max_size=None):
+    """Moves the sidecar shell result cache to another directory, or changes its size limit in bytes."""
+    if directory is not None:
+        result_cache.directory = directory
+        result_cache.file_hashes.clear()
+    if max_size is not None:
+        result_cache.max_size = max_size
+        result_cache.evict()
+
+
+def clear_result_cache():
+    """Removes every cached sidecar shell result."""
+    result_cache.clear()
@@ -0,0 +1,117 @@
+import os
+import signal
+import sys
+import threading
+
+import docker
+from docker.errors import APIError, DockerException
+
+from .containers import DockerContainer
+from .lug import active_session, run_to_completion
+from .persistent_shell import PersistentShell
+from .reaper import reap_container
+from .redirection import Sidecar, current_sidecar, install_dispatchers
+from .shell import sidecar_shell
+
+
+class Session:
+    """
+    A sidecar environment that's kept open for many calls.
+
+    Within a `with lug.session(...)` block, calls to local Docker Sidecar functions with the session's image and mount
+    reuse the session's container and Docker client instead of setting them up and tearing them down on every call.
+    Everything is torn down once, when the block exits.
+    """
+    def __init__(self, image, mount=os.getcwd(), docker_shell_location="/bin/sh", exec_backend="api",
+                 persistent_shell=False):
+        if exec_backend not in ("cli", "api"):
+            raise ValueError(f"Unknown exec_backend '{exec_backend}'. Use 'cli' or 'api'.")
+        self.image = image
+        self.mount = os.path.realpath(mount)
+        self.docker_shell_location = docker_shell_location
+        self.exec_backend = exec_backend
+        self.use_persistent_shell = persistent_shell
+        self.client = None
+        self.user_docker = None
+        self.persistent_shell = None
+        self.sidecar = None
+        self.active_session_token = None
+
+    def __repr__(self):
+        return f"<Lug Session {self.image}>"
+
+    def __enter__(self):
+        try:
+            self.client = docker.from_env()
+        except (APIError, DockerException):
+            raise EnvironmentError(
+                'Unable to connect to Docker. Make sure you have Docker installed and that it is currently running.'
+            )
+        self.user_docker = DockerContainer(docker_client=self.client, image_name_and_tag=self.image)
+        self.user_docker.load_image()
+        self.user_docker.start(mount=self.mount, docker_shell_location=self.docker_shell_location)
+        try:
+            self.start_session()
+        except Exception:
+            reap_container(self.user_docker)
+            raise
+        self.active_session_token = active_session.set(self)
+        return self
+
+    def start_session(self):
+        if threading.current_thread() is threading.main_thread() and not sys.platform.startswith('win'):
+            # Only supports Unix signals
+            signal.signal(signal.SIGABRT, self.user_docker.signal_kill_handler)
+            signal.signal(signal.SIGHUP, self.user_docker.signal_kill_handler)
+            signal.signal(signal.SIGSEGV, self.user_docker.signal_kill_handler)
+            signal.signal(signal.SIGTERM, self.user_docker.signal_kill_handler)
+        if self.use_persistent_shell:
+            self.persistent_shell = PersistentShell(
+                self.client,
+                self.user_docker.container_name,
+                self.docker_shell_location,
+            )
+        self.sidecar = Sidecar(
+            container_name=self.user_docker.container_name,
+            docker_shell_location=self.docker_shell_location,
+            docker_client=self.client if self.exec_backend == "api" else None,
+            persistent_shell=self.persistent_shell,
+            image_id=self.user_docker.image_id,
+            mount=self.mount,
+        )
+
+    def __exit__(self, exc_type, value, traceback):
+        active_session.reset(self.active_session_token)
+        if self.persistent_shell is not None:
+            self.persistent_shell.close()
+        reap_container(self.user_docker)
+
+    def shell(self, command, **kwargs):
+        """Runs a shell command in the session's container, like lug.sidecar_shell."""
+        return self.sidecar.redirect(sidecar_shell, (command,), kwargs)
+
+    def call(self, func, args, kwargs, redirect_shell):
+        """Calls a lugged function with its system calls redirected to the session's container."""
+        install_dispatchers(namespace=func.__globals__)
+        token = current_sidecar.set(self.sidecar.with_redirect_shell(redirect_shell))
+        try:
+            return run_to_completion(func(*args, **kwargs))
+        finally:
+            current_sidecar.reset(token)
+
+
+def session(image, mount=os.getcwd(), docker_shell_location="/bin/sh", exec_backend="api", persistent_shell=False):
+    """
+    Keeps one sidecar container open for many calls to Docker Sidecar functions:
+
+        with lug.session(image="alpine:3.16.2") as s:
+            s.shell("echo hello")
+            my_sidecar_function()
+    """
+    return Session(
+        image=image,
+        mount=mount,
+        docker_shell_location=docker_shell_location,
+        exec_backend=exec_backend,
+        persistent_shell=persistent_shell,
+    )
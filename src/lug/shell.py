@@ -1,10 +1,111 @@
+import asyncio
+import contextvars
+import functools
+import os
+import shlex
 import subprocess
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
 
+from . import redirection
+from .redirection import redirected_sidecar
+from .result_cache import cached_sidecar_shell
 
-def sidecar_shell(command, **kwargs):
+STREAM_CHUNK_SIZE = 64 * 1024
+
+
+class SidecarShellStream:
+    """
+    The output of a streamed lug.sidecar_shell command, read as the command runs.
+
+    Iterating yields lines (or, with text=False, byte chunks of at most chunk_size bytes), and only the unread part of
+    the pipe is buffered. The command's exit code is in `returncode` once the output has been read or `wait()` returns.
+    """
+    def __init__(self, command, process, text=True, chunk_size=STREAM_CHUNK_SIZE):
+        self.args = command
+        self.process = process
+        self.text = text
+        self.chunk_size = chunk_size
+        self.returncode = None
+
+    def __repr__(self):
+        return f"<Lug SidecarShellStream: returncode: {self.returncode} args: {self.args!r}>"
+
+    def __iter__(self):
+        if self.text:
+            # Not `yield from`, which would close the pipe if iteration is abandoned early
+            for line in self.process.stdout:
+                yield line
+        else:
+            chunk = self.process.stdout.read1(self.chunk_size)
+            while chunk:
+                yield chunk
+                chunk = self.process.stdout.read1(self.chunk_size)
+        self.wait()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, value, traceback):
+        self.wait()
+
+    def wait(self):
+        """Discards any unread output, and returns the exit code once the command finishes."""
+        if self.returncode is None:
+            while self.process.stdout.read(self.chunk_size):
+                pass
+            self.process.stdout.close()
+            self.returncode = self.process.wait()
+        return self.returncode
+
+
+def stream_sidecar_shell(command, text=True, chunk_size=STREAM_CHUNK_SIZE, **kwargs):
+    popen_kwargs = dict(shell=True, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, text=text, **kwargs)
+    sidecar = redirected_sidecar(shell_call=True, command=command)
+    if sidecar is not None:
+        process = sidecar.redirect(redirection.ORIGINAL_POPEN, (command,), popen_kwargs)
+    else:
+        process = redirection.ORIGINAL_POPEN(command, **popen_kwargs)
+    return SidecarShellStream(command, process, text=text, chunk_size=chunk_size)
+
+
+def sidecar_shell(command, stream=False, to_file=None, cache=False, inputs=(), outputs=(), **kwargs):
     """
     This function is redirected to the Lug sidecar container. The first arg must remain the shell command.
+
+    With stream=True, returns a SidecarShellStream to iterate over the output while the command runs. With to_file,
+    output is written by the shell to that path (relative to the mount) instead of being returned, so it never passes
+    through Python.
+
+    With cache=True, a successful result is cached on disk, keyed on the sidecar image, the command, and the contents of
+    the `inputs` paths. Later calls with the same key restore the `outputs` paths and return the cached result instead
+    of running the command. Input and output paths are relative to the mount.
     """
+    if stream and to_file is not None:
+        raise ValueError("sidecar_shell can either stream output or write it to_file, not both.")
+    if cache:
+        if stream:
+            raise ValueError("Streamed sidecar_shell output can't be cached.")
+        if to_file is not None:
+            outputs = [*outputs, to_file]
+        return cached_sidecar_shell(
+            sidecar=redirected_sidecar(shell_call=True, command=command),
+            run_command=functools.partial(sidecar_shell, to_file=to_file),
+            command=command,
+            kwargs=kwargs,
+            inputs=list(inputs),
+            outputs=list(outputs),
+        )
+    if inputs or outputs:
+        raise ValueError("sidecar_shell inputs and outputs are only used by the result cache. Pass cache=True.")
+    if stream:
+        return stream_sidecar_shell(command, **kwargs)
+    if to_file is not None:
+        result = sidecar_shell(f"( {command}\n) > {shlex.quote(to_file)} 2>&1", **kwargs)
+        return subprocess.CompletedProcess(command, result.returncode, None)
+    sidecar = redirected_sidecar(shell_call=True, command=command)
+    if sidecar is not None:
+        return sidecar.redirect(sidecar_shell, (command,), kwargs)
     result = subprocess.run(
         command,
         text=True,
@@ -14,3 +115,63 @@ def sidecar_shell(command, **kwargs):
         **kwargs,
     )
     return result
+
+
+def timed_sidecar_shell(command, kwargs):
+    started_at = time.monotonic()
+    result = sidecar_shell(command, **kwargs)
+    result.duration = time.monotonic() - started_at
+    return result
+
+
+def iterate_as_completed(executor, futures):
+    try:
+        for future in as_completed(futures):
+            yield futures[future], future.result()
+    finally:
+        for future in futures:
+            future.cancel()
+        executor.shutdown()
+
+
+def sidecar_shell_many(commands, max_concurrency=None, yield_as_completed=False, **kwargs):
+    """
+    Runs shell commands concurrently in the sidecar container, with at most max_concurrency (by default, the number of
+    CPUs) running at a time. Other keyword arguments are passed to every lug.sidecar_shell call.
+
+    Returns the results in the same order as the commands. With yield_as_completed=True, returns an iterator of
+    (index, result) pairs instead, in the order that commands finish. Each result's `duration` is the number of seconds
+    its command took, including time spent starting it in the container.
+    """
+    commands = list(commands)
+    executor = ThreadPoolExecutor(
+        max_workers=max_concurrency or os.cpu_count() or 1,
+        thread_name_prefix="lug-sidecar-shell",
+    )
+    # Each command runs in a copy of the caller's context, so it's redirected to the caller's sidecar
+    futures = {
+        executor.submit(contextvars.copy_context().run, timed_sidecar_shell, command, kwargs): index
+        for index, command in enumerate(commands)
+    }
+    if yield_as_completed:
+        return iterate_as_completed(executor, futures)
+    try:
+        return [future.result() for future in futures]
+    finally:
+        for future in futures:
+            future.cancel()
+        executor.shutdown()
+
+
+async def sidecar_shell_async(command, **kwargs):
+    """
+    An awaitable lug.sidecar_shell, so a lugged coroutine can run many commands in the sidecar container concurrently.
+    """
+    sidecar = redirected_sidecar(shell_call=True, command=command)
+    shell_kwargs = dict(stdout=subprocess.PIPE, stderr=subprocess.STDOUT, **kwargs)
+    if sidecar is not None:
+        process = await sidecar.redirect_async((command,), shell_kwargs, using_shell=True)
+    else:
+        process = await asyncio.create_subprocess_shell(command, **shell_kwargs)
+    stdout, _ = await process.communicate()
+    return subprocess.CompletedProcess(command, process.returncode, stdout.decode(), None)
@@ -0,0 +1,173 @@
+import os
+import sys
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import cloudpickle
+
+from .package_index import get_package_index
+
+# Below this many unclassified modules, a thread pool costs more than it saves
+MIN_MODULES_FOR_THREAD_POOL = 8
+
+_classifications = dict()  # module name: (module, origin mtime, package index, classification)
+_classifications_lock = threading.Lock()
+# Trial pickles register modules by value process-wide, so they can't overlap
+_trial_pickle_lock = threading.Lock()
+
+
+def can_be_pickled(module):
+    # The module must be referenced inside the function to actually test if it can be pickled
+    def dummy_function_using_module(x):
+        return module.__name__
+
+    with _trial_pickle_lock:
+        try:
+            cloudpickle.register_pickle_by_value(module)
+            cloudpickle.dumps(dummy_function_using_module)
+            return True
+        except Exception:
+            return False
+        finally:
+            cloudpickle.unregister_pickle_by_value(module)
+
+
+def origin_mtime(module):
+    try:
+        return os.stat(module.__spec__.origin).st_mtime_ns
+    except (AttributeError, OSError, TypeError):
+        return None
+
+
+class ModuleClassification:
+    """
+    How a module is sent with a lugged function:
+
+    - "skip": modules without a spec, which are left to cloudpickle
+    - "pickle": pickled by value
+    - "pip": installed with pip, as `pip_versions` ({distribution name: version})
+    - "copy": copied from `location`
+    - "native": includes native extensions but isn't an installed distribution, so it can't be sent
+
+    Submodules are classified by their parent package, which is named by `package_name`.
+    """
+    def __init__(self, kind, package_name=None, child=None, pip_versions=None, location=None):
+        self.kind = kind
+        self.package_name = package_name
+        self.child = child
+        self.pip_versions = pip_versions
+        self.location = location
+
+    def __repr__(self):
+        return f"<Lug ModuleClassification {self.kind} {self.package_name}>"
+
+
+def classify_module(module, package_index):
+    if not module.__spec__:
+        return ModuleClassification("skip")
+
+    # Find physical location of module source
+    parent = module.__spec__.name.rpartition(".")[0]
+    child = None
+    if parent:
+        child = module
+        module = sys.modules[parent]
+    submodule_search_locations = module.__spec__.submodule_search_locations
+    loader_path = getattr(module.__spec__.loader, "path", None)
+    # todo: handle multiple submodule search locations
+    primary_location = (submodule_search_locations and submodule_search_locations[0]) or loader_path
+
+    has_so_files = False
+    if primary_location:
+        # Modules with a location on disk are never pickled, so the trial pickle is skipped
+        adjusted_primary_location = os.path.dirname(primary_location) if primary_location.endswith(".py") \
+            else primary_location
+
+        # Check if the package contains any CPython compiled files (e.g. numpy, scipy, etc)
+        has_so_files = package_index.module_has_native_extensions(module.__name__, adjusted_primary_location)
+    elif can_be_pickled(child or module):
+        return ModuleClassification("pickle", package_name=module.__name__, child=child)
+
+    try:
+        pip_names = package_index.distributions(module.__name__)
+    except KeyError:
+        if has_so_files:
+            return ModuleClassification("native", package_name=module.__name__, child=child)
+        return ModuleClassification("copy", package_name=module.__name__, child=child, location=primary_location)
+    pip_versions = dict()
+    for pip_name in pip_names:
+        # Drop local version identifiers (e.g. "+cu117" in "torch==1.13.1+cu117")
+        if hasattr(module, "__version__"):
+            public_version = module.__version__.split("+")[0]
+        else:
+            public_version = package_index.version(pip_name).split("+")[0]
+        pip_versions[pip_name] = public_version
+    return ModuleClassification("pip", package_name=module.__name__, child=child, pip_versions=pip_versions)
+
+
+def get_module_classifications(modules):
+    """
+    Classifies how each module is sent. Classifications are memoized per module, until the module's file changes or
+    the installed distributions do, and modules that aren't classified yet are classified in a thread pool.
+    """
+    package_index = get_package_index()
+    classifications = dict()
+    unclassified_modules = []
+    for module in modules:
+        mtime = origin_mtime(module)
+        with _classifications_lock:
+            entry = _classifications.get(module.__name__)
+        if entry is not None and entry[0] is module and entry[1] == mtime and entry[2] is package_index:
+            classifications[module] = entry[3]
+        else:
+            unclassified_modules.append((module, mtime))
+
+    def classify(module_and_mtime):
+        module, mtime = module_and_mtime
+        classification = classify_module(module, package_index)
+        with _classifications_lock:
+            _classifications[module.__name__] = (module, mtime, package_index, classification)
+        return module, classification
+
+    if len(unclassified_modules) < MIN_MODULES_FOR_THREAD_POOL:
+        classifications.update(map(classify, unclassified_modules))
+    else:
+        with ThreadPoolExecutor(thread_name_prefix="lug-classify") as executor:
+            classifications.update(executor.map(classify, unclassified_modules))
+    return classifications
+
+
+def find_module_transferability(modules):
+    children_to_ignore = set()
+    copyable_packages = set()
+    uncopyable_packages = set()
+    uncopyable_pip_names = dict()  # package_name: version # todo: filter out packages that can't be installed with pip
+    # Split pickleable and unpickleable packages
+    for classification in get_module_classifications(modules).values():
+        if classification.kind == "pip":
+            uncopyable_pip_names.update(classification.pip_versions)
+            uncopyable_packages.add(classification.package_name)
+            # Make sure we know not to copy the child if present (e.g. lug and lug.run)
+            if classification.child:
+                uncopyable_packages.add(classification.child.__name__)
+                children_to_ignore.add(classification.child)
+        elif classification.kind == "copy":
+            # Add to packages that need to be manually copied
+            copyable_packages.add(classification.location)
+            children_to_ignore.add(classification.child)
+        elif classification.kind == "native":
+            raise ModuleNotFoundError(f"'{classification.package_name}' distribution info not found on this machine.")
+
+    # Prune copyable packages that are a subdirectory of another package
+    # I'm assuming the copyable_packages set will be tiny; optimizing for clarity rather than performance
+    for package_a in copyable_packages.copy():
+        for package_b in copyable_packages:
+            if package_a == package_b:
+                continue
+            # Assuming all absolute paths, no symlinks. If not, we should use proper parent finding.
+            is_child = package_a.startswith(package_b) and len(package_a.split(package_b)) > 1
+            if is_child:
+                copyable_packages.remove(package_a)
+                break
+
+    return uncopyable_packages, uncopyable_pip_names, copyable_packages, children_to_ignore
@@ -0,0 +1,97 @@
+"""Tests leasing sidecar containers from a warm container pool"""
+import subprocess
+import time
+import types
+
+import pytest
+
+import lug
+import lug.lug
+from lug.pool import ContainerPool, get_container_pool
+BASE_TEST_IMAGE = "alpine:3.16.2"
+
+
+@lug.run(image=BASE_TEST_IMAGE, warm_pool=True)
+def pooled_hostname():
+    result = subprocess.run("hostname; sleep 600 &", capture_output=True, text=True, shell=True)
+    return result.stdout
+
+
+@lug.run(image=BASE_TEST_IMAGE, warm_pool=True)
+def pooled_sleep_count():
+    result = subprocess.run("ps | grep -c '[s]leep 600'", capture_output=True, text=True, shell=True)
+    return int(result.stdout)
+
+
+@pytest.mark.unit
+def test_container_is_reused():
+    first_hostname = pooled_hostname()
+    second_hostname = pooled_hostname()
+    assert first_hostname == second_hostname
+
+
+@pytest.mark.unit
+def test_container_is_reset_between_leases():
+    pooled_hostname()
+    # The background sleep started by the previous lease is killed when the container is released
+    assert pooled_sleep_count() == 0
+
+
+@pytest.mark.unit
+def test_pools_are_keyed_by_their_options():
+    client = types.SimpleNamespace(api=types.SimpleNamespace(base_url="http+docker://pool-options-test"))
+    small_pool = get_container_pool(client, BASE_TEST_IMAGE, "/tmp", "/bin/sh", min_size=0, max_size=1, idle_ttl=60)
+    assert get_container_pool(client, BASE_TEST_IMAGE, "/tmp", "/bin/sh", min_size=0, max_size=1, idle_ttl=60) \
+        is small_pool
+    large_pool = get_container_pool(client, BASE_TEST_IMAGE, "/tmp", "/bin/sh", min_size=0, max_size=8, idle_ttl=60)
+    assert large_pool is not small_pool
+    assert (small_pool.max_size, large_pool.max_size) == (1, 8)
+
+
+@pytest.mark.unit
+def test_failed_lease_error_propagates(monkeypatch):
+    class FailingPool:
+        def lease(self):
+            raise OSError("image pull failed")
+
+        def release(self, user_docker):
+            raise AssertionError("Nothing was leased, so nothing is released")
+
+    monkeypatch.setattr(lug.lug.docker, "from_env", lambda: None)
+    monkeypatch.setattr(lug.lug, "get_container_pool", lambda **pool_options: FailingPool())
+    with pytest.raises(OSError, match="image pull failed"):
+        pooled_hostname()
+
+
+@pytest.mark.unit
+def test_idle_containers_evicted_without_leases():
+    pool = ContainerPool(None, BASE_TEST_IMAGE, "/tmp", "/bin/sh", idle_ttl=0.05)
+    torn_down = []
+    pool.teardown_container = torn_down.append
+    idle_docker = types.SimpleNamespace(container=object())
+    pool.release(idle_docker, reset=False)
+    deadline = time.monotonic() + 5
+    while not torn_down and time.monotonic() < deadline:
+        time.sleep(0.01)
+    pool.shutdown()
+    assert torn_down == [idle_docker]
+    assert pool.idle_containers == []
+
+
+@pytest.mark.unit
+def test_reset_off_the_return_path():
+    pool = ContainerPool(None, BASE_TEST_IMAGE, "/tmp", "/bin/sh")
+
+    def slow_reset(user_docker):
+        time.sleep(0.2)
+        return True
+
+    pool.reset_container = slow_reset
+    pooled_docker = types.SimpleNamespace(container=object(), is_running=lambda: True)
+    released_at = time.monotonic()
+    pool.release(pooled_docker)
+    assert time.monotonic() - released_at < 0.1
+    # Leasing waits for the reset instead of starting a new container
+    assert pool.lease() is pooled_docker
+    assert time.monotonic() - released_at >= 0.2
+    pool.shutdown()
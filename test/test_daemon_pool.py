@@ -0,0 +1,58 @@
+"""Tests scheduling local sidecar calls across a pool of Docker daemons"""
+import subprocess
+
+import pytest
+
+import lug
+from lug.daemons import DaemonPool
+BASE_TEST_IMAGE = "alpine:3.16.2"
+# The same daemon twice, standing in for two build hosts
+DOCKER_HOSTS = ["unix:///var/run/docker.sock", "unix:///var/run/docker.sock"]
+
+
+class HealthCheckedPool(DaemonPool):
+    """A pool whose daemons' health is set by the test instead of checked over the network."""
+    def __init__(self, healthy_hosts, **pool_options):
+        super().__init__(["unix:///daemon-a.sock", "unix:///daemon-b.sock"], **pool_options)
+        self.healthy_hosts = healthy_hosts
+        for daemon in self.daemons:
+            daemon.is_healthy = lambda daemon=daemon: daemon.docker_host in self.healthy_hosts
+            daemon.client = object()
+
+
+@lug.run(image=BASE_TEST_IMAGE, docker_hosts=DOCKER_HOSTS)
+def pooled_uname():
+    return subprocess.run("uname", capture_output=True, text=True, shell=True).stdout
+
+
+@pytest.mark.unit
+def test_least_loaded_scheduling(monkeypatch):
+    monkeypatch.setattr("lug.daemons.image_index.is_cached", lambda client, image: False)
+    pool = HealthCheckedPool(healthy_hosts={"unix:///daemon-a.sock", "unix:///daemon-b.sock"})
+    first_daemon = pool.acquire(BASE_TEST_IMAGE)
+    second_daemon = pool.acquire(BASE_TEST_IMAGE)
+    assert first_daemon is not second_daemon
+    pool.release(first_daemon)
+    assert pool.acquire(BASE_TEST_IMAGE) is first_daemon
+
+
+@pytest.mark.unit
+def test_unhealthy_daemon_ejected(monkeypatch):
+    monkeypatch.setattr("lug.daemons.image_index.is_cached", lambda client, image: False)
+    pool = HealthCheckedPool(healthy_hosts={"unix:///daemon-a.sock", "unix:///daemon-b.sock"})
+    daemon = pool.acquire(BASE_TEST_IMAGE)
+    pool.healthy_hosts.discard(daemon.docker_host)
+    pool.release(daemon, failed=True)
+    assert all(pool.acquire(BASE_TEST_IMAGE) is not daemon for _ in range(3))
+
+    pool.healthy_hosts.clear()
+    for other_daemon in pool.daemons:
+        other_daemon.ejected_until = 0
+        other_daemon.consecutive_failures = 1
+    with pytest.raises(EnvironmentError):
+        pool.acquire(BASE_TEST_IMAGE)
+
+
+@pytest.mark.unit
+def test_pooled_calls():
+    assert [pooled_uname() for _ in range(3)] == ["Linux\n"] * 3
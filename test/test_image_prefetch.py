@@ -0,0 +1,27 @@
+"""Tests prefetching sidecar images and caching resolved images"""
+import docker
+import pytest
+
+import lug
+from lug.images import image_index
+BASE_TEST_IMAGE = "alpine:3.16.2"
+SECOND_TEST_IMAGE = "busybox:1.36"
+
+
+@lug.docker_sidecar(sidecar_image=SECOND_TEST_IMAGE, prefetch_image=True)
+def prefetched_sidecar():
+    return lug.sidecar_shell("echo prefetched").stdout
+
+
+@pytest.mark.unit
+def test_concurrent_prefetch_is_cached():
+    pulls = lug.prefetch_images([BASE_TEST_IMAGE, SECOND_TEST_IMAGE])
+    images = [pull.result() for pull in pulls]
+    client = docker.from_env()
+    assert image_index.resolve(client, BASE_TEST_IMAGE) is images[0]
+    assert image_index.resolve(client, SECOND_TEST_IMAGE) is images[1]
+
+
+@pytest.mark.unit
+def test_prefetch_at_decoration():
+    assert prefetched_sidecar() == "prefetched\n"
@@ -0,0 +1,33 @@
+"""Tests running the whole lugged function inside the sidecar container's Python"""
+import subprocess
+import sys
+
+import pytest
+
+import lug
+PYTHON_TEST_IMAGE = f"python:{sys.version_info.major}.{sys.version_info.minor}-slim"
+
+
+@lug.docker_sidecar(sidecar_image=PYTHON_TEST_IMAGE, execute_in_container=True)
+def os_release_in_container(number):
+    # Without a sidecar exec, this only shows the container's OS if the function itself runs inside the container
+    result = subprocess.run("cat /etc/os-release", capture_output=True, text=True, shell=True)
+    return number, result.stdout
+
+
+@lug.docker_sidecar(sidecar_image=PYTHON_TEST_IMAGE, execute_in_container=True)
+def working_directory_in_container():
+    import os
+    return os.getcwd()
+
+
+@pytest.mark.unit
+def test_function_runs_in_container():
+    number, os_release = os_release_in_container(4)
+    assert number == 4
+    assert "Debian GNU/Linux" in os_release
+
+
+@pytest.mark.unit
+def test_working_directory_is_mount():
+    assert working_directory_in_container() == "/lug"
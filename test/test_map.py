@@ -0,0 +1,72 @@
+"""Tests fanning out calls to a lugged function with .map()"""
+import subprocess
+
+import pytest
+
+import lug
+from lug.containers import partition_cpus
+BASE_TEST_IMAGE = "alpine:3.16.2"
+
+
+@lug.docker_sidecar(sidecar_image=BASE_TEST_IMAGE)
+def container_resources(number):
+    hostname = lug.sidecar_shell("hostname").stdout.strip()
+    omp_num_threads = lug.sidecar_shell("echo $OMP_NUM_THREADS").stdout.strip()
+    return number, hostname, omp_num_threads
+
+
+@lug.run(image=BASE_TEST_IMAGE)
+def square_in_sidecar(number):
+    result = subprocess.run(f"echo $(({number} * {number}))", capture_output=True, text=True, shell=True)
+    return int(result.stdout)
+
+
+@lug.hybrid()
+def square(number):
+    return number * number
+
+
+@pytest.mark.unit
+def test_partition_cpus():
+    assert partition_cpus(8, 3) == ["0-1", "2-4", "5-7"]
+    assert partition_cpus(4, 4) == ["0", "1", "2", "3"]
+    assert partition_cpus(2, 3) == ["0", "1", "0"]
+
+
+@pytest.mark.unit
+def test_map_in_order():
+    assert list(square_in_sidecar.map(range(10), workers=3)) == [number * number for number in range(10)]
+
+
+@pytest.mark.unit
+def test_map_across_containers():
+    results = list(container_resources.map(range(8), workers=2, mem_limit="256m"))
+    assert [number for number, _, _ in results] == list(range(8))
+    assert len({hostname for _, hostname, _ in results}) <= 2
+    assert all(omp_num_threads for _, _, omp_num_threads in results)
+
+
+@pytest.mark.unit
+def test_map_as_completed():
+    results = sorted(square.map(range(5), yield_as_completed=True))
+    assert results == [(number, number * number) for number in range(5)]
+
+
+@pytest.mark.unit
+def test_map_never_iterated(monkeypatch):
+    started_containers = []
+    monkeypatch.setattr(lug.lug.docker, "from_env", lambda: None)
+    monkeypatch.setattr(
+        lug.lug, "partitioned_resource_options", lambda client, workers, **options: [dict()] * workers,
+    )
+    monkeypatch.setattr(lug.lug, "start_containers", lambda user_dockers, **options: started_containers.extend(
+        user_dockers
+    ))
+    results = container_resources.map(range(4), workers=2)
+    del results
+    assert started_containers == []
+
+    calls = []
+    results = lug.hybrid()(calls.append).map(range(4))
+    del results
+    assert calls == []
@@ -0,0 +1,108 @@
+"""Tests finding dependencies from the names a function's bytecode uses"""
+import importlib
+import sys
+
+import idna
+import pytest
+import six
+
+from lug.module_detection import get_modules_to_register
+from .test_module_detection import lug_simulating_decorator
+
+
+def func_that_uses_idna():
+    return idna.encode('ドメイン.テスト')
+
+
+def func_that_uses_helper():
+    return lug_simulating_decorator
+
+
+class ClassWithMethodUsingSix:
+    def method(self):
+        return six
+
+
+def func_that_uses_class():
+    return ClassWithMethodUsingSix().method()
+
+
+def make_closure_over_six():
+    module = six
+    return lambda: module
+
+
+@pytest.fixture
+def cyclic_package(tmp_path):
+    """
+    A package that imports its submodule, which imports the package back (lug_test_cycle <-> lug_test_cycle.sub), and a
+    module whose function uses the submodule through the package
+    """
+    package_directory = tmp_path / "lug_test_cycle"
+    package_directory.mkdir()
+    (package_directory / "__init__.py").write_text("from . import sub\n")
+    (package_directory / "sub.py").write_text("import lug_test_cycle\n\n\ndef helper():\n    return 1\n")
+    (package_directory / "caller.py").write_text(
+        "import lug_test_cycle\n\n\ndef call_helper():\n    return lug_test_cycle.sub.helper()\n"
+    )
+    sys.path.insert(0, str(tmp_path))
+    try:
+        yield importlib.import_module("lug_test_cycle.caller")
+    finally:
+        sys.path.remove(str(tmp_path))
+        for module_name in list(sys.modules):
+            if module_name.startswith("lug_test_cycle"):
+                del sys.modules[module_name]
+
+
+def registered_module_names(func, dependency_mode):
+    return sorted(
+        module.__name__
+        for module in get_modules_to_register(func, dependency_mode=dependency_mode, modules_to_skip={"pytest"})
+    )
+
+
+@pytest.mark.unit
+def test_only_used_modules_registered():
+    # Everything the module references is registered by a globals search
+    assert "six" in registered_module_names(func_that_uses_idna, dependency_mode="globals")
+    assert registered_module_names(func_that_uses_idna, dependency_mode="bytecode") == [
+        'idna',
+        'idna.core',  # Defines idna.encode
+        'test_module_registration.test_bytecode_dependencies',
+    ]
+
+
+@pytest.mark.unit
+def test_used_functions_registered():
+    module_names = registered_module_names(func_that_uses_helper, dependency_mode="bytecode")
+    # Pytest's internals are used by the helper's rewritten assert
+    assert [module_name for module_name in module_names if not module_name.startswith("_pytest")] == [
+        'test_module_registration.test_bytecode_dependencies',
+        'test_module_registration.test_module_detection',
+    ]
+
+
+@pytest.mark.unit
+def test_class_methods_analyzed():
+    assert registered_module_names(func_that_uses_class, dependency_mode="bytecode") == [
+        'six',
+        'test_module_registration.test_bytecode_dependencies',
+    ]
+
+
+@pytest.mark.unit
+def test_closure_analyzed():
+    assert registered_module_names(make_closure_over_six(), dependency_mode="bytecode") == [
+        'six',
+        'test_module_registration.test_bytecode_dependencies',
+    ]
+
+
+@pytest.mark.unit
+def test_module_cycle_analyzed_once(cyclic_package):
+    assert registered_module_names(cyclic_package.call_helper, dependency_mode="bytecode") == [
+        'lug_test_cycle',
+        'lug_test_cycle.caller',
+        'lug_test_cycle.sub',
+    ]
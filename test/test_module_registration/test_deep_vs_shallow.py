@@ -3,6 +3,13 @@ import pytest
 
 from .test_module_detection import lug_simulating_decorator
 
+# Every top-level package that a deep search from docker may register: docker, the distributions it depends on
+# (directly or through requests), and the test modules. Registering anything else is over-shipping.
+DEEP_SEARCH_UPPER_BOUND = frozenset({
+    "_pytest", "certifi", "chardet", "charset_normalizer", "docker", "idna", "packaging", "requests",
+    "test_module_registration", "typing_extensions", "urllib3", "websocket",
+})
+
 
 def func_that_uses_docker():
     return docker
@@ -25,36 +32,27 @@ def test_module_detection_docker_shallow():
 
 @pytest.mark.unit
 def test_module_detection_docker_deep():
-    wrapped_func = lug_simulating_decorator(
-        func=func_that_uses_docker,
-        assert_module_names=[
-            '_pytest.assertion.rewrite',
-            'docker',
-            'docker.api',
-            'docker.constants',
-            'docker.context',
-            'docker.context.config',
-            'docker.errors',
-            'docker.tls',
-            'docker.transport.basehttpadapter',
-            'docker.types',
-            'docker.utils.config',
-            'http.client',
-            'importlib.metadata',
-            'json.decoder',
-            'lug.module_detection',
-            'packaging.version',
-            'posixpath',
-            'requests',
-            'requests.adapters',
-            'requests.exceptions',
-            'test_module_registration.test_deep_vs_shallow',
-            'test_module_registration.test_module_detection',
-            'urllib.parse',
-            'urllib3',
-            'websocket'
-        ],
+    from lug.module_detection import get_modules_to_register
+
+    modules_to_skip = frozenset({"pytest", "lug", "cloudpickle"})  # exclude docker from skip list
+    shallow_module_names = {module.__name__ for module in get_modules_to_register(
+        func_that_uses_docker,
+        modules_to_skip=modules_to_skip,
+    )}
+    deep_module_names = {module.__name__ for module in get_modules_to_register(
+        func_that_uses_docker,
         deep=True,
-        modules_to_skip=frozenset({"pytest", "lug", "cloudpickle"})  # exclude docker from skip list
-    )
-    assert wrapped_func() == docker
+        modules_to_skip=modules_to_skip,
+    )}
+    assert shallow_module_names < deep_module_names
+    # Found transitively: docker imports .api, which imports .service
+    assert {"docker.api", "docker.api.service", "docker.errors"} <= deep_module_names
+    # Found through other distributions: docker imports requests, which imports urllib3.util.retry
+    assert {"requests", "requests.adapters", "urllib3", "urllib3.util.retry", "websocket"} <= deep_module_names
+    # Stdlib and skipped modules aren't registered
+    assert not {"http.client", "json.decoder", "lug.module_detection"} & deep_module_names
+    # Nothing outside of docker's dependencies is registered, including the other test modules that are loaded
+    assert {module_name.partition(".")[0] for module_name in deep_module_names} <= DEEP_SEARCH_UPPER_BOUND
+    assert {
+        module_name for module_name in deep_module_names if module_name.startswith("test_module_registration")
+    } == {"test_module_registration.test_deep_vs_shallow", "test_module_registration.test_module_detection"}
@@ -0,0 +1,36 @@
+"""Tests memoizing the dependency analysis of lugged functions"""
+import sys
+import types
+
+import pytest
+
+import lug
+from lug.lug import analyze_dependencies
+
+
+def function_using_lug():
+    return lug.__name__
+
+
+@pytest.mark.unit
+def test_analysis_reused():
+    lug.clear_dependency_cache()
+    first_analysis = analyze_dependencies(function_using_lug)
+    assert analyze_dependencies(function_using_lug) is first_analysis
+
+
+@pytest.mark.unit
+def test_analysis_redone_after_import():
+    first_analysis = analyze_dependencies(function_using_lug)
+    sys.modules["lug_test_newly_imported_module"] = types.ModuleType("lug_test_newly_imported_module")
+    try:
+        assert analyze_dependencies(function_using_lug) is not first_analysis
+    finally:
+        del sys.modules["lug_test_newly_imported_module"]
+
+
+@pytest.mark.unit
+def test_analysis_redone_after_clear():
+    first_analysis = analyze_dependencies(function_using_lug)
+    lug.clear_dependency_cache(function_using_lug)
+    assert analyze_dependencies(function_using_lug) is not first_analysis
@@ -0,0 +1,114 @@
+"""Tests tracing the modules a function imports for dependency_mode="trace\""""
+import importlib
+import os
+import subprocess
+import sys
+import threading
+
+import pytest
+
+import lug
+from lug.dependency_trace import ImportTracer, stable_function_fingerprint, traced_dependencies
+from lug.lug import analyze_dependencies
+
+
+def func_with_lazy_import(value):
+    import six
+    return six.ensure_str(value)
+
+
+def func_without_imports(value):
+    return value
+
+
+def func_with_set_constant(value):
+    # The set is compiled to a frozenset constant, whose order differs between processes
+    return value in {"alpha", "beta", "gamma", "delta"}
+
+
+@pytest.fixture(autouse=True)
+def cache_dir(tmp_path, monkeypatch):
+    monkeypatch.setenv("LUG_CACHE_DIR", str(tmp_path / "cache"))
+    lug.clear_dependency_cache()
+    return tmp_path / "cache"
+
+
+@pytest.mark.unit
+def test_lazy_import_traced(cache_dir):
+    assert traced_dependencies(func_with_lazy_import) is None
+    assert lug.trace_dependencies(func_with_lazy_import, b"traced") == "traced"
+    module_names = {module.__name__ for module in traced_dependencies(func_with_lazy_import)}
+    assert module_names == {"six", "test_module_registration.test_dependency_trace"}
+    assert len(list(cache_dir.glob("traces/*.json"))) == 1
+
+
+@pytest.mark.unit
+def test_untraced_function_not_run_by_analysis():
+    with pytest.raises(ValueError, match="hasn't been traced"):
+        analyze_dependencies(func_with_lazy_import, "trace")
+    assert traced_dependencies(func_with_lazy_import) is None
+    lug.trace_dependencies(func_with_lazy_import, b"traced")
+    modules_to_register = analyze_dependencies(func_with_lazy_import, "trace")[0]
+    assert "six" in {module.__name__ for module in modules_to_register}
+
+
+@pytest.mark.unit
+def test_module_cycle_traced(tmp_path):
+    package_directory = tmp_path / "lug_test_trace_cycle"
+    package_directory.mkdir()
+    (package_directory / "__init__.py").write_text("from . import sub\n")
+    (package_directory / "sub.py").write_text("import lug_test_trace_cycle\n\n\ndef helper():\n    return 1\n")
+    (package_directory / "caller.py").write_text(
+        "import lug_test_trace_cycle\n\n\ndef call_helper():\n    return lug_test_trace_cycle.sub.helper()\n"
+    )
+    sys.path.insert(0, str(tmp_path))
+    try:
+        caller = importlib.import_module("lug_test_trace_cycle.caller")
+        assert lug.trace_dependencies(caller.call_helper) == 1
+        assert {module.__name__ for module in traced_dependencies(caller.call_helper)} >= {
+            "lug_test_trace_cycle", "lug_test_trace_cycle.sub",
+        }
+    finally:
+        sys.path.remove(str(tmp_path))
+        for module_name in list(sys.modules):
+            if module_name.startswith("lug_test_trace_cycle"):
+                del sys.modules[module_name]
+
+
+@pytest.mark.unit
+def test_fingerprint_stable_per_code():
+    test_directory = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    fingerprint_script = (
+        "from lug.dependency_trace import stable_function_fingerprint\n"
+        "from test_module_registration import test_dependency_trace as functions\n"
+        "print(stable_function_fingerprint(functions.func_with_lazy_import))\n"
+        "print(stable_function_fingerprint(functions.func_with_set_constant))\n"
+    )
+    for hash_seed in ["1", "2"]:
+        # Each process hashes strings with its own seed, like separate runs of a script do
+        fingerprints = subprocess.run(
+            [sys.executable, "-c", fingerprint_script],
+            cwd=test_directory,
+            env={**os.environ, "PYTHONHASHSEED": hash_seed},
+            capture_output=True,
+            text=True,
+            check=True,
+        ).stdout.split()
+        assert fingerprints == [
+            stable_function_fingerprint(func_with_lazy_import), stable_function_fingerprint(func_with_set_constant),
+        ]
+    assert stable_function_fingerprint(func_with_lazy_import) != stable_function_fingerprint(func_without_imports)
+
+
+@pytest.mark.unit
+def test_tracer_ignores_other_threads():
+    def import_in_thread():
+        import wave  # noqa: F401
+
+    with ImportTracer() as tracer:
+        thread = threading.Thread(target=import_in_thread)
+        thread.start()
+        thread.join()
+        import colorsys  # noqa: F401
+    assert "colorsys" in tracer.imported_module_names
+    assert "wave" not in tracer.imported_module_names
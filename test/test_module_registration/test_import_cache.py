@@ -0,0 +1,63 @@
+"""Tests caching the imports extracted from Python files for deep dependency search"""
+import os
+
+import pytest
+
+import lug.import_cache
+from lug.import_cache import extract_imports, get_imports_by_file
+
+IMPORTS = ["os", "sys", "json", "json.loads", ".", ".sibling", "docker.errors"]
+
+
+@pytest.fixture
+def cache_dir(tmp_path, monkeypatch):
+    monkeypatch.setenv("LUG_CACHE_DIR", str(tmp_path / "cache"))
+    monkeypatch.setattr(lug.import_cache, "_imports_by_file", dict())
+    return tmp_path / "cache"
+
+
+@pytest.fixture
+def python_file(tmp_path):
+    python_file = tmp_path / "module.py"
+    python_file.write_text(
+        "import os, sys\nfrom json import loads\nfrom . import sibling\n\ndef f():\n    import docker.errors\n"
+    )
+    return str(python_file)
+
+
+@pytest.mark.unit
+def test_extract_imports(python_file):
+    assert extract_imports(python_file) == IMPORTS
+
+
+@pytest.mark.unit
+def test_imports_cached_on_disk(cache_dir, python_file, monkeypatch):
+    assert get_imports_by_file([python_file]) == {python_file: IMPORTS}
+    assert len(list(cache_dir.glob("imports/*/*.json"))) == 1
+
+    # Another process reads the imports from disk instead of parsing the file
+    monkeypatch.setattr(lug.import_cache, "_imports_by_file", dict())
+    monkeypatch.setattr(lug.import_cache, "extract_imports", lambda path: pytest.fail("File was parsed again"))
+    assert get_imports_by_file([python_file]) == {python_file: IMPORTS}
+
+
+@pytest.mark.unit
+def test_modified_file_parsed_again(cache_dir, python_file):
+    get_imports_by_file([python_file])
+    with open(python_file, "a") as appended_file:
+        appended_file.write("import subprocess\n")
+    os.utime(python_file, ns=(0, 0))
+    assert get_imports_by_file([python_file])[python_file] == IMPORTS[:-1] + ["subprocess", "docker.errors"]
+
+
+@pytest.mark.unit
+def test_many_files_parsed_in_process_pool(cache_dir, tmp_path):
+    python_files = []
+    for index in range(lug.import_cache.MIN_FILES_FOR_PROCESS_POOL + 1):
+        python_file = tmp_path / f"module_{index}.py"
+        python_file.write_text(f"import module_{index + 1}\n")
+        python_files.append(str(python_file))
+    imports_by_file = get_imports_by_file(python_files)
+    assert [imports_by_file[python_file] for python_file in python_files] == [
+        [f"module_{index + 1}"] for index in range(len(python_files))
+    ]
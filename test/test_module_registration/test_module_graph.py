@@ -0,0 +1,100 @@
+"""Tests the module dependency graph shared by dependency searches"""
+import importlib
+import os
+import sys
+
+import pytest
+
+import lug.module_detection
+from lug.module_detection import get_modules_to_register, module_graph, module_python_files
+
+CHAIN_LENGTH = 6
+
+
+@pytest.fixture
+def module_chain(tmp_path):
+    """A package whose modules each call a function from the next one: lug_test_chain.m0 -> m1 -> ... -> m5"""
+    package_directory = tmp_path / "lug_test_chain"
+    package_directory.mkdir()
+    (package_directory / "__init__.py").write_text("")
+    for index in range(CHAIN_LENGTH):
+        if index < CHAIN_LENGTH - 1:
+            source = f"from .m{index + 1} import f as next_f\n\n\ndef f():\n    return next_f()\n\n\n"
+            source += "def g():\n    return 0\n"
+        else:
+            source = "def f():\n    return 1\n"
+        (package_directory / f"m{index}.py").write_text(source)
+    sys.path.insert(0, str(tmp_path))
+    try:
+        yield importlib.import_module("lug_test_chain.m0")
+    finally:
+        sys.path.remove(str(tmp_path))
+        for module_name in list(sys.modules):
+            if module_name.startswith("lug_test_chain"):
+                del sys.modules[module_name]
+        module_graph.clear()
+
+
+@pytest.mark.unit
+def test_transitive_dependencies(module_chain):
+    module_names = {module.__name__ for module in get_modules_to_register(module_chain.f)}
+    assert {f"lug_test_chain.m{index}" for index in range(CHAIN_LENGTH)} <= module_names
+
+
+@pytest.mark.unit
+def test_graph_reused_across_functions(module_chain, monkeypatch):
+    get_modules_to_register(module_chain.f)
+
+    searched_namespaces = []
+
+    def counting_namespace_edges(namespace):
+        searched_namespaces.append(namespace.get("__name__"))
+        return namespace_edges(namespace)
+
+    namespace_edges = lug.module_detection.namespace_edges
+    monkeypatch.setattr(lug.module_detection, "namespace_edges", counting_namespace_edges)
+    module_names = {module.__name__ for module in get_modules_to_register(module_chain.g)}
+    assert "lug_test_chain.m5" in module_names
+    # Only the function's own globals are scanned; every module's edges come from the graph
+    assert searched_namespaces == ["lug_test_chain.m0"]
+
+
+@pytest.mark.unit
+def test_reloaded_module_searched_again(module_chain):
+    get_modules_to_register(module_chain.f)
+    last_module = sys.modules[f"lug_test_chain.m{CHAIN_LENGTH - 1}"]
+    with open(last_module.__file__, "a") as last_module_file:
+        last_module_file.write("import six\n")
+    importlib.reload(last_module)
+    module_names = {module.__name__ for module in get_modules_to_register(module_chain.f)}
+    assert "six" in module_names
+
+
+@pytest.mark.unit
+def test_package_files_include_one_level_of_subdirectories(tmp_path):
+    package_directory = tmp_path / "lug_test_nested"
+    (package_directory / "sub" / "deeper").mkdir(parents=True)
+    for relative_path in ["__init__.py", "a.py", "sub/__init__.py", "sub/b.py", "sub/deeper/c.py"]:
+        (package_directory / relative_path).write_text("")
+    sys.path.insert(0, str(tmp_path))
+    try:
+        package = importlib.import_module("lug_test_nested")
+        python_files = {
+            os.path.relpath(python_file, package_directory): relative_package
+            for python_file, relative_package in module_python_files(package).items()
+        }
+        # Files in subdirectories resolve relative imports against their subpackage, and deeper files aren't searched
+        assert python_files == {
+            "__init__.py": "lug_test_nested",
+            "a.py": "lug_test_nested",
+            os.path.join("sub", "__init__.py"): "lug_test_nested.sub",
+            os.path.join("sub", "b.py"): "lug_test_nested.sub",
+        }
+        assert module_python_files(importlib.import_module("lug_test_nested.a")) == {
+            str(package_directory / "a.py"): "lug_test_nested",
+        }
+    finally:
+        sys.path.remove(str(tmp_path))
+        for module_name in list(sys.modules):
+            if module_name.startswith("lug_test_nested"):
+                del sys.modules[module_name]
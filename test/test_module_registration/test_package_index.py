@@ -0,0 +1,77 @@
+"""Tests the persisted module to distribution to version index"""
+import os
+
+import pytest
+
+import lug.package_index
+from lug.package_index import PackageIndex, get_package_index, scan_for_native_extensions
+
+
+@pytest.fixture
+def cache_dir(tmp_path, monkeypatch):
+    monkeypatch.setenv("LUG_CACHE_DIR", str(tmp_path))
+    monkeypatch.setattr(lug.package_index, "_package_index", None)
+    return tmp_path
+
+
+@pytest.mark.unit
+def test_index_contents(cache_dir):
+    index = get_package_index()
+    assert index.distributions("cloudpickle") == ["cloudpickle"]
+    assert index.version("cloudpickle")
+    assert index.has_native_extensions("cloudpickle") is False
+    with pytest.raises(KeyError):
+        index.distributions("lug_test_module_that_does_not_exist")
+
+
+@pytest.mark.unit
+def test_index_persisted(cache_dir, monkeypatch):
+    get_package_index()
+    index_files = os.listdir(cache_dir / "package-index")
+    assert len(index_files) == 1
+
+    # A new process loads the persisted index instead of scanning installed distributions
+    monkeypatch.setattr(lug.package_index, "_package_index", None)
+    monkeypatch.setattr(PackageIndex, "build", classmethod(lambda cls: pytest.fail("Index was rebuilt")))
+    assert get_package_index().version("cloudpickle")
+
+
+@pytest.mark.unit
+def test_index_serialization():
+    index = PackageIndex({"yaml": ["PyYAML"]}, {"PyYAML": "6.0"}, {"PyYAML": True})
+    loaded_index = PackageIndex.from_json(index.to_json())
+    assert loaded_index.distributions("yaml") == ["PyYAML"]
+    assert loaded_index.version("PyYAML") == "6.0"
+    assert loaded_index.has_native_extensions("PyYAML") is True
+
+
+@pytest.mark.unit
+@pytest.mark.parametrize("file_name", ["_speedups.cpython-311-x86_64-linux-gnu.so", "_speedups.pyd", "libblas.dylib"])
+def test_scan_finds_native_extensions(tmp_path, file_name):
+    nested_directory = tmp_path / "package" / "subpackage"
+    nested_directory.mkdir(parents=True)
+    (tmp_path / "package" / "__init__.py").write_text("")
+    (nested_directory / file_name).write_text("")
+    assert scan_for_native_extensions(str(tmp_path / "package"))
+
+
+@pytest.mark.unit
+def test_scan_without_native_extensions(tmp_path):
+    (tmp_path / "__init__.py").write_text("")
+    (tmp_path / "__pycache__").mkdir()
+    (tmp_path / "__pycache__" / "ignored.so").write_text("")
+    assert not scan_for_native_extensions(str(tmp_path))
+
+
+@pytest.mark.unit
+def test_native_extensions_from_record(tmp_path):
+    index = PackageIndex(
+        {"native": ["native-dist"], "pure": ["pure-dist"]},
+        {},
+        {"native-dist": True, "pure-dist": False},
+    )
+    # Distributions are checked by their RECORD, without walking the (here, empty) directory
+    assert index.module_has_native_extensions("native", str(tmp_path))
+    assert not index.module_has_native_extensions("pure", str(tmp_path))
+    (tmp_path / "local.so").write_text("")
+    assert index.module_has_native_extensions("local_module", str(tmp_path))
@@ -0,0 +1,49 @@
+"""Tests classifying how modules are sent with a lugged function"""
+import sys
+
+import docker  # noqa: F401 (classified below, with its submodules)
+import pytest
+import six
+
+import lug.transferability
+from lug.package_index import get_package_index
+from lug.transferability import classify_module, find_module_transferability, get_module_classifications
+
+
+@pytest.fixture(autouse=True)
+def empty_classifications(monkeypatch):
+    monkeypatch.setattr(lug.transferability, "_classifications", dict())
+
+
+@pytest.mark.unit
+def test_module_transferability():
+    this_module = sys.modules[__name__]
+    uncopyable_packages, uncopyable_pip_names, copyable_packages, _ = find_module_transferability({six, this_module})
+    assert uncopyable_packages == {"six"}
+    assert uncopyable_pip_names == {"six": six.__version__}
+    assert len(copyable_packages) == 1 and copyable_packages.pop().endswith("test_module_registration")
+
+
+@pytest.mark.unit
+def test_trial_pickle_skipped_for_modules_on_disk(monkeypatch):
+    monkeypatch.setattr(lug.transferability, "can_be_pickled", lambda module: pytest.fail("Module was trial pickled"))
+    assert get_module_classifications({six})[six].kind == "pip"
+
+
+@pytest.mark.unit
+def test_classifications_memoized(monkeypatch):
+    first_classification = get_module_classifications({six})[six]
+    monkeypatch.setattr(lug.transferability, "classify_module", lambda *args: pytest.fail("Module was classified"))
+    assert get_module_classifications({six})[six] is first_classification
+
+
+@pytest.mark.unit
+def test_many_modules_classified_in_thread_pool():
+    modules = {module for module in list(sys.modules.values()) if module.__name__.startswith("docker")}
+    assert len(modules) >= lug.transferability.MIN_MODULES_FOR_THREAD_POOL
+    classifications = get_module_classifications(modules)
+    package_index = get_package_index()
+    for module in modules:
+        sequential_classification = classify_module(module, package_index)
+        assert classifications[module].kind == sequential_classification.kind
+        assert classifications[module].package_name == sequential_classification.package_name
@@ -0,0 +1,55 @@
+"""Tests routing commands to multiple sidecar containers by executable name"""
+import subprocess
+
+import pytest
+
+import lug
+BASE_TEST_IMAGE = "alpine:3.16.2"
+SECOND_TEST_IMAGE = "busybox:1.36"
+
+
+@lug.run(image=BASE_TEST_IMAGE, sidecars={"busybox": SECOND_TEST_IMAGE})
+def routed_hostnames():
+    default_hostname = subprocess.run("hostname", capture_output=True, text=True, shell=True).stdout
+    routed_hostname = subprocess.run(["busybox", "hostname"], capture_output=True, text=True).stdout
+    return default_hostname, routed_hostname
+
+
+@lug.docker_sidecar(sidecar_image=BASE_TEST_IMAGE, sidecars={"busybox": SECOND_TEST_IMAGE})
+def routed_release_files():
+    default_release = lug.sidecar_shell("cat /etc/os-release").stdout
+    routed_release = lug.sidecar_shell("busybox cat /etc/os-release").stdout
+    return default_release, routed_release
+
+
+@lug.run(sidecars={"uname": BASE_TEST_IMAGE})
+def routed_without_default_image():
+    host_hostname = subprocess.run("hostname", capture_output=True, text=True, shell=True).stdout
+    routed_hostname = subprocess.run("uname -n", capture_output=True, text=True, shell=True).stdout
+    return host_hostname, routed_hostname
+
+
+@pytest.mark.unit
+def test_routed_to_separate_containers():
+    default_hostname, routed_hostname = routed_hostnames()
+    assert default_hostname != routed_hostname
+
+
+@pytest.mark.unit
+def test_sidecar_shell_routing():
+    default_release, routed_release = routed_release_files()
+    assert "Alpine" in default_release
+    assert "Alpine" not in routed_release
+
+
+@pytest.mark.unit
+def test_unrouted_commands_run_on_host():
+    host_hostname, routed_hostname = routed_without_default_image()
+    assert host_hostname == subprocess.run("hostname", capture_output=True, text=True, shell=True).stdout
+    assert host_hostname != routed_hostname
+
+
+@pytest.mark.unit
+def test_remote_routing_unsupported():
+    with pytest.raises(ValueError):
+        lug.run(image=BASE_TEST_IMAGE, remote=True, sidecars={"busybox": SECOND_TEST_IMAGE})
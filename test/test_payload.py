@@ -0,0 +1,129 @@
+"""Tests running functions from a binary payload file through the bootstrap script"""
+import contextvars
+import io
+import os
+import pickle
+import threading
+import subprocess
+import sys
+import tempfile
+
+import pytest
+
+from lug.lug import create_python_script, parse_toolchest_run
+from lug.module_detection import ModuleGraph
+from lug.payload import MIN_OUT_OF_BAND_BUFFER_SIZE, PAYLOAD_FILE_NAME, PAYLOAD_MAGIC, PayloadPickler
+
+
+@pytest.fixture
+def run_directory(tmp_path):
+    os.makedirs(tmp_path / "input" / ".lug-test")
+    os.makedirs(tmp_path / "output")
+    return tmp_path
+
+
+def run_payload(run_directory, func, args, kwargs, without_lug=False):
+    with tempfile.NamedTemporaryFile(dir=run_directory, suffix=".py") as temp_input:
+        output_uuid, _ = create_python_script(
+            func=func,
+            args=args,
+            kwargs=kwargs,
+            temp_input=temp_input,
+            user_docker=None,
+            docker_shell_location="/bin/sh",
+            serialize_dependencies=False,
+            internal_dir=str(run_directory / "input" / ".lug-test"),
+            redirect_shell=False,
+        )
+        script_size = os.path.getsize(temp_input.name)
+        command = [sys.executable, temp_input.name]
+        if without_lug:
+            # Runs the script with Lug made unimportable, like in a container that doesn't have it installed
+            command[1:1] = ["-c", "import runpy, sys; sys.modules['lug'] = None; runpy.run_path(sys.argv[1])"]
+        subprocess.run(command, cwd=run_directory, check=True)
+    return parse_toolchest_run(str(run_directory / "output"), output_uuid), script_size
+
+
+@pytest.mark.unit
+def test_payload_round_trip(run_directory):
+    large_argument = os.urandom(8 * 1024 ** 2)
+    result, script_size = run_payload(
+        run_directory,
+        func=lambda data, suffix=b"": (len(data), data[:16] + suffix),
+        args=(large_argument,),
+        kwargs={"suffix": b"\x00\n"},
+    )
+    assert result == (len(large_argument), large_argument[:16] + b"\x00\n")
+    # The arguments are only in the payload, which stores them without base64 inflation
+    assert script_size < 4096
+    payload_path = run_directory / "input" / ".lug-test" / PAYLOAD_FILE_NAME
+    assert payload_path.read_bytes().startswith(PAYLOAD_MAGIC)
+    assert len(large_argument) < os.path.getsize(payload_path) < len(large_argument) + 64 * 1024
+
+
+@pytest.mark.unit
+def test_large_buffers_out_of_band(run_directory):
+    class ZeroCopyBuffer(bytearray):
+        """Pickled out-of-band, and unpickled as a view of the received buffer (like NumPy arrays)"""
+        def __reduce_ex__(self, protocol):
+            return memoryview, (pickle.PickleBuffer(self),)
+
+    large_buffer = ZeroCopyBuffer(os.urandom(2 * MIN_OUT_OF_BAND_BUFFER_SIZE))
+    small_buffer = ZeroCopyBuffer(b"small")
+
+    def mutate_buffers(large, small):
+        large[0:4] = b"lug!"
+        return bytes(large), bytes(small)
+
+    result, _ = run_payload(run_directory, func=mutate_buffers, args=(large_buffer, small_buffer), kwargs={})
+    assert result == (b"lug!" + large_buffer[4:], b"small")
+    internal_dir = run_directory / "input" / ".lug-test"
+    assert sorted(path.name for path in internal_dir.iterdir()) == ["buffer_0", PAYLOAD_FILE_NAME]
+    # The buffer file is mapped copy-on-write, so it's left unchanged
+    assert (internal_dir / "buffer_0").read_bytes() == large_buffer
+    assert os.path.getsize(internal_dir / PAYLOAD_FILE_NAME) < MIN_OUT_OF_BAND_BUFFER_SIZE
+
+
+@pytest.mark.unit
+def test_numpy_arrays_out_of_band(run_directory):
+    numpy = pytest.importorskip("numpy")
+    array = numpy.arange(MIN_OUT_OF_BAND_BUFFER_SIZE, dtype=numpy.float64).reshape(1024, -1)
+
+    def double_in_place(values):
+        values *= 2
+        return values[-1, -1], values.flags.writeable
+
+    result, _ = run_payload(run_directory, func=double_in_place, args=(array,), kwargs={})
+    assert result == (array[-1, -1] * 2, True)
+    assert (run_directory / "input" / ".lug-test" / "buffer_0").stat().st_size == array.nbytes
+
+
+@pytest.mark.unit
+def test_async_function_payload(run_directory):
+    async def async_function(value):
+        return value * 2
+
+    result, _ = run_payload(run_directory, func=async_function, args=(21,), kwargs={})
+    assert result == 42
+
+
+@pytest.mark.unit
+def test_payload_without_sidecar_runs_without_lug(run_directory):
+    result, _ = run_payload(run_directory, func=lambda value: value + 1, args=(41,), kwargs={}, without_lug=True)
+    assert result == 42
+
+
+@pytest.mark.unit
+def test_process_state_pickled_as_new_objects():
+    context_variable = contextvars.ContextVar("lug_test_context_variable", default="default")
+    context_variable.set("set")
+    module_graph = ModuleGraph()
+    module_graph.namespace_edges["lug_test_module"] = (None, 0, set(), set())
+    lock = threading.Lock()
+    lock.acquire()
+    pickled_state = io.BytesIO()
+    PayloadPickler(pickled_state).dump((context_variable, module_graph, lock))
+    context_variable, module_graph, lock = pickle.loads(pickled_state.getvalue())
+    assert (context_variable.name, context_variable.get()) == ("lug_test_context_variable", "default")
+    assert module_graph.namespace_edges == dict()
+    assert lock.acquire(blocking=False)
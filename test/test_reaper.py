@@ -0,0 +1,62 @@
+"""Tests tearing down sidecar containers in the background"""
+import subprocess
+
+import docker
+import pytest
+
+import lug
+from lug.reaper import ContainerReaper, container_reaper, reap_containers_now
+BASE_TEST_IMAGE = "alpine:3.16.2"
+
+
+@lug.run(image=BASE_TEST_IMAGE)
+def container_hostname():
+    result = subprocess.run("hostname", capture_output=True, text=True, shell=True)
+    return result.stdout.strip()
+
+
+@pytest.mark.unit
+def test_container_is_reaped():
+    hostname = container_hostname()
+    container_reaper.drain()
+    assert lug.reaper_backlog() == 0
+    client = docker.from_env()
+    with pytest.raises(docker.errors.NotFound):
+        client.containers.get(hostname)
+
+
+class FakeContainer:
+    def __init__(self):
+        self.killed = False
+        self.removed = False
+
+    def kill(self):
+        self.killed = True
+
+    def remove(self, force=False):
+        self.removed = True
+
+
+class FakeDocker:
+    def __init__(self):
+        self.container = FakeContainer()
+
+
+@pytest.mark.unit
+def test_queue_is_drained_in_batches():
+    reaper = ContainerReaper(max_batch_size=4)
+    fake_dockers = [FakeDocker() for _ in range(10)]
+    reaper.pending.extend(fake_dockers)
+    assert reaper.backlog() == 10
+    reaper.drain()
+    assert reaper.backlog() == 0
+    assert all(fake_docker.container.killed and fake_docker.container.removed for fake_docker in fake_dockers)
+
+
+@pytest.mark.unit
+def test_reap_now_drains_queued_containers():
+    queued_docker, signalled_docker = FakeDocker(), FakeDocker()
+    container_reaper.pending.append(queued_docker)
+    reap_containers_now([signalled_docker])
+    assert queued_docker.container.removed and signalled_docker.container.removed
+    assert lug.reaper_backlog() == 0
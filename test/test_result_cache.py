@@ -0,0 +1,89 @@
+"""Tests caching sidecar shell results on disk"""
+import os
+import subprocess
+import time
+
+import pytest
+
+import lug
+from lug.result_cache import ResultCache
+BASE_TEST_IMAGE = "alpine:3.16.2"
+
+
+@pytest.fixture
+def cache(tmp_path):
+    return ResultCache(directory=str(tmp_path / "cache"), max_size=1024 ** 2)
+
+
+@pytest.fixture
+def mount(tmp_path):
+    mount = tmp_path / "mount"
+    mount.mkdir()
+    (mount / "input.txt").write_text("original")
+    return str(mount)
+
+
+@pytest.mark.unit
+def test_key_changes_with_inputs(cache, mount):
+    key = cache.key("sha256:image", "wc -c input.txt", {}, mount, ["input.txt"], [])
+    assert key == cache.key("sha256:image", "wc -c input.txt", {}, mount, ["input.txt"], [])
+    assert key != cache.key("sha256:other", "wc -c input.txt", {}, mount, ["input.txt"], [])
+    with open(os.path.join(mount, "input.txt"), "w") as input_file:
+        input_file.write("changed")
+    assert key != cache.key("sha256:image", "wc -c input.txt", {}, mount, ["input.txt"], [])
+
+
+@pytest.mark.unit
+def test_store_and_replay(cache, mount):
+    key = cache.key("sha256:image", "cp input.txt output.txt", {}, mount, ["input.txt"], ["output.txt"])
+    assert cache.replay(key, "cp input.txt output.txt", mount, ["output.txt"]) is None
+    with open(os.path.join(mount, "output.txt"), "w") as output_file:
+        output_file.write("original")
+    cache.store(key, mount, ["output.txt"], subprocess.CompletedProcess("cp", 0, b"\x00binary"))
+    os.remove(os.path.join(mount, "output.txt"))
+
+    result = cache.replay(key, "cp input.txt output.txt", mount, ["output.txt"])
+    assert (result.returncode, result.stdout) == (0, b"\x00binary")
+    with open(os.path.join(mount, "output.txt")) as output_file:
+        assert output_file.read() == "original"
+
+
+@pytest.mark.unit
+def test_least_recently_used_eviction(cache, mount):
+    cache.max_size = 1500
+    keys = [cache.key("sha256:image", f"command {i}", {}, mount, [], []) for i in range(3)]
+    for key in keys:
+        cache.store(key, mount, [], subprocess.CompletedProcess("command", 0, "x" * 600))
+        time.sleep(0.01)
+    assert cache.replay(keys[0], "command", mount, []) is None
+    assert cache.replay(keys[1], "command", mount, []) is not None
+    assert cache.replay(keys[2], "command", mount, []) is not None
+
+
+@lug.docker_sidecar(sidecar_image=BASE_TEST_IMAGE)
+def uppercase_input(input_path, output_path):
+    return lug.sidecar_shell(
+        f"tr a-z A-Z < {input_path} > {output_path}; date +%s%N",
+        cache=True,
+        inputs=[input_path],
+        outputs=[output_path],
+    )
+
+
+@pytest.mark.unit_io
+def test_cached_sidecar_shell(tmp_path):
+    lug.configure_result_cache(directory=str(tmp_path))
+    with open("cache_input.txt", "w") as input_file:
+        input_file.write("hello")
+    try:
+        first_result = uppercase_input("cache_input.txt", "cache_output.txt")
+        os.remove("cache_output.txt")
+        second_result = uppercase_input("cache_input.txt", "cache_output.txt")
+        assert (first_result.cached, second_result.cached) == (False, True)
+        assert first_result.stdout == second_result.stdout
+        with open("cache_output.txt") as output_file:
+            assert output_file.read() == "HELLO"
+    finally:
+        for path in ("cache_input.txt", "cache_output.txt"):
+            if os.path.exists(path):
+                os.remove(path)
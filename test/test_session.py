@@ -0,0 +1,62 @@
+"""Tests keeping one sidecar container open for many calls with lug.session()"""
+import os
+import subprocess
+
+import pytest
+
+import lug
+from lug.lug import active_session, usable_session
+from lug.session import Session
+BASE_TEST_IMAGE = "alpine:3.16.2"
+
+
+@lug.run(image=BASE_TEST_IMAGE)
+def session_hostname():
+    result = subprocess.run("hostname", capture_output=True, text=True, shell=True)
+    return result.stdout
+
+
+@lug.docker_sidecar(sidecar_image=BASE_TEST_IMAGE)
+def session_sidecar_hostname():
+    return lug.sidecar_shell("hostname").stdout
+
+
+@pytest.mark.unit
+def test_calls_share_one_container():
+    with lug.session(image=BASE_TEST_IMAGE) as s:
+        session_container_hostname = s.shell("hostname").stdout
+        for _ in range(5):
+            assert session_hostname() == session_container_hostname
+            assert session_sidecar_hostname() == session_container_hostname
+    # Outside of the session, calls get their own container again
+    assert session_hostname() != session_container_hostname
+
+
+@pytest.mark.unit
+def test_calls_outside_lugged_functions_run_on_host():
+    with lug.session(image=BASE_TEST_IMAGE, persistent_shell=True) as s:
+        assert s.shell("exit 2").returncode == 2
+        session_container_hostname = session_hostname()
+        host_hostname = subprocess.run("hostname", capture_output=True, text=True, shell=True).stdout
+        assert host_hostname != session_container_hostname
+
+
+@pytest.mark.unit
+def test_only_matching_calls_use_the_session():
+    session = Session(image=BASE_TEST_IMAGE, mount=os.getcwd())
+    token = active_session.set(session)
+    try:
+        call_options = dict(
+            image=BASE_TEST_IMAGE, mount=os.getcwd(), execute_in_container=False, warm_pool=False, docker_hosts=None,
+            exec_backend="cli", persistent_shell=False,
+        )
+        assert usable_session(**call_options) is session
+        assert usable_session(**{**call_options, "exec_backend": "api"}) is session
+        for option, value in [
+            ("image", "alpine:3.17"), ("mount", os.path.dirname(os.getcwd())), ("execute_in_container", True),
+            ("warm_pool", True), ("docker_hosts", ["unix:///var/run/docker.sock"]), ("persistent_shell", True),
+        ]:
+            assert usable_session(**{**call_options, option: value}) is None
+    finally:
+        active_session.reset(token)
+    assert usable_session(**call_options) is None
@@ -0,0 +1,34 @@
+"""Tests redirecting asyncio subprocesses into the sidecar container"""
+import asyncio
+
+import pytest
+
+import lug
+from .base import BASE_TEST_IMAGE
+
+
+@lug.run(image=BASE_TEST_IMAGE)
+async def concurrent_uname_calls(number):
+    shell_process = await asyncio.create_subprocess_shell("uname", stdout=asyncio.subprocess.PIPE)
+    exec_process = await asyncio.create_subprocess_exec("ls", "/", stdout=asyncio.subprocess.PIPE)
+    (shell_stdout, _), (exec_stdout, _) = await asyncio.gather(shell_process.communicate(), exec_process.communicate())
+    assert shell_stdout == b"Linux\n"
+    assert b"lug\n" in exec_stdout
+    return number
+
+
+@lug.docker_sidecar(sidecar_image=BASE_TEST_IMAGE)
+async def concurrent_sidecar_shell_calls(numbers):
+    results = await asyncio.gather(*[lug.sidecar_shell_async(f"echo {number}") for number in numbers])
+    return [int(result.stdout) for result in results]
+
+
+@pytest.mark.unit
+def test_asyncio_subprocesses():
+    assert asyncio.run(concurrent_uname_calls(4)) == 4
+
+
+@pytest.mark.unit
+def test_concurrent_sidecar_shell_async():
+    numbers = list(range(8))
+    assert asyncio.run(concurrent_sidecar_shell_calls(numbers)) == numbers
@@ -0,0 +1,69 @@
+"""Tests redirecting system calls through the Docker Engine API instead of the docker CLI"""
+import os
+import subprocess
+
+import pytest
+
+import lug
+from .base import BASE_TEST_IMAGE, base_test_decorator
+
+
+@pytest.mark.unit
+@base_test_decorator
+@lug.run(image=BASE_TEST_IMAGE, exec_backend="api")
+def test_subprocess_run_capture(number, **kwargs):
+    result = subprocess.run('echo "Hello, `uname`!"', capture_output=True, text=True, shell=True)
+    assert result.stdout == "Hello, Linux!\n"
+    assert result.returncode == 0
+    return number
+
+
+@pytest.mark.unit
+@base_test_decorator
+@lug.run(image=BASE_TEST_IMAGE, exec_backend="api")
+def test_subprocess_run_without_shell(number, **kwargs):
+    result = subprocess.run(["ls", "/"], capture_output=True, text=True)
+    assert "lug\n" in result.stdout
+    return number
+
+
+@pytest.mark.unit
+@base_test_decorator
+@lug.run(image=BASE_TEST_IMAGE, exec_backend="api")
+def test_subprocess_run_check(number, **kwargs):
+    with pytest.raises(subprocess.CalledProcessError):
+        subprocess.run("echo failing >&2; exit 3", capture_output=True, shell=True, check=True)
+    return number
+
+
+@pytest.mark.unit
+@base_test_decorator
+@lug.run(image=BASE_TEST_IMAGE, exec_backend="api")
+def test_subprocess_popen_pipes(number, **kwargs):
+    process = subprocess.Popen("echo out; echo err >&2; exit 2", stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+                               text=True, shell=True)
+    stdout, stderr = process.communicate()
+    assert (stdout, stderr, process.returncode) == ("out\n", "err\n", 2)
+    return number
+
+
+@pytest.mark.unit
+@base_test_decorator
+@lug.run(image=BASE_TEST_IMAGE, exec_backend="api")
+def test_os_system_exit_status(number, **kwargs):
+    assert os.system("exit 0") == 0
+    assert os.system("exit 5") >> 8 == 5
+    return number
+
+
+@pytest.mark.unit
+@base_test_decorator
+@lug.run(image=BASE_TEST_IMAGE, exec_backend="api")
+def test_subprocess_popen_signals(number, **kwargs):
+    process = subprocess.Popen("sleep 30", shell=True)
+    process.terminate()
+    assert process.wait(timeout=10) == -15
+    process = subprocess.Popen(["sleep", "30"])
+    process.kill()
+    assert process.wait(timeout=10) == -9
+    return number
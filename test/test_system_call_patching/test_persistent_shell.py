@@ -0,0 +1,39 @@
+"""Tests pipelining sidecar_shell and os.system commands through one persistent shell in the sidecar"""
+import os
+
+import pytest
+
+import lug
+from .base import BASE_TEST_IMAGE, base_test_decorator
+
+
+@pytest.mark.unit
+@base_test_decorator
+@lug.docker_sidecar(sidecar_image=BASE_TEST_IMAGE, persistent_shell=True)
+def test_many_sidecar_shell_calls(number, **kwargs):
+    for i in range(50):
+        result = lug.sidecar_shell(f"echo {i}")
+        assert result.stdout == f"{i}\n"
+        assert result.returncode == 0
+    return number
+
+
+@pytest.mark.unit
+@base_test_decorator
+@lug.docker_sidecar(sidecar_image=BASE_TEST_IMAGE, persistent_shell=True)
+def test_commands_are_isolated(number, **kwargs):
+    """Exit codes, exits, and directory changes don't leak into the following commands"""
+    assert lug.sidecar_shell("cd /tmp; echo 'single quoted' >&2; exit 3").returncode == 3
+    result = lug.sidecar_shell("pwd")
+    assert (result.stdout, result.returncode) == ("/lug\n", 0)
+    assert lug.sidecar_shell("printf 'no trailing newline'").stdout == "no trailing newline"
+    return number
+
+
+@pytest.mark.unit
+@base_test_decorator
+@lug.run(image=BASE_TEST_IMAGE, persistent_shell=True)
+def test_os_system(number, **kwargs):
+    assert os.system("exit 0") == 0
+    assert os.system("exit 4") >> 8 == 4
+    return number
@@ -0,0 +1,38 @@
+"""Tests running many shell commands concurrently in the sidecar container"""
+import time
+
+import pytest
+
+import lug
+from .base import BASE_TEST_IMAGE, base_test_decorator
+
+
+@pytest.mark.unit
+@base_test_decorator
+@lug.docker_sidecar(sidecar_image=BASE_TEST_IMAGE)
+def test_results_in_order(number, **kwargs):
+    started_at = time.monotonic()
+    results = lug.sidecar_shell_many([f"sleep 1; echo {i}" for i in range(8)], max_concurrency=8)
+    assert time.monotonic() - started_at < 8
+    assert [result.stdout for result in results] == [f"{i}\n" for i in range(8)]
+    assert all(result.duration >= 1 for result in results)
+    return number
+
+
+@pytest.mark.unit
+@base_test_decorator
+@lug.docker_sidecar(sidecar_image=BASE_TEST_IMAGE)
+def test_yield_as_completed(number, **kwargs):
+    results = lug.sidecar_shell_many(["sleep 2; exit 1", "exit 2"], max_concurrency=2, yield_as_completed=True)
+    assert [(index, result.returncode) for index, result in results] == [(1, 2), (0, 1)]
+    return number
+
+
+@pytest.mark.unit
+@base_test_decorator
+@lug.docker_sidecar(sidecar_image=BASE_TEST_IMAGE, exec_backend="api", persistent_shell=True)
+def test_concurrent_with_persistent_shell(number, **kwargs):
+    results = lug.sidecar_shell_many(["hostname"] * 4, max_concurrency=4)
+    assert len({result.stdout for result in results}) == 1
+    assert all(result.returncode == 0 for result in results)
+    return number
@@ -0,0 +1,52 @@
+"""Tests streaming lug.sidecar_shell output and writing it to a file in the mount"""
+import os
+
+import pytest
+
+import lug
+from .base import BASE_TEST_IMAGE, base_test_decorator
+
+
+@pytest.mark.unit
+@base_test_decorator
+@lug.docker_sidecar(sidecar_image=BASE_TEST_IMAGE)
+def test_stream_lines(number, **kwargs):
+    output = lug.sidecar_shell("for i in 1 2 3; do echo line $i; done; exit 5", stream=True)
+    assert list(output) == ["line 1\n", "line 2\n", "line 3\n"]
+    assert output.returncode == 5
+    return number
+
+
+@pytest.mark.unit
+@base_test_decorator
+@lug.docker_sidecar(sidecar_image=BASE_TEST_IMAGE, exec_backend="api")
+def test_stream_bounded_chunks(number, **kwargs):
+    output = lug.sidecar_shell("head -c 1000000 /dev/zero", stream=True, text=False, chunk_size=4096)
+    chunk_sizes = [len(chunk) for chunk in output]
+    assert max(chunk_sizes) <= 4096
+    assert sum(chunk_sizes) == 1000000
+    assert output.returncode == 0
+    return number
+
+
+@pytest.mark.unit
+@base_test_decorator
+@lug.docker_sidecar(sidecar_image=BASE_TEST_IMAGE)
+def test_stream_abandoned_early(number, **kwargs):
+    with lug.sidecar_shell("yes | head -n 100000", stream=True) as output:
+        assert next(iter(output)) == "y\n"
+    assert output.returncode == 0
+    return number
+
+
+@pytest.mark.unit_io
+@base_test_decorator
+@lug.docker_sidecar(sidecar_image=BASE_TEST_IMAGE)
+def test_output_to_file(number, **kwargs):
+    result = lug.sidecar_shell("uname; echo error >&2 # trailing comment", to_file="streamed_output.txt")
+    assert result.returncode == 0
+    assert result.stdout is None
+    with open("streamed_output.txt") as output_file:
+        assert output_file.read() == "Linux\nerror\n"
+    os.remove("streamed_output.txt")
+    return number